@@ -0,0 +1,148 @@
+import os
+import time
+import asyncio
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import MM_run
+from MM_mpi import StealPool, add_mpi_arguments
+
+# Miriad Multicore asyncio engine
+# A drop-in for the schwimmbad pools (map, imap, apply_async, close) that runs the task functions
+# in threads of this process and launches their miriad commands with
+# asyncio.create_subprocess_exec on one event loop, at most `processes` commands at a time.
+# There are no worker processes to start, import into or pickle task lists for, and each task
+# still runs its miriad commands in order (invert, then clean, restor, ... of a channel).
+# A task only holds a slot while its miriad command runs, so the python side of the tasks
+# (noise, copying back from scratch, the state journal) overlaps the commands of others.
+# WORKS FOR PYTHON 3
+
+ENGINES = ['pool', 'asyncio']
+# Seconds between checks of the cancel file of a speculated task's command
+CANCEL_POLL = 0.5
+
+
+class AsyncioPool:
+    '''
+    Pool running tasks in threads and their miriad commands on an asyncio event loop
+
+    Inputs:
+    processes = maximum number of miriad commands running at once
+    threads = number of tasks in flight (default twice processes)
+    timeout = seconds after which a miriad command is killed (None for no limit)
+    '''
+
+    def __init__(self, processes=1, threads=None, timeout=None):
+        self.processes = processes
+        self.timeout = timeout
+        # run_graph keeps this many tasks in flight
+        self._processes = threads or 2 * processes
+        self._executor = ThreadPoolExecutor(max_workers=self._processes)
+        self._children = set()
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+        self._slots = asyncio.run_coroutine_threadsafe(self._make_slots(), self._loop).result()
+        MM_run.set_engine(self)
+
+    async def _make_slots(self):
+        return asyncio.Semaphore(self.processes)
+
+    async def _exec(self, args, stdout, stderr, env=None, preexec_fn=None, timeout=None, cancel=None):
+        async with self._slots:
+            start = time.time()
+            proc = await asyncio.create_subprocess_exec(*args, stdout=stdout, stderr=stderr,
+                                                        env=env, preexec_fn=preexec_fn)
+            self._children.add(proc)
+            limit = timeout or self.timeout
+            try:
+                while True:
+                    # With a cancel file the command is woken up every CANCEL_POLL seconds to check it
+                    left = None if limit is None else max(start + limit - time.time(), 0)
+                    step = left if cancel is None else min(CANCEL_POLL, left if left is not None else CANCEL_POLL)
+                    try:
+                        return await asyncio.wait_for(proc.wait(), step), start, False
+                    except asyncio.TimeoutError:
+                        if limit is not None and time.time() >= start + limit:
+                            proc.kill()
+                            return await proc.wait(), start, True
+                        if cancel is not None and os.path.exists(cancel):
+                            proc.kill()
+                            return await proc.wait(), start, False
+            finally:
+                self._children.discard(proc)
+
+    def run(self, args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=None, preexec_fn=None, timeout=None, cancel=None):
+        '''
+        Runs one command on the event loop from a task thread
+
+        Outputs:
+        exit code (negative signal number if it was killed), the time the command started,
+        which is later than the call if all slots were busy, and whether it was killed by the
+        timeout (the timeout of the call, or of the pool if the call has none). The command is
+        also killed once the cancel file appears (see MM_state.attempt).
+        '''
+        return asyncio.run_coroutine_threadsafe(self._exec(args, stdout, stderr, env, preexec_fn, timeout, cancel), self._loop).result()
+
+    def is_master(self):
+        return True
+
+    def map(self, func, iterable, callback=None):
+        results = list(self._executor.map(func, iterable))
+        if callback is not None:
+            for result in results:
+                callback(result)
+        return results
+
+    def imap(self, func, iterable):
+        return self._executor.map(func, iterable)
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        future = self._executor.submit(func, *args)
+
+        def done(future):
+            if future.exception() is not None:
+                if error_callback is not None:
+                    error_callback(future.exception())
+            elif callback is not None:
+                callback(future.result())
+        future.add_done_callback(done)
+        return future
+
+    def terminate(self):
+        '''
+        Kills the running miriad commands and drops the tasks that have not started
+        '''
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for proc in list(self._children):
+            self._loop.call_soon_threadsafe(proc.kill)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        MM_run.set_engine(None)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+
+
+def add_engine_arguments(parser):
+    '''
+    Adds the execution engine option shared by the multicore scripts to an argparse parser
+    '''
+    parser.add_argument("--engine", dest="engine", default="pool", choices=ENGINES,
+                        help="pool: schwimmbad worker processes (multiprocessing or MPI)\n"
+                             "asyncio: miriad commands launched from one process, --ncores at a time")
+
+    add_mpi_arguments(parser)
+
+
+def choose_engine(args):
+    '''
+    Builds the pool for the parsed command line options (--engine, --ncores, --mpi, --mpi-dispatch)
+    '''
+    import schwimmbad
+    if args.engine == 'asyncio':
+        return AsyncioPool(args.n_cores)
+    if args.mpi and args.mpi_dispatch == 'steal':
+        return StealPool(args.mpi_chunk, args.mpi_affinity)
+    return schwimmbad.choose_pool(mpi=args.mpi, processes=args.n_cores)
@@ -0,0 +1,268 @@
+import sys
+import argparse
+import tqdm
+
+from MM_pipeline import build_tasks
+from MM_scheduler import run_graph, read_runtimes
+from MM_state import add_state_arguments
+from MM_scratch import add_scratch_arguments
+from MM_trace import add_trace_arguments
+from MM_memory import add_memory_arguments
+from MM_placement import add_placement_arguments, autotune
+from MM_async import choose_engine, add_engine_arguments
+from MM_retry import apply_retry, add_retry_arguments
+from MM_prebin import prebin_passes, add_prebin_arguments
+from MM_block import BLOCK_NOTE, add_block_arguments
+from MM_manifest import DEFAULT_GLOBS, manifest_name, load_manifest, channel_range, add_manifest_arguments
+from MM_flags import screen, add_flag_arguments
+from MM_cube import CubeWriter, add_cube_arguments
+
+# Miriad Multicore Batch
+# Region imaging of many targets in one field from a catalogue of offsets: the invert, noise and
+# clean tasks of every (target, channel) go into one task graph on one pool (the region mode of
+# MM_pipeline.py for each target), so the visibilities are scanned and screened once and the pool
+# stays busy until the last task of the last target instead of draining at the end of every run.
+# Each target's images, state journal and cubes are named after the target,
+# e.g. {target}.{freq}.{chan}.{stokes}.map
+# WORKS FOR PYTHON 3
+
+# Stages of the per-target task graph, the prebin tasks are shared by all targets
+TARGET_STAGES = ('grid', 'noise', 'clean')
+
+
+def read_catalogue(path, field=2000):
+    '''
+    Reads the target catalogue: one target per line, name xoff yoff [field]
+    (whitespace or comma separated, offsets and field size in pixels, # comments)
+
+    Inputs:
+    path = catalogue file
+    field = field size of targets without one
+
+    Outputs:
+    list of (name, xoff, yoff, field)
+    '''
+    targets = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            words = line.split('#')[0].replace(',', ' ').split()
+            if not words:
+                continue
+            if len(words) not in (3, 4):
+                raise ValueError(f'{path}:{number}: expected name xoff yoff [field], got {line.strip()}')
+            name, xoff, yoff = words[0], int(words[1]), int(words[2])
+            targets.append((name, xoff, yoff, int(words[3]) if len(words) == 4 else field))
+    names = [target[0] for target in targets]
+    repeated = sorted({name for name in names if names.count(name) > 1})
+    if repeated:
+        raise ValueError(f'{path}: target names must be unique, repeated: {" ".join(repeated)}')
+    return targets
+
+
+def target_args(args, target):
+    '''
+    Command line arguments of one target: the region mode of the pipeline with the target's
+    offset and field size, named (and journalled) after the target
+    '''
+    name, xoff, yoff, field = target
+    sub = argparse.Namespace(**vars(args))
+    sub.source, sub.xoff, sub.yoff, sub.field_size = name, xoff, yoff, field
+    sub.region_mode = True
+    return sub
+
+
+def batch_tasks(args, targets, manifest, screened):
+    '''
+    Merges the task graphs of all targets into one
+
+    Outputs:
+    dict of (stage, chan, stokes, target) -> (func, args, deps) for MM_scheduler.run_graph, the
+    shared prebin tasks keeping their own keys. Tasks are ordered channel by channel across the
+    targets so that tasks of equal priority are submitted round robin over the targets.
+    '''
+    def rename(key, name):
+        return key + (name,) if key[0] in TARGET_STAGES else key
+
+    merged = []
+    for index, target in enumerate(targets):
+        name = target[0]
+        tasks = build_tasks(target_args(args, target), manifest, screened)
+        for key, (func, task_args, deps) in tasks.items():
+            merged.append(((key[1], index), rename(key, name), (func, task_args, [rename(dep, name) for dep in deps])))
+    merged.sort(key=lambda item: item[0])
+    return {key: task for _, key, task in merged}
+
+
+def batch_priority(args, targets):
+    '''
+    Priority of the batch tasks: cleans (longest first) ahead of the inverts (largest field first)
+
+    Cleans without a past runtime are estimated from the runtime per pixel of the cleans of the
+    targets that have one, so a new large target is not left to the end of the run.
+    '''
+    runtimes = read_runtimes(args.runtime_table)
+    fields = {name: field for name, _, _, field in targets}
+    largest = max(fields.values())
+    rates = [seconds / fields[source]**2 for (stage, source, freq, _, _), (seconds, _) in runtimes.items()
+             if stage == 'clean' and source in fields and freq == str(args.freq)]
+    rate = sum(rates) / len(rates) if rates else 0.0
+
+    def priority(key):
+        stage, chan, stokes, name = key
+        if stage == 'grid':
+            return 0.5 * (fields[name] / largest)**2
+        past = runtimes.get((stage, name, str(args.freq), chan, stokes), (rate * fields[name]**2, 0))[0]
+        return 1.0 + past
+    return priority
+
+
+def main(pool, args):
+
+    targets = read_catalogue(args.catalogue, args.field_size)
+    if not targets:
+        print(f'No targets in {args.catalogue}')
+        pool.close()
+        sys.exit(1)
+
+    # The visibilities of the field are found and pre-screened once for all targets
+    manifest = load_manifest(args.source, args.freq, args.vis_globs or DEFAULT_GLOBS['region'], args.manifest, args.rescan)
+    chans = channel_range(manifest, args.start_chan, args.end_chan, args.step_size)
+    screened = screen(manifest, chans, args)
+    tasks = batch_tasks(args, targets, manifest, screened)
+    if args.block_size > 1:
+        print(BLOCK_NOTE)
+
+    # The shared visibility bins are cut first, in passes of independent tasks (see MM_prebin.prebin_passes)
+    passes, tasks = prebin_passes(tasks)
+    if passes:
+        print('Binning Visibilities')
+    for binning in passes:
+        for _ in tqdm.tqdm(run_graph(pool, binning), total=len(binning)):
+            pass
+
+    print(f'Creating and Cleaning Images of {len(targets)} targets')
+    cubes = {}
+    if args.cube:
+        for name, _, _, _ in targets:
+            cubes[name] = CubeWriter(name, args.freq, chans, args.step_size, ['i','q','u','v'], args.cube_compress,
+                                     args.manifest or manifest_name(args.source, args.freq))
+    for key, _ in tqdm.tqdm(run_graph(pool, tasks, batch_priority(args, targets), args.speculate, ('grid', 'clean')), total=len(tasks)):
+        if cubes and key[0] == 'clean':
+            cubes[key[3]].add(key[1], key[2])
+    pool.close()
+    for name, writer in cubes.items():
+        print(f'Cubes of {name}: ' + ' '.join(writer.close()))
+
+
+if __name__ == "__main__":
+
+
+    # Help string to be shown using the -h option
+    descStr = """
+    Runs region invert and clean for every target of a catalogue of offsets in one field, with all
+    the (target, channel) tasks in one pool. Equivalent to MM_pipeline.py --region-mode once per target.
+    The catalogue has one target per line: name xoff yoff [field]
+    """
+
+    # Parse the command line options
+    parser = argparse.ArgumentParser(description=descStr,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-s", dest="source",
+                        type=str, help="Source name of the field in RA-DEC convention from miriad")
+
+    parser.add_argument("-c", dest="catalogue", required=True,
+                        help="target catalogue: name xoff yoff [field] per line (offsets in pixels)")
+
+    parser.add_argument("-f", dest="freq", type=int, default=2100,
+                        help="centre frequency in MHz")
+
+    parser.add_argument("-1", dest="start_chan", type=int, default=1,
+                        help="starting channel number")
+
+    parser.add_argument("-2", dest="end_chan", type=int, default=None,
+                        help="final channel number (default from the visibility manifest)")
+
+    parser.add_argument("-d", dest="step_size", type=int, default=5,
+                        help="channel step_size for images")
+
+    parser.add_argument("-b", dest="field_size", type=int, default=2000,
+                        help="size of field in pixels sqr (targets without one in the catalogue)")
+
+    add_block_arguments(parser)
+
+    parser.add_argument("-i", dest="n_iters", type=int, default=1000,
+                        help="number of iterations to clean")
+
+    parser.add_argument("-r", dest="region", type=float, default=95,
+                        help="region (percentage) to clean as percentage of image")
+
+    parser.add_argument("--noise", dest="noise_method", default="std", choices=['mad','clip','std'],
+                        help="estimator for the stokes v noise used as clean cutoff")
+
+    parser.add_argument("--noise-table", dest="noise_table", default="noise_table.txt",
+                        help="table caching per-channel noise between runs, also passes the noise of each\n"
+                             "channel to its clean tasks (cannot be disabled in the batch)")
+
+    parser.add_argument("--runtime-table", dest="runtime_table", default="runtime_table.txt",
+                        help="table of past clean runtimes used to start the slowest cleans first ('' to disable)")
+
+    add_prebin_arguments(parser)
+
+    add_state_arguments(parser)
+
+    add_scratch_arguments(parser)
+
+    add_trace_arguments(parser)
+
+    add_memory_arguments(parser)
+
+    add_placement_arguments(parser)
+
+    add_flag_arguments(parser)
+
+    add_cube_arguments(parser)
+
+    add_manifest_arguments(parser, DEFAULT_GLOBS['region'])
+
+    add_retry_arguments(parser)
+
+    add_engine_arguments(parser)
+
+    group = parser.add_mutually_exclusive_group()
+
+    group.add_argument("--ncores", dest="n_cores", default=1,
+                       type=int, help="Number of processes (uses multiprocessing).")
+    group.add_argument("--mpi", dest="mpi", default=False,
+                       action="store_true", help="Run with MPI.")
+
+
+    args = parser.parse_args()
+    if args.engine == 'asyncio' and args.mpi:
+        parser.error('--engine asyncio runs on one node, it cannot be combined with --mpi')
+    if args.autotune and args.mpi:
+        parser.error('--autotune sizes a single node run, it cannot be combined with --mpi')
+    if args.autotune and args.state == '':
+        parser.error("--autotune needs the state journal to skip its trial channels in the run, it cannot be combined with --state ''")
+    if args.prebin and args.block_size > 1:
+        parser.error('--prebin and --block cannot be combined')
+    if args.flag_merge and (args.prebin or args.block_size > 1):
+        parser.error('--flag-merge cannot be combined with --prebin or --block')
+    if not args.noise_table:
+        parser.error('the clean tasks read the noise of their channel from the noise table, --noise-table cannot be empty')
+    if args.state not in (None, ''):
+        parser.error("each target has its own state journal ({target}.{freq}.state.log), --state only takes '' to disable them")
+    # Timeouts and retries of the miriad tasks, inherited by the workers
+    apply_retry(args)
+    if args.autotune:
+        # The first channels still to do of all targets are run with each processes x threads split, the rest with the fastest
+        args.n_cores, args.threads = autotune(main, args, 'clean', 'region', [target[0] for target in read_catalogue(args.catalogue, args.field_size)])
+    pool = choose_engine(args)
+
+    if args.mpi:
+        if not pool.is_master():
+            pool.wait()
+            sys.exit(0)
+
+
+    # Makes and cleans the images of every target
+    main(pool, args)
@@ -0,0 +1,339 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+
+from MM_miriad_io import read_header, read_image, write_header, write_image, write_uv
+from MM_fits import write_fits
+from MM_trace import read_trace, percentile
+from MM_async import ENGINES
+
+# Miriad Multicore benchmark
+# Runs the multicore inverters and cleaners against fake miriad tasks (invert, clean, restor,
+# linmos, gethd, puthd, fits, imsub, uvcat, uvaver) put first on PATH. The fakes sleep, allocate
+# memory and write miriad style datasets of the real sizes, so the scheduling of the scripts can be
+# timed and changed without a miriad install. Reports channels/sec, scaling efficiency over the
+# --ncores (and MPI) values, the share of the run not spent in miriad tasks, and tail latency.
+# WORKS FOR PYTHON 3
+
+MB = 1024**2
+
+# Seconds and MB of memory of one run of each fake task (jitter is the sigma of a lognormal factor
+# on the time, giving the long tail real cleans have, fail is the chance a run exits with 1)
+DEFAULT_COSTS = {
+    'invert': {'time': 0.5, 'memory': 200},
+    'clean': {'time': 0.3, 'memory': 100},
+    'mfclean': {'time': 0.3, 'memory': 100},
+    'restor': {'time': 0.1, 'memory': 50},
+    'linmos': {'time': 0.05, 'memory': 50},
+    'gethd': {'time': 0.01, 'memory': 0},
+    'puthd': {'time': 0.01, 'memory': 0},
+    'fits': {'time': 0.05, 'memory': 50},
+    'imsub': {'time': 0.02, 'memory': 20},
+    'uvcat': {'time': 0.1, 'memory': 20},
+    'uvaver': {'time': 0.1, 'memory': 20},
+}
+# Fake clean iterations per e-fold drop of the residual peak
+CLEAN_DECAY = 500
+
+# Inverter and cleaner run one after the other in the same directory, the cleaner using the maps
+LAYOUTS = {
+    'multicore': ('MM_inverter.py', 'MM_cleaner.py'),
+    'region': ('MM_region_invert.py', 'MM_region_clean.py'),
+}
+
+
+def fake_task(name, argv, costs):
+    '''
+    Does the work of one fake miriad task
+
+    Inputs:
+    name = miriad task name
+    argv = its key=value command line arguments
+    costs = dict of task name -> {'time', 'memory', 'jitter', 'fail'}
+
+    Outputs:
+    exit code
+    '''
+    kv = dict(a.split('=', 1) for a in argv if '=' in a)
+    cost = dict(DEFAULT_COSTS.get(name, {}), **costs.get(name, {}))
+    # Hold the memory for the whole run, touching every page so it counts in the peak rss
+    hold = np.ones(int(cost.get('memory', 0) * MB), dtype=np.uint8)
+    time.sleep(cost.get('time', 0) * random.lognormvariate(0, cost.get('jitter', 0)))
+    if random.random() < cost.get('fail', 0):
+        return 1
+
+    if name == 'invert':
+        field = int(kv.get('imsize', '256').split(',')[0])
+        nplanes = 1 if 'mfs' in kv.get('options', '') else int(kv['line'].split(',')[1])
+        header = {'crval3': 1.4, 'cdelt3': 0.001, 'ctype3': 'FREQ', 'bunit': 'JY/BEAM'}
+        for out in kv['map'].split(',') + [kv['beam']]:
+            write_image(out, np.random.standard_normal((nplanes, field, field)).astype(np.float32), header)
+    elif name in ('clean', 'mfclean'):
+        # The residual falls by e every CLEAN_DECAY iterations, clean stops early at the cutoff
+        # and counts its iterations (with those of the input model) in the model header
+        header = read_header(kv['map'])
+        data = read_image(kv['map'])
+        before = read_header(kv['model']).get('niters', 0) if 'model' in kv else 0
+        cutoff = float(kv.get('cutoff', 0))
+        peak = float(np.abs(data).max())
+        needed = CLEAN_DECAY * np.log(peak / cutoff) if 0 < cutoff < peak else 0
+        header['niters'] = int(min(before + int(kv.get('niters', 100)), max(before, needed)))
+        write_image(kv['out'], np.zeros_like(data), header)
+    elif name == 'restor':
+        header = read_header(kv['map'])
+        data = read_image(kv['map'])
+        if kv.get('mode') == 'residual':
+            data = data * np.exp(-read_header(kv['model']).get('niters', 0) / CLEAN_DECAY)
+        write_image(kv['out'], data, header)
+    elif name == 'linmos':
+        write_image(kv['out'], read_image(kv['in']), read_header(kv['in']))
+    elif name == 'imsub':
+        plane = int(kv['region'].split('(')[1].split(',')[0]) - 1
+        write_image(kv['out'], read_image(kv['in'], plane)[np.newaxis], read_header(kv['in']))
+    elif name == 'gethd':
+        dataset, item = os.path.split(kv['in'])
+        with open(kv['log'], 'w') as f:
+            f.write(f"{read_header(dataset).get(item, 0.001)}\n")
+    elif name == 'puthd':
+        dataset, item = os.path.split(kv['in'])
+        value = kv['value']
+        if value.startswith('@'):
+            with open(value[1:]) as f:
+                value = f.read().strip()
+        header = read_header(dataset)
+        header[item] = float(value)
+        write_header(dataset, header)
+    elif name == 'fits':
+        write_fits(kv['out'], read_image(kv['in']), read_header(kv['in']))
+    elif name in ('uvcat', 'uvaver'):
+        shutil.copytree(kv['vis'].split(',')[0], kv['out'])
+    del hold
+    return 0
+
+
+def fake_main(config):
+    '''
+    Entry point of the fake task executables, the task is the name the executable was run as
+    '''
+    with open(config) as f:
+        costs = json.load(f)
+    sys.exit(fake_task(os.path.basename(sys.argv[0]), sys.argv[1:], costs))
+
+
+def install_fakes(bin_dir, costs):
+    '''
+    Writes an executable for every fake miriad task into bin_dir
+
+    Inputs:
+    bin_dir = directory to put first on PATH
+    costs = per task overrides of DEFAULT_COSTS
+    '''
+    os.makedirs(bin_dir, exist_ok=True)
+    config = os.path.join(bin_dir, 'fake_costs.json')
+    with open(config, 'w') as f:
+        json.dump(costs, f)
+    repo = os.path.dirname(os.path.abspath(__file__))
+    for name in DEFAULT_COSTS:
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(f'#!{sys.executable}\n'
+                    f'import sys\n'
+                    f'sys.path.insert(0, {repo!r})\n'
+                    f'from MM_benchmark import fake_main\n'
+                    f'fake_main({config!r})\n')
+        os.chmod(path, 0o755)
+
+
+def make_visibilities(path, nchan, nrec=100):
+    '''
+    Writes a fake uvaver dataset with nchan channels for the manifest and the fake invert
+    '''
+    write_uv(path, {'nchan': np.array([nchan], dtype=np.int32), 'sfreq': np.array([1.4]),
+                    'sdf': np.array([0.001]), 'source': 'bench',
+                    'corr': np.zeros(2 * nchan, dtype=np.float32)}, nrec)
+
+
+def run_script(script, workdir, bin_dir, options, ncores=None, mpi=None, engine='pool', trace='trace.jsonl'):
+    '''
+    Runs one of the multicore scripts (its main(pool, args)) with the fakes on PATH
+
+    Inputs:
+    script = script file name, e.g. MM_inverter.py
+    options = command line options of the run
+    ncores = --ncores value, or mpi = number of MPI workers (run under mpiexec with one extra rank
+             for the schwimmbad master)
+    engine = --engine value (pool or asyncio, see MM_async)
+
+    Outputs:
+    wall time of the run in seconds and the trace records of its miriad tasks
+    '''
+    repo = os.path.dirname(os.path.abspath(__file__))
+    cmd = [sys.executable, os.path.join(repo, script)] + options + ['--trace', trace, '--engine', engine]
+    if mpi:
+        cmd = ['mpiexec', '-n', str(mpi + 1)] + cmd + ['--mpi']
+    else:
+        cmd += ['--ncores', str(ncores)]
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+               PYTHONPATH=repo + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    start = time.time()
+    subprocess.run(cmd, cwd=workdir, env=env, stdout=subprocess.DEVNULL, check=True)
+    elapsed = time.time() - start
+    trace = os.path.join(workdir, trace)
+    return elapsed, read_trace(trace) if os.path.isfile(trace) else []
+
+
+def measure(script, stage, elapsed, entries, nchan, workers):
+    '''
+    Throughput and latency figures of one run from its trace
+
+    Outputs:
+    dict of channels/sec, fraction of worker time not spent in miriad tasks (scheduling, python
+    startup, idle workers) and percentiles of the per-channel miriad time
+    '''
+    per_chan = {}
+    for entry in entries:
+        if entry.get('stage') == stage:
+            per_chan[entry['chan']] = per_chan.get(entry['chan'], 0.0) + entry['wall']
+    busy = sum(entry['wall'] for entry in entries)
+    latency = list(per_chan.values())
+    return {'script': script, 'workers': workers, 'elapsed': elapsed, 'channels': nchan,
+            'chan_per_sec': nchan / elapsed, 'overhead': max(0.0, 1 - busy / (elapsed * workers)),
+            'p50': percentile(latency, 50), 'p95': percentile(latency, 95), 'max': max(latency, default=0.0)}
+
+
+def benchmark(layouts, ncores_list, mpi_list, nchan, step, field, costs, engines=('pool',), keep=False):
+    '''
+    Runs the inverter then the cleaner of every layout for each engine and number of workers
+
+    Outputs:
+    list of result dicts from measure, with the scaling efficiency of each run relative to the
+    first run of the same script
+    '''
+    root = tempfile.mkdtemp(prefix='mm_bench_')
+    bin_dir = os.path.join(root, 'bin')
+    install_fakes(bin_dir, costs)
+    vis = os.path.join(root, 'vis', 'bench.2100.uvaver')
+    make_visibilities(vis, nchan * step)
+    options = ['-s', 'bench', '-f', '2100', '-1', '1', '-2', str(1 + nchan * step), '-d', str(step)]
+    runs = [(engine, 'ncores', n) for engine in engines for n in ncores_list]
+    runs += [('pool', 'mpi', n) for n in mpi_list]
+    results = []
+    try:
+        for layout in layouts:
+            inverter, cleaner = LAYOUTS[layout]
+            for engine, kind, workers in runs:
+                workdir = os.path.join(root, f'{layout}.{engine}.{kind}.{workers}')
+                os.makedirs(workdir)
+                pool = {kind: workers, 'engine': engine}
+                elapsed, entries = run_script(inverter, workdir, bin_dir, options + ['-b', str(field), '--vis-glob', vis],
+                                              trace='invert.trace.jsonl', **pool)
+                results.append(dict(measure(inverter, 'grid', elapsed, entries, nchan, workers), pool=kind, engine=engine))
+                elapsed, entries = run_script(cleaner, workdir, bin_dir, options, trace='clean.trace.jsonl', **pool)
+                results.append(dict(measure(cleaner, 'clean', elapsed, entries, nchan, workers), pool=kind, engine=engine))
+    finally:
+        if keep:
+            print(f'Benchmark directory kept in {root}')
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+    for result in results:
+        base = next(r for r in results if r['script'] == result['script'] and r['engine'] == result['engine'])
+        result['efficiency'] = (result['chan_per_sec'] / base['chan_per_sec']) / (result['workers'] / base['workers'])
+    return results
+
+
+def report(results):
+    lines = [f"{'script':22s} {'engine':7s} {'pool':6s} {'workers':>7s} {'wall[s]':>8s} {'chan/s':>8s} {'eff':>6s} "
+             f"{'ovhd':>6s} {'p50[s]':>7s} {'p95[s]':>7s} {'max[s]':>7s}"]
+    for r in results:
+        lines.append(f"{r['script']:22s} {r['engine']:7s} {r['pool']:6s} {r['workers']:7d} {r['elapsed']:8.2f} {r['chan_per_sec']:8.2f} "
+                     f"{r['efficiency']:6.2f} {r['overhead']:6.2f} {r['p50']:7.2f} {r['p95']:7.2f} {r['max']:7.2f}")
+    return lines
+
+
+def regressions(results, baseline, tolerance):
+    '''
+    Runs whose channels/sec dropped more than tolerance (fraction) below the same run in baseline
+    '''
+    past = {(r['script'], r.get('engine', 'pool'), r['pool'], r['workers']): r['chan_per_sec'] for r in baseline}
+    return [r for r in results
+            if r['chan_per_sec'] < (1 - tolerance) * past.get((r['script'], r['engine'], r['pool'], r['workers']), 0)]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    # Help string to be shown using the -h option
+    descStr = """
+    Benchmarks the parallel paths of the multicore inverters and cleaners with fake miriad tasks
+    """
+
+    parser = argparse.ArgumentParser(description=descStr,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--layout", dest="layouts", default=list(LAYOUTS), nargs='+', choices=list(LAYOUTS),
+                        help="scripts to benchmark: multicore (MM_inverter/MM_cleaner) and/or region")
+
+    parser.add_argument("--ncores", dest="ncores", default=[1, 2, 4], type=int, nargs='*',
+                        help="numbers of processes to run with")
+
+    parser.add_argument("--mpi", dest="mpi", default=[], type=int, nargs='*',
+                        help="numbers of MPI workers to run with (needs mpiexec and mpi4py)")
+
+    parser.add_argument("--engine", dest="engines", default=['pool'], nargs='+', choices=ENGINES,
+                        help="execution engines to run the --ncores values with (see MM_async)")
+
+    parser.add_argument("-n", dest="nchan", type=int, default=16,
+                        help="number of output channels")
+
+    parser.add_argument("-d", dest="step_size", type=int, default=5,
+                        help="channel step_size for images")
+
+    parser.add_argument("-b", dest="field_size", type=int, default=512,
+                        help="size of field in pixels sqr (sets the size of the fake images)")
+
+    parser.add_argument("--costs", dest="costs", default=None,
+                        help="json file of per task overrides of the fake costs, e.g.\n"
+                             '{"clean": {"time": 2.0, "memory": 500, "jitter": 0.5, "fail": 0.01}}')
+
+    parser.add_argument("--time-scale", dest="time_scale", type=float, default=1.0,
+                        help="multiplies the time of every fake task")
+
+    parser.add_argument("--output", dest="output", default=None,
+                        help="json file to save the results to")
+
+    parser.add_argument("--baseline", dest="baseline", default=None,
+                        help="json results of an earlier run, exits with 1 if throughput regressed")
+
+    parser.add_argument("--tolerance", dest="tolerance", type=float, default=0.1,
+                        help="fractional drop in channels/sec counted as a regression")
+
+    parser.add_argument("--keep", dest="keep", default=False, action="store_true",
+                        help="keep the benchmark directory")
+
+    args = parser.parse_args()
+    costs = {}
+    if args.costs:
+        with open(args.costs) as f:
+            costs = json.load(f)
+    for name, cost in DEFAULT_COSTS.items():
+        costs[name] = dict(cost, **costs.get(name, {}))
+        costs[name]['time'] *= args.time_scale
+    if args.mpi and not shutil.which('mpiexec'):
+        parser.error('--mpi needs mpiexec on PATH')
+
+    results = benchmark(args.layouts, args.ncores, args.mpi, args.nchan, args.step_size, args.field_size, costs, args.engines, args.keep)
+    print('\n'.join(report(results)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for r in slower:
+            print(f"Regression: {r['script']} {r['engine']} {r['pool']} {r['workers']} at {r['chan_per_sec']:.2f} chan/s")
+        sys.exit(1 if slower else 0)
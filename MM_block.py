@@ -0,0 +1,111 @@
+import os
+import shutil
+
+from MM_run import run_miriad, split_cube
+from MM_scratch import scratch_space, staged, in_scratch, copy_back, image_bytes
+from MM_state import record, remove, tmp_name, commit
+
+# Miriad Multicore block inverts
+# Images a block of contiguous output channels with one miriad invert, so the visibilities are
+# read once per block instead of once per channel, and splits the cubes into the per-channel
+# maps and beams the cleaners expect. Shared by MM_inverter.py, MM_region_invert.py and
+# MM_pipeline.py (--block).
+# The planes are NOT the mfs maps of grid_images: invert cannot make one mfs image per plane, so
+# each plane is the line=chan,N,start,step,step average of its step channels, gridded at the
+# average frequency of the plane instead of at the frequency of every channel. The maps differ
+# from the single channel ones by the bandwidth smearing over the step channels of a plane.
+# WORKS FOR PYTHON 3
+
+BLOCK_NOTE = ('--block: the planes are channel averages (line=chan,N,start,step,step), not the options=mfs '
+              'maps of single channel inverts; they are not identical to a run without --block')
+
+
+def grid_block(args):
+    '''
+    Runs a single miriad invert for a block of contiguous output channels, reading the
+    visibilities once per block, then splits the cubes into the per-channel maps and beams of grid_images
+    (channel averaged planes, see BLOCK_NOTE)
+
+    User Inputs:
+    args = chans, step, source, freq, field, offset, var_strs, state, scratch, trace, memory, placement
+    (only the channels in chans are imaged, one invert per contiguous run of them; offset is (xoff, yoff) in pixels for the region inverts, which also image in double precision,
+    or None for the full field)
+
+    Outputs:
+    dirty maps (.map) for each Stokes parameter and beam images for every channel in chans
+    '''
+    chans, step, source, freq, field, offset, var_strs, state, scratch, trace, memory, placement = args
+
+    #Only image the channels whose maps have not been created yet
+    if state:
+        todo = list(chans)
+    else:
+        todo = [c for c in chans if not os.path.isdir(f'{source}.{freq}.{c:04d}.i.map') and not os.path.isdir(f'{source}.{freq}.{c:04d}.beam')]
+    #Channels already done leave gaps, each contiguous run of the rest is one invert
+    for block in blocks(todo, len(todo), step):
+        _invert_block(block, step, source, freq, field, offset, var_strs, state, scratch, trace, memory, placement)
+
+
+def _invert_block(block, step, source, freq, field, offset, var_strs, state, scratch, trace, memory, placement):
+    '''
+    Inverts one run of contiguous output channels (step apart) as the planes of one cube and splits it
+    '''
+    stokespars = ['i','q','u','v']
+    log_file = 'error_inv.log'
+    outputs = {c: [f'{source}.{freq}.{c:04d}.{a}.map' for a in stokespars] + [f'{source}.{freq}.{c:04d}.beam'] for c in block}
+    for c in block:
+        for out in outputs[c]:
+            remove(tmp_name(out))
+        record(state, 'grid', c, '', 'running')
+    # Cubes and their split planes stay in scratch if used, only the maps are copied back
+    with scratch_space(scratch, image_bytes(field, 16*len(block))) as work:
+        name = f'{source}.{freq}.{block[0]:04d}-{block[-1]:04d}'
+        cubes = [in_scratch(f'{name}.{a}.cube', work) for a in stokespars]
+        beamcube = in_scratch(f'{name}.beamcube', work)
+
+        # Each plane averages the step channels of one output channel (no mfs, see BLOCK_NOTE)
+        chan_str = f'chan,{len(block)},{block[0]},{step},{step}'
+        stokes_str = ','.join(stokespars)
+        region = f' offset={offset[0]},{offset[1]}' if offset else ''
+        options = ' options=double' if offset else ''
+        cmd = f'invert vis={var_strs} map={",".join(cubes)} beam={beamcube}{region} line={chan_str} imsize={field},{field} cell=1,1 robust=+0.6 stokes={stokes_str}{options}'
+        tags = {'stage': 'grid', 'chan': block[0], 'stokes': '', 'block': len(block)}
+        run_miriad(cmd, log_file, True, trace, tags, memory, placement)
+
+        # Split the planes into the usual per-channel names so the cleaners are unchanged
+        if os.path.isdir(beamcube):
+            split_cube(beamcube, [staged(outputs[c][-1], work) for c in block], log_file, trace, tags, memory, placement)
+        for k, cube in enumerate(cubes):
+            if os.path.isdir(cube):
+                split_cube(cube, [staged(outputs[c][k], work) for c in block], log_file, trace, tags, memory, placement)
+        for cube in cubes + [beamcube]:
+            shutil.rmtree(cube, ignore_errors=True)
+        for c in block:
+            if copy_back(outputs[c], work) and commit(outputs[c]):
+                record(state, 'grid', c, '', 'done', outputs[c])
+            else:
+                record(state, 'grid', c, '', 'failed')
+
+
+def blocks(chans, block_size, step):
+    '''
+    Groups the channel list into blocks of at most block_size contiguous channels (step apart),
+    a gap in the list (channels done or screened out) always starting a new block
+    '''
+    groups = []
+    for c in chans:
+        if groups and len(groups[-1]) < block_size and c == groups[-1][-1] + step:
+            groups[-1].append(c)
+        else:
+            groups.append([c])
+    return groups
+
+
+def add_block_arguments(parser):
+    '''
+    Adds the block invert option shared by the inverters, the pipeline and the batch to an argparse parser
+    '''
+    parser.add_argument("--block", dest="block_size", type=int, default=1,
+                        help="output channels imaged per invert run (visibilities are read once per block,\n"
+                             "memory grows with the block size). The planes are channel averages, not the\n"
+                             "mfs maps of single channel inverts")
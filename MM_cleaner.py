@@ -2,161 +2,235 @@ import os
 import subprocess,shlex,shutil
 import sys,getopt
 import glob
+import time
 from multiprocessing import Pool
 import tqdm 
 
+from MM_scheduler import read_runtimes, record_runtime, task_costs
+from MM_state import state_name, stage_outputs, read_states, mark_pending, record, remove, tmp_name, commit, output_size, add_state_arguments
+from MM_scratch import scratch_space, staged, in_scratch, copy_back, scratch_option, add_scratch_arguments
+from MM_run import run_miriad
+from MM_fits import miriad_to_fits
+from MM_cube import CubeWriter, add_cube_arguments
+from MM_manifest import DEFAULT_GLOBS, load_manifest, channel_range, add_manifest_arguments
+from MM_miriad_io import read_header
+from MM_trace import trace_option, add_trace_arguments
+from MM_memory import memory_option, add_memory_arguments
+from MM_placement import placement_option, add_placement_arguments, autotune
+from MM_warmstart import seed_model, warm_chains, add_warm_arguments
+from MM_iterations import adaptive_clean, read_iterations, record_iterations, iteration_option, iteration_report, add_iteration_arguments
+from MM_scheduler import run_chain, imap_tasks
+from MM_async import choose_engine, add_engine_arguments
+from MM_retry import apply_retry, add_retry_arguments
+
 # Miriad Multicore Cleaner
 # Work through making images from .uvaver miriad files
 # J. Livingston 10 Oct 2019
 # Modified from RC polarimetry script from 10 August 2016 and N. McClure-Griffiths 10 Dec 2018
 # WORKS FOR PYTHON 3
 
-def get_noise(source,freq,chan):
+def get_noise(source,freq,chan,method='std',table='noise_table.txt'):
     '''
     Generates noise cutoff from stokes v image to use for cleaning
     
     Auto Inputs:
     args = source,freq,chan
+    method = noise estimator from MM_noise (mad, clip or std)
+    table = noise table caching the noise of each channel ('' to always recompute)
     
     Outputs:
     float that will be used as cutoff for cleaning process
     '''
-    from astropy.io import fits
-    import numpy as np
+    from MM_noise import cached_noise
     noise=-100.0
     stokes='v'
-    maps = f'{source}.{freq}.{chan}.{stokes}.map'
-    log_file = 'error_noise.log'
+    maps = f'{source}.{freq}.{chan:04d}.{stokes}.map'
     if os.path.isdir(maps):
-        fitsfile = f'{maps}.fits'
-        cmd = f'fits in={maps} out={fitsfile} op=xyout '
-        #print(cmd)
-        args=shlex.split(cmd)
-        with open(log_file,'a') as log:
-            p=subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    # Print the output
-        #for line in p.stdout:
-        #    print(line)
-            p.wait()
-    # Open the FITS file
-        hdul = fits.open(fitsfile)
-        data = hdul[0].data
-        noise=np.std(data)/2
+    # Robust noise of the map, reused from the noise table if the map is unchanged
+        noise=cached_noise(maps,source,freq,chan,method,table)/2
         #print(f"RMS = {noise}")
-        os.remove(fitsfile)
     return noise
 
 
+def clean_stokes(args):
+    '''
+    Cleans, restors, primary beam corrects and converts to fits a single stokes map of a channel
+    
+    User Inputs:
+    args = chan, stokes, source, freq, region, nit, cut_noise, runtime_table, state, scratch, trace, memory, placement, warm, iters
+    (scratch is (directory, GB reserve) to keep the intermediates on node-local storage, or None)
+    (trace is the json-lines file timing every miriad task, see MM_trace, None or '' for no trace)
+    (memory is (node budget bytes, memory table) to admit each task only when it fits, or None, see MM_memory)
+    (placement is (OpenMP threads, pin) for the miriad tasks, or None, see MM_placement)
+    (warm is (previous channel's model, previous channel's map, scale) to seed clean and keep the
+     model for the next channel, or None, see MM_warmstart)
+    (iters is (iteration table, round, max iterations) to clean in rounds until the residual peak is
+     below the cutoff instead of nit iterations, or None, see MM_iterations)
+    
+    Outputs:
+    clean fits image for the stokes parameter, returns the time taken in seconds
+    '''
+    chan, stokes, source, freq, region, nit, cut_noise, runtime_table, state, scratch, trace, memory, placement, warm, iters = args
+    start = time.time()
+    # Create names for files
+    mod = f'{source}.{freq}.{chan:04d}.{stokes}.mod'
+    cln = f'{source}.{freq}.{chan:04d}.{stokes}.cln'
+    pbcorr = f'{source}.{freq}.{chan:04d}.{stokes}.pbcorr'
+    maps = f'{source}.{freq}.{chan:04d}.{stokes}.map'
+    beam = f'{source}.{freq}.{chan:04d}.beam'
+    outfile = f'{source}.{freq}.{chan:04d}.{stokes}.cln.fits'
+    log_file = 'error_cln.log'
+    # Check that the map exists before trying
+    if not os.path.isdir(maps) and not os.path.isdir(beam):
+        #print(f"Map {maps} does not exist")
+        return 0.0
+    # Intermediates stay in scratch if used, only the fits image is copied back
+    with scratch_space(scratch, 4*(output_size(maps) or 0)) as work:
+        # A warm started model stays next to the maps to seed the next channel
+        seed = in_scratch(f'{source}.{freq}.{chan:04d}.{stokes}.seed', work)
+        pbcorr, cln = [in_scratch(a, work) for a in [pbcorr, cln]]
+        mod = mod if warm else in_scratch(mod, work)
+        # Clear intermediates left by an interrupted run, miriad will not overwrite them
+        for stale in [mod, seed, pbcorr, cln, tmp_name(outfile)]:
+            remove(stale)
+        record(state, 'clean', chan, stokes, 'running')
+        seed = seed_model(warm, maps, seed) if warm else None
+        model = f' model={seed}' if seed else ''
+        tags = {'stage': 'clean', 'chan': chan, 'stokes': stokes}
+        if iters and cut_noise > 0:
+            # Clean in rounds until the residual peak is below the cutoff, starting from the
+            # iterations the channel needed last time
+            table, round_iters, max_iters = iters
+            first = read_iterations(table).get((source, str(freq), chan, stokes), (round_iters,))[0]
+            run = lambda cmd: run_miriad(cmd, log_file, False, trace, tags, memory, placement)
+            spent, converged = adaptive_clean(run, maps, beam, mod, cut_noise, max(first, 1), round_iters, max_iters, seed, f' region=percentage({region})')
+            record_iterations(table, source, freq, chan, stokes, spent, converged)
+            ret = 0 if os.path.isdir(mod) else 1
+        else:
+            # Run through clean
+            ret = run_miriad(f'clean map={maps} beam={beam}{model} region=percentage({region}) niters={nit} cutoff={cut_noise} out={mod}',
+                             log_file, False, trace, tags, memory, placement)
+        # Restor the images, each task only runs if the one before succeeded
+        if ret == 0:
+            ret = run_miriad(f'restor map={maps} beam={beam} model={mod} out={pbcorr}', log_file, False, trace, tags, memory, placement)
+        # Primary Beam Correction
+        if ret == 0:
+            ret = run_miriad(f'linmos in={pbcorr} out={cln}', log_file, False, trace, tags, memory, placement)
+        # Convert to fits, carrying over the rms that primary beam correction drops
+        if ret == 0:
+            rms = read_header(pbcorr).get('rms') if os.path.isdir(pbcorr) else None
+            ret = miriad_to_fits(cln, staged(outfile, work), None if rms is None else {'rms': rms})
+        # The fits image only appears under its final name once it is complete
+        if ret == 0 and copy_back([outfile], work) and commit([outfile]):
+            record(state, 'clean', chan, stokes, 'done', [outfile])
+        else:
+            record(state, 'clean', chan, stokes, 'failed')
+
+    elapsed = time.time() - start
+    record_runtime(runtime_table, 'clean', source, freq, chan, stokes, elapsed, clean_work(maps, nit))
+    return elapsed
+
+
+def clean_work(maps, nit):
+    '''
+    Static cost estimate of cleaning a map: niters x number of pixels (0 if the map does not exist)
+    '''
+    if not os.path.isdir(maps):
+        return 0
+    header = read_header(maps)
+    return nit * header['naxis1'] * header['naxis2']
+
+
 def clean_images(args):
     '''
-    Takes inputs and runs miriad invert from command line producing dirty maps and beams
+    Takes inputs and runs miriad clean, restor and linmos on every stokes map of a channel, writing fits images
     
     User Inputs:
-    args = chan, source, freq, region, nit
+    args = chan, source, freq, region, nit, noise_method, noise_table, runtime_table, state, scratch, trace, memory, placement
     
     Outputs:
     cleans dirty maps and produces fits images for each stokes parameter
     '''
-    chan, source, freq, region, nit = args
+    chan, source, freq, region, nit, noise_method, noise_table, runtime_table, state, scratch, trace, memory, placement = args
     stokespars = ['i','q','u','v']
-    # Cycle over the channels
 
     # Gets noise for clean cutoff from stokes v
-    cut_noise = get_noise(source,freq,chan)
+    cut_noise = get_noise(source,freq,chan,noise_method,noise_table)
 
-    # Create names for files
     for stokes in stokespars:
-        mod = f'{source}.{freq}.{chan:04d}.{stokes}.mod'
-        cln = f'{source}.{freq}.{chan:04d}.{stokes}.cln'
-        pbcorr = f'{source}.{freq}.{chan:04d}.{stokes}.pbcorr'
-        maps = f'{source}.{freq}.{chan:04d}.{stokes}.map'
-        beam = f'{source}.{freq}.{chan:04d}.beam'
-        rms = f'{source}.{freq}.{chan:04d}.{stokes}.rms'
-        outfile = f'{source}.{freq}.{chan:04d}.{stokes}.cln.fits'
-        log_file = 'error_cln.log'
-    # Check that the map exists before trying
-        if not os.path.isdir(maps) and not os.path.isdir(beam):
-            #print(f"Map {maps} does not exist")
-            pass
-        else:
-    # Run through clean
-            cmd = f'clean map={maps} beam={beam} region=percentage({region}) niters={nit} cutoff={cut_noise} out={mod}'
-            #print(cmd)
-            args=shlex.split(cmd)  # Splits the cmd into a string for subprocess
-            with open(log_file,'a') as log:
-                p=subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    # Print the output
-            #for line in p.stdout:
-            #     print(line)
-                p.wait()
-     # Restor the images
-            cmd = f'restor map={maps} beam={beam} model={mod} out={pbcorr}'
-            #print(cmd)
-            args=shlex.split(cmd)
-            with open(log_file,'a') as log:
-                p=subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-#         #Print the output
-            #for line in p.stdout:
-                # print(line)
-                p.wait()
-
-#         # Primary Beam Correction
-            cmd = f'linmos in={pbcorr} out={cln}'
-            #print(cmd)
-            args=shlex.split(cmd)
-            with open(log_file,'a') as log:
-                p=subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-#         #Print the output
-            #for line in p.stdout:
-            #      print(line)
-                p.wait()
-
-#         # Copy missing RMS after primary beam correction
-            cmd = f'gethd in={pbcorr}/rms log={rms}'
-            #print(cmd)
-            args=shlex.split(cmd)
-            with open(log_file,'a') as log:
-                p=subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-#         #Print the output
-            #for line in p.stdout:
-            #      print(line)
-                p.wait()
-
-#         # Paste missing RMS onto primary beam correction
-            cmd = f'puthd in={cln}/rms value=@{rms}'
-            #print(cmd)
-            args=shlex.split(cmd)
-            with open(log_file,'a') as log:
-                p=subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-#         #Print the output
-            #for line in p.stdout:
-            #      print(line)
-                p.wait()
-
-#         #convert to fits
-            cmd =f'fits in={cln} out={outfile} op=xyout'
-            #print(cmd)
-            args=shlex.split(cmd)  # Splits the cmd into a string for subprocess
-            with open(log_file,'a') as log:
-                p=subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=log)
-      # Print the output
-            #for line in p.stdout:
-            #      print(line)
-                p.wait()
-
+        clean_stokes([chan, stokes, source, freq, region, nit, cut_noise, runtime_table, state, scratch, trace, memory, placement, None, None])
     return
 
 
+def channel_noise(args):
+    '''
+    Pool wrapper for get_noise, args = chan, source, freq, noise_method, noise_table
+    '''
+    chan, source, freq, noise_method, noise_table = args
+    return get_noise(source,freq,chan,noise_method,noise_table)
+
 
 def main(pool, args):
 
-    inputs = [[i, args.source, args.freq, args.region, args.n_iters] for i in range(args.start_chan, args.end_chan, args.step_size)]
-
-    #Runs each chunk of freq on new processor
+    # The final channel is taken from the visibility manifest when -2 is not given
+    manifest = load_manifest(args.source, args.freq, args.vis_globs or DEFAULT_GLOBS['multicore'], args.manifest, args.rescan)
+    chans = list(channel_range(manifest, args.start_chan, args.end_chan, args.step_size))
+    stokespars = ['i','q','u','v']
+    imap = getattr(pool, 'imap', pool.map)
+
+    # Noise cutoff is computed once per channel and shared by its stokes tasks
+    print('Measuring Noise')
+    noise_inputs = [[i, args.source, args.freq, args.noise_method, args.noise_table] for i in chans]
+    cut_noise = dict(zip(chans, tqdm.tqdm(imap(channel_noise, noise_inputs),total=len(chans))))
+
+    # Resume from the state journal: cleans whose fits images were finished and are unchanged are skipped,
+    # unless their maps were gridded again since (images made before the journal count as finished)
+    state = state_name(args.source, args.freq) if args.state is None else args.state
+    todo = [('clean', i, stokes) for i in chans for stokes in stokespars]
+    if state:
+        todo = mark_pending(state, read_states(state), todo, stage_outputs(args.source, args.freq))
+
+    # One task per channel and stokes, most expensive first so the longest cleans are not left to the end
+    keys = [('clean', args.source, str(args.freq), i, stokes) for _, i, stokes in todo]
+    work = {key: clean_work(f'{args.source}.{args.freq}.{key[3]:04d}.{key[4]}.map', args.n_iters) for key in keys}
+    costs = task_costs(keys, work, read_runtimes(args.runtime_table))
+    keys.sort(key=lambda key: costs[key], reverse=True)
+    options = [args.runtime_table, state, scratch_option(args), trace_option(args), memory_option(args), placement_option(args)]
+    iters = iteration_option(args)
+    def clean_inputs(chan, stokes, warm=None):
+        return [chan, stokes, args.source, args.freq, args.region, args.n_iters, cut_noise[chan]] + options + [warm, iters]
+
+    if args.warm_start:
+        # Chains of consecutive channels run in one worker, each clean seeded by the one before
+        name = lambda chan, stokes, ext: f'{args.source}.{args.freq}.{chan:04d}.{stokes}.{ext}'
+        chains = warm_chains([(key[3], key[4]) for key in keys], chans, args.warm_chain)
+        chains.sort(key=lambda chain: sum(costs[('clean', args.source, str(args.freq), chan, stokes)] for chan, stokes, _ in chain), reverse=True)
+        inputs = [[(clean_stokes, clean_inputs(chan, stokes, (name(prev, stokes, 'mod') if prev else None, name(prev, stokes, 'map') if prev else None, args.warm_scale)))
+                   for chan, stokes, prev in chain] for chain in chains]
+        planes = [[(chan, stokes) for chan, stokes, _ in chain] for chain in chains]
+        task = run_chain
+    else:
+        inputs = [clean_inputs(key[3], key[4]) for key in keys]
+        planes = [[(key[3], key[4])] for key in keys]
+        task = clean_stokes
+
+    # Clean images are written into the stokes cubes as their tasks finish
+    cubes = CubeWriter(args.source, args.freq, chans, args.step_size, stokespars, args.cube_compress, args.manifest) if args.cube else None
+
+    #Runs each channel and stokes (or chain of channels) on new processor
     print('Cleaning Images')
-    for _ in tqdm.tqdm(pool.imap(clean_images, inputs),total=len(inputs)):
-        pass
+    # Warm started chains keep their models next to the maps, so only single cleans are speculated
+    speculate = None if args.warm_start else args.speculate
+    for cleaned, _ in tqdm.tqdm(zip(planes, imap_tasks(pool, task, inputs, speculate)),total=len(inputs)):
+        for chan, stokes in cleaned if cubes else []:
+            cubes.add(chan, stokes)
     pool.close()
+    if cubes:
+        print('Cubes: ' + ' '.join(cubes.close()))
+
+    if iters:
+        print('Clean iterations per channel')
+        print('\n'.join(iteration_report(args.iter_table, args.source, args.freq, chans, args.n_iters)))
 
 
 if __name__ == "__main__":
@@ -182,8 +256,8 @@ if __name__ == "__main__":
     parser.add_argument("-1", dest="start_chan", type=int, default=1,
                         help="starting channel number")
 
-    parser.add_argument("-2", dest="end_chan", type=int, default=1500,
-                        help="final channel number")
+    parser.add_argument("-2", dest="end_chan", type=int, default=None,
+                        help="final channel number (default from the visibility manifest)")
 
     parser.add_argument("-d", dest="step_size", type=int, default=5,
                         help="channel step_size for images")
@@ -194,7 +268,38 @@ if __name__ == "__main__":
     parser.add_argument("-r", dest="region", type=float, default=95,
                         help="region (percentage) to clean as percentage of image")
 
+    parser.add_argument("--noise", dest="noise_method", default="std", choices=['mad','clip','std'],
+                        help="estimator for the stokes v noise used as clean cutoff")
+
+    parser.add_argument("--noise-table", dest="noise_table", default="noise_table.txt",
+                        help="table caching per-channel noise between runs ('' to disable)")
+
+    add_state_arguments(parser)
+
+    add_scratch_arguments(parser)
+
+    add_trace_arguments(parser)
+
+    add_memory_arguments(parser)
+
+    add_placement_arguments(parser)
+
+    add_warm_arguments(parser)
+
+    add_iteration_arguments(parser)
+
+    add_cube_arguments(parser)
+
+    add_manifest_arguments(parser, DEFAULT_GLOBS['multicore'])
+
+    parser.add_argument("--runtime-table", dest="runtime_table", default="runtime_table.txt",
+                        help="table of past clean runtimes used to start the slowest cleans first ('' to disable)")
+
+
+
+    add_retry_arguments(parser)
 
+    add_engine_arguments(parser)
 
     group = parser.add_mutually_exclusive_group()
 
@@ -205,7 +310,18 @@ if __name__ == "__main__":
 
 
     args = parser.parse_args()
-    pool = schwimmbad.choose_pool(mpi=args.mpi, processes=args.n_cores)
+    if args.engine == 'asyncio' and args.mpi:
+        parser.error('--engine asyncio runs on one node, it cannot be combined with --mpi')
+    if args.autotune and args.mpi:
+        parser.error('--autotune sizes a single node run, it cannot be combined with --mpi')
+    if args.autotune and args.state == '':
+        parser.error("--autotune needs the state journal to skip its trial channels in the run, it cannot be combined with --state ''")
+    # Timeouts and retries of the miriad tasks, inherited by the workers
+    apply_retry(args)
+    if args.autotune:
+        # The first channels still to do are run with each processes x threads split, the rest with the fastest
+        args.n_cores, args.threads = autotune(main, args, 'clean', 'multicore')
+    pool = choose_engine(args)
     #pool = schwimmbad.SerialPool()
 
     if args.mpi:
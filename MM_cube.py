@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import numpy as np
+
+from MM_miriad_io import read_header, image_shape
+from MM_fits import fits_header, create_fits, read_fits, compress_fits
+from MM_manifest import DEFAULT_GLOBS, manifest_name, load_manifest, channel_range, add_manifest_arguments
+
+# Miriad Multicore cube assembly
+# Builds one fits cube per stokes ({source}.{freq}.{stokes}.cube.fits) from the per-channel
+# .cln.fits images. Each cube is pre-allocated on disk with a spectral axis worked out from the
+# channel numbers and step size (frequencies from the visibility manifest when it is there),
+# and every plane is written through a memory map as soon as its clean finishes, so only one
+# plane is in memory at a time. Channels without an image are NaN. The cubes can be tile
+# compressed (.cube.fits.fz) once complete.
+# WORKS FOR PYTHON 3
+
+# Header items of a single channel that do not describe the cube
+CHANNEL_ITEMS = ('bmaj', 'bmin', 'bpa', 'rms', 'niters', 'datamin', 'datamax')
+
+
+def cube_name(source, freq, stokes):
+    return f'{source}.{freq}.{stokes}.cube.fits'
+
+
+def spectral_axis(source, freq, chans, step, manifest=None):
+    '''
+    Spectral axis of the cube in miriad units: (ctype, crval, crpix, cdelt)
+
+    Planes are the output channels chans[0], chans[0]+step, ..., each averaging step channels.
+    With the frequency axis of the manifest the axis is FREQ (GHz) at the centre of each plane,
+    otherwise it counts channel numbers. manifest is the manifest file when it is not
+    {source}.{freq}.manifest.json (the targets of MM_batch.py share the manifest of their field).
+    '''
+    path = manifest or manifest_name(source, freq)
+    sfreq = sdf = None
+    if os.path.isfile(path):
+        with open(path) as f:
+            datasets = json.load(f).get('datasets', [])
+        described = [entry for entry in datasets if entry.get('sfreq') and entry.get('sdf')]
+        if described:
+            sfreq, sdf = described[0]['sfreq'][0], described[0]['sdf'][0]
+    if sfreq is None:
+        return 'CHANNEL', float(chans[0]), 1.0, float(step)
+    return 'FREQ', sfreq + (chans[0] - 1 + (step - 1) / 2) * sdf, 1.0, step * sdf
+
+
+class CubeWriter:
+    '''
+    Streams the clean images of a run into one pre-allocated fits cube per stokes
+
+    Inputs:
+    source, freq = names of the images
+    chans = output channels of the run, one plane each (a regular range of step)
+    step = channel step size
+    stokespars = stokes parameters to build cubes for
+    compress = tile compress the cubes when they are finished
+    manifest = visibility manifest file for the frequency axis (default {source}.{freq}.manifest.json)
+    '''
+
+    def __init__(self, source, freq, chans, step, stokespars, compress=False, manifest=None):
+        self.source, self.freq, self.step, self.compress = source, freq, step, compress
+        self.chans = list(chans)
+        self.index = {chan: k for k, chan in enumerate(self.chans)}
+        self.stokespars = list(stokespars)
+        self.cubes, self.written = {}, {}
+        self.axis = spectral_axis(source, freq, self.chans, step, manifest)
+
+    def _open(self, stokes):
+        '''
+        Pre-allocates the cube of a stokes parameter, sized from the first dirty map there is
+        (in the pipeline the maps only appear as the channels are gridded)
+        '''
+        if stokes in self.cubes:
+            return self.cubes[stokes]
+        maps = [self._name(chan, stokes, 'map') for chan in self.chans]
+        template = next((m for m in maps if os.path.isdir(m)), None)
+        if template is None:
+            return None
+        ctype, crval, crpix, cdelt = self.axis
+        header = {key: value for key, value in read_header(template).items() if key not in CHANNEL_ITEMS}
+        header.update({'ctype3': ctype, 'crval3': crval, 'crpix3': crpix, 'cdelt3': cdelt})
+        shape = (len(self.chans),) + image_shape(header)[-2:]
+        path = cube_name(self.source, self.freq, stokes)
+        create_fits(path, fits_header(header, shape), shape)
+        self.cubes[stokes] = read_fits(path, 'r+')[1]
+        self.written[stokes] = set()
+        return self.cubes[stokes]
+
+    def _name(self, chan, stokes, ext):
+        return f'{self.source}.{self.freq}.{chan:04d}.{stokes}.{ext}'
+
+    def add(self, chan, stokes):
+        '''
+        Writes the clean image of a channel into its plane (NaN if there is no image)
+        '''
+        cube = self._open(stokes) if chan in self.index else None
+        if cube is None:
+            return
+        plane = np.nan
+        image = self._name(chan, stokes, 'cln.fits')
+        if os.path.isfile(image):
+            try:
+                data = read_fits(image)[1]
+                plane = data.reshape(data.shape[-2:])
+                if plane.shape != cube.shape[1:]:
+                    print(f'{image} is {plane.shape}, not the cube plane size {cube.shape[1:]}')
+                    plane = np.nan
+            except (OSError, ValueError, KeyError) as err:
+                print(f'Could not read {image}: {err}')
+        cube[self.index[chan]] = plane
+        self.written[stokes].add(chan)
+
+    def close(self):
+        '''
+        Fills the planes not written yet (channels cleaned in an earlier run, or NaN), and tile
+        compresses the cubes if asked
+
+        Outputs:
+        list of the cube files
+        '''
+        paths = []
+        for stokes in self.stokespars:
+            cube = self._open(stokes)
+            if cube is None:
+                print(f'No {stokes} maps to size the cube, it is not built')
+                continue
+            for chan in self.chans:
+                if chan not in self.written[stokes]:
+                    self.add(chan, stokes)
+            cube.flush()
+            path = cube_name(self.source, self.freq, stokes)
+            if self.compress:
+                compress_fits(path, f'{path}.fz')
+                os.remove(path)
+                path = f'{path}.fz'
+            paths.append(path)
+        self.cubes = {}
+        return paths
+
+
+def add_cube_arguments(parser):
+    '''
+    Adds the cube assembly options shared by the cleaners and the pipeline to an argparse parser
+    '''
+    parser.add_argument("--cube", dest="cube", default=False, action="store_true",
+                        help="write each clean image into a {source}.{freq}.{stokes}.cube.fits cube as it finishes")
+
+    parser.add_argument("--cube-compress", dest="cube_compress", default=False, action="store_true",
+                        help="tile compress the finished cubes (.cube.fits.fz)")
+
+
+if __name__ == "__main__":
+    import argparse
+    import tqdm
+
+    # Help string to be shown using the -h option
+    descStr = """
+    Assembles the .cln.fits images of a run into one fits cube per stokes parameter
+    """
+
+    parser = argparse.ArgumentParser(description=descStr,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-s", dest="source",
+                        type=str, help="Source name in RA-DEC convention from miriad")
+
+    parser.add_argument("-f", dest="freq", type=int, default=2100,
+                        help="centre frequency in MHz")
+
+    parser.add_argument("-1", dest="start_chan", type=int, default=1,
+                        help="starting channel number")
+
+    parser.add_argument("-2", dest="end_chan", type=int, default=None,
+                        help="final channel number (default from the visibility manifest)")
+
+    parser.add_argument("-d", dest="step_size", type=int, default=5,
+                        help="channel step_size for images")
+
+    parser.add_argument("--stokes", dest="stokes", default="iquv",
+                        help="stokes parameters to build cubes for")
+
+    parser.add_argument("--cube-compress", dest="cube_compress", default=False, action="store_true",
+                        help="tile compress the cubes (.cube.fits.fz)")
+
+    add_manifest_arguments(parser, DEFAULT_GLOBS['multicore'])
+
+    args = parser.parse_args()
+    # The final channel is taken from the visibility manifest when -2 is not given
+    manifest = load_manifest(args.source, args.freq, args.vis_globs or DEFAULT_GLOBS['multicore'], args.manifest, args.rescan)
+    chans = channel_range(manifest, args.start_chan, args.end_chan, args.step_size)
+    writer = CubeWriter(args.source, args.freq, chans, args.step_size, list(args.stokes), args.cube_compress, args.manifest)
+    for chan in tqdm.tqdm(chans):
+        for stokes in writer.stokespars:
+            writer.add(chan, stokes)
+    cubes = writer.close()
+    if not cubes:
+        sys.exit(1)
+    print('\n'.join(cubes))
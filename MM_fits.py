@@ -0,0 +1,299 @@
+import os
+import datetime
+import numpy as np
+
+from MM_miriad_io import read_header, read_image
+
+# Miriad Multicore fits writer
+# Writes a miriad image as a fits file with numpy, as miriad fits op=xyout does: the WCS and
+# beam are converted to fits units (radians -> degrees, GHz -> Hz, km/s -> m/s), flagged pixels
+# become NaN, and header items such as rms are carried over. The cleaners use it instead of
+# running gethd, puthd and fits for every channel and stokes.
+# WORKS FOR PYTHON 3
+
+FITS_BLOCK = 2880
+CARD = 80
+# Header keywords describing the array itself rather than the sky
+STRUCTURE_KEYS = ('SIMPLE', 'BITPIX', 'NAXIS', 'EXTEND', 'DATAMIN', 'DATAMAX')
+
+# Axis types whose miriad values are in radians
+ANGLE_TYPES = ('RA', 'DEC', 'GLON', 'GLAT', 'ELON', 'ELAT')
+# Scale from the miriad to the fits unit of an axis, by the start of its ctype
+AXIS_SCALE = {'FREQ': 1e9, 'VELO': 1e3, 'FELO': 1e3, 'VRAD': 1e3, 'VOPT': 1e3}
+# Miriad header items copied to fits keywords, with their scale
+HEADER_ITEMS = [('bunit', 'BUNIT', None), ('btype', 'BTYPE', None), ('object', 'OBJECT', None),
+                ('telescop', 'TELESCOP', None), ('observer', 'OBSERVER', None),
+                ('epoch', 'EQUINOX', None), ('restfreq', 'RESTFREQ', 1e9), ('vobs', 'VOBS', 1e3),
+                ('bmaj', 'BMAJ', np.degrees(1.0)), ('bmin', 'BMIN', np.degrees(1.0)), ('bpa', 'BPA', None),
+                ('rms', 'RMS', None), ('niters', 'NITERS', None), ('pbtype', 'PBTYPE', None)]
+
+
+def fits_card(key, value, comment=''):
+    '''
+    One 80 character fits header card, value in the fixed format
+    '''
+    if isinstance(value, (bool, np.bool_)):
+        text = f'{"T" if value else "F":>20}'
+    elif isinstance(value, (int, np.integer)):
+        text = f'{int(value):>20d}'
+    elif isinstance(value, (float, np.floating)):
+        text = repr(float(value)).upper()
+        text = f'{text if len(text) <= 20 else f"{value:.13E}":>20}'
+    else:
+        text = "'" + str(value).replace("'", "''").ljust(8) + "'"
+    card = f'{key:<8}= {text}'
+    if comment:
+        card += f' / {comment}'
+    return card[:CARD].ljust(CARD)
+
+
+def _scale(ctype):
+    if ctype.split('-')[0] in ANGLE_TYPES:
+        return np.degrees(1.0)
+    return AXIS_SCALE.get(ctype[:4], 1.0)
+
+
+def fits_header(header, shape, extra=None, data_range=None):
+    '''
+    Fits header cards of a miriad image
+
+    Inputs:
+    header = miriad header dict (from read_header)
+    shape = numpy shape of the pixels, slowest axis first
+    extra = further miriad items to write (e.g. {'rms': 0.001}), overriding the header
+    data_range = (min, max) of the pixels for DATAMIN/DATAMAX, or None
+
+    Outputs:
+    list of cards, END included
+    '''
+    header = dict(header, **(extra or {}))
+    cards = [fits_card('SIMPLE', True), fits_card('BITPIX', -32), fits_card('NAXIS', len(shape))]
+    cards += [fits_card(f'NAXIS{n+1}', size) for n, size in enumerate(shape[::-1])]
+    for n in range(1, len(shape) + 1):
+        ctype = header.get(f'ctype{n}')
+        scale = _scale(ctype) if ctype else 1.0
+        if ctype:
+            cards.append(fits_card(f'CTYPE{n}', ctype))
+        if f'crval{n}' in header:
+            cards.append(fits_card(f'CRVAL{n}', float(header[f'crval{n}']) * scale))
+        if f'cdelt{n}' in header:
+            cards.append(fits_card(f'CDELT{n}', float(header[f'cdelt{n}']) * scale))
+        if f'crpix{n}' in header:
+            cards.append(fits_card(f'CRPIX{n}', float(header[f'crpix{n}'])))
+    if header.get('llrot'):
+        cards.append(fits_card('CROTA2', np.degrees(float(header['llrot']))))
+    for item, key, scale in HEADER_ITEMS:
+        value = header.get(item)
+        if value is None:
+            continue
+        if scale is not None:
+            value = float(value) * scale
+        if isinstance(value, float) and not np.isfinite(value):
+            continue
+        cards.append(fits_card(key, value))
+    if 'obstime' in header:
+        # miriad obstime is a julian date
+        when = datetime.datetime(1970, 1, 1) + datetime.timedelta(days=float(header['obstime']) - 2440587.5)
+        cards.append(fits_card('DATE-OBS', when.strftime('%Y-%m-%dT%H:%M:%S.%f')[:22]))
+    if data_range is not None and np.isfinite(data_range).all():
+        cards += [fits_card('DATAMIN', float(data_range[0])), fits_card('DATAMAX', float(data_range[1]))]
+    cards.append(fits_card('ORIGIN', 'Miriad Multicore'))
+    cards.append('END'.ljust(CARD))
+    return cards
+
+
+def write_fits(path, data, header=None, extra=None):
+    '''
+    Writes a float32 fits image
+
+    Inputs:
+    path = fits file to write
+    data = numpy array of pixels, slowest axis first (e.g. a read_image memmap, written as it is read)
+    header = miriad header dict for the WCS and header items (None for a bare image)
+    extra = further miriad items to write, e.g. {'rms': 0.001}
+    '''
+    data_range = (np.nanmin(data), np.nanmax(data)) if data.size and not np.isnan(data).all() else None
+    cards = fits_header(header or {}, data.shape, extra, data_range)
+    raw = ''.join(cards).encode('ascii')
+    with open(path, 'wb') as f:
+        f.write(raw.ljust(-(-len(raw) // FITS_BLOCK) * FITS_BLOCK, b' '))
+        pixels = data.reshape((-1,) + data.shape[-2:]) if data.ndim > 2 else data[np.newaxis]
+        for plane in pixels:
+            f.write(np.ascontiguousarray(plane, dtype='>f4').tobytes())
+        size = data.size * 4
+        f.write(b'\0' * (-size % FITS_BLOCK))
+
+
+def miriad_to_fits(image, out, extra=None):
+    '''
+    Converts a miriad image to fits (fits op=xyout), flagged pixels written as NaN
+
+    Inputs:
+    image = miriad image directory
+    out = fits file to write
+    extra = miriad items to add to the fits header, e.g. {'rms': rms of another image}
+
+    Outputs:
+    0 on success, 1 (with the error printed) if the image could not be read or written,
+    as an exit code like the miriad task
+    '''
+    try:
+        write_fits(out, read_image(image), read_header(image), extra)
+    except (OSError, ValueError, KeyError) as err:
+        print(f'Could not write {out} from {image}: {err}')
+        if os.path.isfile(out):
+            os.remove(out)
+        return 1
+    return 0
+
+
+def parse_card(card):
+    '''
+    Keyword and python value of a fits header card (None for cards without a value)
+    '''
+    key = card[:8].strip()
+    if card[8:10] != '= ':
+        return key, None
+    text = card[10:].strip()
+    if text.startswith("'"):
+        end = text.find("'", 1)
+        while end != -1 and text[end + 1:end + 2] == "'":
+            end = text.find("'", end + 2)
+        return key, text[1:end].replace("''", "'").rstrip()
+    text = text.split('/', 1)[0].strip()
+    if text in ('T', 'F'):
+        return key, text == 'T'
+    try:
+        return key, int(text)
+    except ValueError:
+        try:
+            return key, float(text.replace('D', 'E'))
+        except ValueError:
+            return key, text
+
+
+def read_fits(path, mode='r'):
+    '''
+    Memory maps the primary image of a fits file
+
+    Inputs:
+    path = fits file
+    mode = numpy memmap mode, 'r+' to write pixels in place
+
+    Outputs:
+    dict of header keyword -> value and the pixels (big endian memmap, slowest axis first)
+    '''
+    header, offset = {}, 0
+    with open(path, 'rb') as f:
+        while 'END' not in header:
+            block = f.read(FITS_BLOCK)
+            if len(block) < FITS_BLOCK:
+                raise ValueError(f'{path} has no END card')
+            offset += FITS_BLOCK
+            for i in range(0, FITS_BLOCK, CARD):
+                key, value = parse_card(block[i:i + CARD].decode('ascii', 'replace'))
+                if key == 'END':
+                    header['END'] = None
+                    break
+                if key and value is not None:
+                    header[key] = value
+    del header['END']
+    dtypes = {-32: '>f4', -64: '>f8', 8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8'}
+    shape = tuple(header[f'NAXIS{n}'] for n in range(header['NAXIS'], 0, -1))
+    data = np.memmap(path, dtype=dtypes[header['BITPIX']], mode=mode, offset=offset, shape=shape)
+    return header, data
+
+
+def derived_cards(header, shape, changes=None):
+    '''
+    Header cards of a new float32 image derived from a fits header, e.g. a map made from a cube
+
+    Inputs:
+    header = fits header dict (from read_fits)
+    shape = numpy shape of the new pixels, slowest axis first
+    changes = keywords to set, or to drop with a value of None (e.g. {'CTYPE3': None})
+
+    Outputs:
+    list of cards, END included; keywords of axes the new image does not have are dropped
+    '''
+    header = dict(header, **(changes or {}))
+    cards = [fits_card('SIMPLE', True), fits_card('BITPIX', -32), fits_card('NAXIS', len(shape))]
+    cards += [fits_card(f'NAXIS{n+1}', size) for n, size in enumerate(shape[::-1])]
+    for key, value in header.items():
+        axis = key.rstrip('0123456789')
+        if value is None or key.startswith(STRUCTURE_KEYS):
+            continue
+        if axis != key and axis in ('CTYPE', 'CRVAL', 'CDELT', 'CRPIX', 'CUNIT') and int(key[len(axis):]) > len(shape):
+            continue
+        cards.append(fits_card(key, value))
+    return cards + ['END'.ljust(CARD)]
+
+
+def create_fits(path, cards, shape):
+    '''
+    Pre-allocates a float32 fits image on disk (sparse, pixels read as 0 until written)
+
+    Inputs:
+    path = fits file to create
+    cards = header cards from fits_header, END included
+    shape = numpy shape of the pixels, slowest axis first
+    '''
+    raw = ''.join(cards).encode('ascii')
+    raw = raw.ljust(-(-len(raw) // FITS_BLOCK) * FITS_BLOCK, b' ')
+    size = int(np.prod(shape)) * 4
+    with open(path, 'wb') as f:
+        f.write(raw)
+        f.truncate(len(raw) + size + (-size % FITS_BLOCK))
+
+
+
+
+def compress_fits(src, dst, level=6):
+    '''
+    Tile compresses a float32 fits image (GZIP_1 on each plane, lossless), as fpack does
+
+    Inputs:
+    src = uncompressed fits image
+    dst = compressed fits file to write (conventionally .fits.fz)
+    level = gzip compression level
+
+    Only one plane is held in memory at a time: the tiles are written as they are compressed and
+    the header and tile table filled in afterwards.
+    '''
+    import gzip
+    header, data = read_fits(src)
+    planes = data.reshape((-1,) + data.shape[-2:]) if data.ndim > 2 else data[np.newaxis]
+    ntiles = len(planes)
+
+    def cards(heap, longest):
+        hdu = [fits_card('XTENSION', 'BINTABLE'), fits_card('BITPIX', 8), fits_card('NAXIS', 2),
+               fits_card('NAXIS1', 8), fits_card('NAXIS2', ntiles), fits_card('PCOUNT', heap),
+               fits_card('GCOUNT', 1), fits_card('TFIELDS', 1), fits_card('TTYPE1', 'COMPRESSED_DATA'),
+               fits_card('TFORM1', f'1PB({longest})'), fits_card('ZIMAGE', True),
+               fits_card('ZBITPIX', -32), fits_card('ZNAXIS', data.ndim)]
+        hdu += [fits_card(f'ZNAXIS{n+1}', size) for n, size in enumerate(data.shape[::-1])]
+        hdu += [fits_card(f'ZTILE{n+1}', size if n < 2 else 1) for n, size in enumerate(data.shape[::-1])]
+        hdu += [fits_card('ZCMPTYPE', 'GZIP_1'), fits_card('ZQUANTIZ', 'NONE')]
+        hdu += [fits_card(key, value) for key, value in header.items()
+                if not key.startswith(STRUCTURE_KEYS)]
+        return ''.join(hdu + ['END'.ljust(CARD)]).encode('ascii')
+
+    primary = ''.join([fits_card('SIMPLE', True), fits_card('BITPIX', 8), fits_card('NAXIS', 0),
+                       fits_card('EXTEND', True), 'END'.ljust(CARD)]).encode('ascii')
+    primary = primary.ljust(FITS_BLOCK, b' ')
+    # The header has the same number of cards whatever the heap size, so its length is known now
+    head_len = -(-len(cards(0, 0)) // FITS_BLOCK) * FITS_BLOCK
+    table = np.zeros((ntiles, 2), dtype='>i4')
+    heap = 0
+    with open(dst, 'wb') as f:
+        f.seek(len(primary) + head_len + table.nbytes)
+        for k, plane in enumerate(planes):
+            tile = gzip.compress(np.ascontiguousarray(plane, dtype='>f4').tobytes(), level, mtime=0)
+            table[k] = len(tile), heap
+            f.write(tile)
+            heap += len(tile)
+        f.write(b'\0' * (-(table.nbytes + heap) % FITS_BLOCK))
+        f.seek(0)
+        f.write(primary)
+        f.write(cards(heap, int(table[:, 0].max()) if ntiles else 0).ljust(head_len, b' '))
+        f.write(table.tobytes())
@@ -0,0 +1,185 @@
+import os
+import sys
+import numpy as np
+
+from MM_miriad_io import ITEM_HDR_SIZE, unpack_mask
+
+# Miriad Multicore channel pre-screen
+# Reads the flags item of the uvaver datasets straight into numpy (no miriad task) and works out
+# the unflagged fraction of every channel, so channels that are (almost) entirely flagged are
+# dropped from the task list before invert instead of going through invert and four stokes
+# cleans to give empty maps. With --flag-merge a channel below the threshold is instead imaged
+# together with the kept channel before it (a wider line= selection).
+# The per-channel statistics are written to {source}.{freq}.flags.txt.
+# WORKS FOR PYTHON 3
+
+
+def flags_name(source, freq):
+    return f'{source}.{freq}.flags.txt'
+
+
+def channel_flags(path, nchan, chunk_words=1 << 20):
+    '''
+    Counts the unflagged records of every channel of a uv dataset
+
+    Inputs:
+    path = miriad uv dataset directory
+    nchan = channels per record
+    chunk_words = mask words read at a time (31 flags each)
+
+    Outputs:
+    int array of unflagged counts per channel and the number of records. A dataset without a
+    flags item has every record unflagged, the record count is then None. (The last word is padded
+    out to 31 bits, which only adds a flagged record when nchan < 31.)
+    '''
+    item = os.path.join(path, 'flags')
+    if not os.path.isfile(item) or os.path.getsize(item) <= ITEM_HDR_SIZE:
+        return np.ones(nchan, dtype=np.int64), None
+    words = np.memmap(item, dtype='>u4', mode='r', offset=ITEM_HDR_SIZE)
+    good, nrec, carry = np.zeros(nchan, dtype=np.int64), 0, np.zeros(0, dtype=bool)
+    # Chunks are cut at word boundaries, the bits of a record split between chunks are carried over
+    for start in range(0, len(words), chunk_words):
+        bits = np.concatenate([carry, unpack_mask(words[start:start + chunk_words])])
+        n = len(bits) // nchan
+        good += bits[:n * nchan].reshape(n, nchan).sum(axis=0)
+        nrec += n
+        carry = bits[n * nchan:]
+    return good, nrec
+
+
+def unflagged_fraction(manifest):
+    '''
+    Unflagged fraction of every channel over all the datasets of a manifest (index 0 is channel 1),
+    each dataset weighted by its size
+    '''
+    nchan = manifest.get('nchan')
+    if not nchan:
+        return None
+    good, total = np.zeros(nchan), 0.0
+    for entry in manifest['datasets']:
+        counts, nrec = channel_flags(entry['path'], entry['nchan'] or nchan)
+        weight = entry['size'] or 1
+        # No flags item: every record of the dataset is unflagged
+        good += weight * (counts[:nchan] / nrec if nrec else (counts[:nchan] > 0))
+        total += weight
+    return good / total if total else np.ones(nchan)
+
+
+def screen_channels(fraction, chans, step, threshold, merge=False):
+    '''
+    Picks the channels to image from their unflagged fraction
+
+    Inputs:
+    fraction = unflagged fraction per input channel (from unflagged_fraction)
+    chans = output channels, each averaging step input channels from chan
+    threshold = minimum unflagged fraction; entirely flagged channels are always dropped
+    merge = image a channel below the threshold with the kept channel before it instead of
+            dropping it (only partly flagged channels, entirely flagged ones add nothing)
+
+    Outputs:
+    kept channels, miriad line selections of the kept channels that absorbed merged ones
+    ({chan: line}), and {chan: (fraction, status)} for the statistics
+    '''
+    kept, lines, stats, width = [], {}, {}, {}
+    for chan in chans:
+        frac = float(np.mean(fraction[chan - 1:chan - 1 + step])) if chan - 1 < len(fraction) else 0.0
+        if frac > 0 and frac >= threshold:
+            kept.append(chan)
+            width[chan] = step
+            stats[chan] = (frac, 'kept')
+        elif merge and frac > 0 and kept and kept[-1] + width[kept[-1]] == chan:
+            width[kept[-1]] += step
+            lines[kept[-1]] = f'chan,{width[kept[-1]]},{kept[-1]}'
+            stats[chan] = (frac, f'merged:{kept[-1]}')
+        else:
+            stats[chan] = (frac, 'dropped')
+    return kept, lines, stats
+
+
+def write_flag_stats(path, stats):
+    '''
+    Writes the per-channel flag statistics: channel, unflagged fraction, kept/dropped/merged:chan
+    '''
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'w') as f:
+        f.write('# chan unflagged status\n')
+        for chan, (frac, status) in sorted(stats.items()):
+            f.write(f'{chan} {frac:.4f} {status}\n')
+    os.replace(tmp, path)
+
+
+def screen(manifest, chans, args):
+    '''
+    Pre-screens the channel list of an inverter from the flags (a no-op without --min-unflagged)
+
+    Outputs:
+    channels to image and the line selections of merged channels ({chan: line})
+    '''
+    if args.min_unflagged is None:
+        return list(chans), {}
+    fraction = unflagged_fraction(manifest)
+    if fraction is None:
+        print('Number of channels unknown, channels are not pre-screened')
+        return list(chans), {}
+    kept, lines, stats = screen_channels(fraction, chans, args.step_size, args.min_unflagged, args.flag_merge)
+    write_flag_stats(args.flag_stats or flags_name(args.source, args.freq), stats)
+    merged = sum(1 for _, status in stats.values() if status.startswith('merged'))
+    print(f'Pre-screen: {len(kept)} of {len(stats)} channels kept, {merged} merged, '
+          f'{len(stats) - len(kept) - merged} dropped')
+    return kept, lines
+
+
+def add_flag_arguments(parser):
+    '''
+    Adds the channel pre-screen options shared by the inverters to an argparse parser
+    '''
+    parser.add_argument("--min-unflagged", dest="min_unflagged", type=float, default=None,
+                        help="drop channels whose unflagged fraction (from the uv flags) is below this\n"
+                             "(0 drops only entirely flagged channels, default no pre-screen)")
+
+    parser.add_argument("--flag-merge", dest="flag_merge", default=False, action="store_true",
+                        help="image a partly flagged channel below --min-unflagged with the channel before it\n"
+                             "instead of dropping it (not with --block or --prebin)")
+
+    parser.add_argument("--flag-stats", dest="flag_stats", default=None,
+                        help="per-channel flag statistics file (default {source}.{freq}.flags.txt)")
+
+
+if __name__ == "__main__":
+    import argparse
+    from MM_manifest import DEFAULT_GLOBS, load_manifest, channel_range, add_manifest_arguments
+
+    # Help string to be shown using the -h option
+    descStr = """
+    Writes the unflagged fraction of every channel of the uvaver files of a source
+    """
+
+    parser = argparse.ArgumentParser(description=descStr,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-s", dest="source",
+                        type=str, help="Source name in RA-DEC convention from miriad")
+
+    parser.add_argument("-f", dest="freq", type=int, default=2100,
+                        help="centre frequency in MHz")
+
+    parser.add_argument("-1", dest="start_chan", type=int, default=1,
+                        help="starting channel number")
+
+    parser.add_argument("-2", dest="end_chan", type=int, default=None,
+                        help="final channel number (default from the visibility manifest)")
+
+    parser.add_argument("-d", dest="step_size", type=int, default=5,
+                        help="channel step_size for images")
+
+    add_flag_arguments(parser)
+
+    add_manifest_arguments(parser, DEFAULT_GLOBS['multicore'])
+
+    args = parser.parse_args()
+    if args.min_unflagged is None:
+        args.min_unflagged = 0.0
+    manifest = load_manifest(args.source, args.freq, args.vis_globs or DEFAULT_GLOBS['multicore'], args.manifest, args.rescan)
+    if not manifest['datasets']:
+        print('No uvaver files found')
+        sys.exit(1)
+    screen(manifest, channel_range(manifest, args.start_chan, args.end_chan, args.step_size), args)
@@ -5,6 +5,20 @@ import glob
 from multiprocessing import Pool
 import tqdm
 
+from MM_run import run_miriad
+from MM_scratch import scratch_space, staged, copy_back, image_bytes, scratch_option, add_scratch_arguments
+from MM_state import state_name, stage_outputs, read_states, mark_pending, record, remove, tmp_name, commit, add_state_arguments
+from MM_trace import trace_option, add_trace_arguments
+from MM_memory import memory_option, add_memory_arguments
+from MM_placement import placement_option, add_placement_arguments, autotune
+from MM_async import choose_engine, add_engine_arguments
+from MM_retry import apply_retry, add_retry_arguments
+from MM_prebin import prebin_tasks, prebin_passes, add_prebin_arguments
+from MM_scheduler import run_graph, imap_tasks
+from MM_manifest import DEFAULT_GLOBS, load_manifest, vis_string, channel_range, add_manifest_arguments
+from MM_flags import screen, add_flag_arguments
+from MM_block import BLOCK_NOTE, grid_block, blocks, add_block_arguments
+
 # Miriad Multicore Inverter
 # Work through making images from .uvaver miriad files
 # J. Livingston 10 Oct 2019
@@ -16,46 +30,89 @@ def grid_images(args):
     Takes inputs and runs miriad invert from command line producing dirty maps and beams
     
     User Inputs:
-    args = chan, step, source, freq, field
+    args = chan, step, source, freq, field, var_strs, line, state, scratch, trace, memory, placement
+    (line overrides the miriad line selection, e.g. for pre-binned visibilities, None for chan,step,chan)
+    (state is the run state journal from MM_state, None or '' to skip channels whose maps exist)
+    (scratch is (directory, GB reserve) to invert on node-local storage, or None, see MM_scratch)
+    (trace is the json-lines file timing every miriad task, see MM_trace, None or '' for no trace)
+    (memory is (node budget bytes, memory table) to admit invert only when it fits, or None, see MM_memory)
+    (placement is (OpenMP threads, pin) for invert, or None, see MM_placement)
     
     Outputs:
     for each channel band produces dirty maps (.map) for each Stokes parameter and beam images
     '''
-    chan, step, source, freq, field = args
-    #Get all uvaver files
-    uvaver_locations=glob.glob(f'../*/*{source}*.uvaver') #!only works for where my files are stored!
-    var_strs=','.join(uvaver_locations)
+    chan, step, source, freq, field, var_strs, line, state, scratch, trace, memory, placement = args
+    #uvaver files come from the visibility manifest (comma separated)
     # make images for all sources in a directory
     stokespars = ['i','q','u','v']
     #print(f'Loading in {var_strs}')
    
     im,qm,um,vm = [f'{source}.{freq}.{chan:04d}.{a}.map' for a in stokespars]  #creates stokes names
     beam = f'{source}.{freq}.{chan:04d}.beam' #creates beam names
-    maps=','.join([im,qm,um,vm]) #create dirty map names
-
-    #Check if the maps have already been created
-    if not os.path.isdir(im) and not os.path.isdir(beam):
-    # Do the imaging
-        chan_str = f'chan,{step},{chan}'
-        stokes_str = ','.join(stokespars)
-        cmd = f'invert vis={var_strs} map={maps} beam={beam} line={chan_str} imsize={field},{field} cell=1,1 robust=+0.6 stokes={stokes_str} options=mfs'
-        #print(cmd)
-        args=shlex.split(cmd)
-        with open('error_inv.log','a') as log:
-            p=subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=log)
-    # Print the output
-        #print(p.stdout.read())
-        #for line in p.stdout:
-        #   print(line)
-            p.wait()
-            
+    outputs = [im,qm,um,vm,beam]
+
+    #Check if the maps have already been created (main has already dropped channels the state journal has as done)
+    if state or (not os.path.isdir(im) and not os.path.isdir(beam)):
+        with scratch_space(scratch, image_bytes(field, 8)) as work:
+            for out in outputs:
+                remove(tmp_name(out))
+            record(state, 'grid', chan, '', 'running')
+            #Dirty maps are written under temporary names (in scratch if used) and renamed once invert finishes
+            maps=','.join(staged(a, work) for a in [im,qm,um,vm])
+        # Do the imaging
+            chan_str = line or f'chan,{step},{chan}'
+            stokes_str = ','.join(stokespars)
+            cmd = f'invert vis={var_strs} map={maps} beam={staged(beam, work)} line={chan_str} imsize={field},{field} cell=1,1 robust=+0.6 stokes={stokes_str} options=mfs'
+            ret = run_miriad(cmd, 'error_inv.log', True, trace, {'stage': 'grid', 'chan': chan, 'stokes': ''}, memory, placement)
+            if ret == 0 and copy_back(outputs, work) and commit(outputs):
+                record(state, 'grid', chan, '', 'done', outputs)
+            else:
+                record(state, 'grid', chan, '', 'failed')
+
+
 def main(pool, args):
 
-    inputs = [[i, args.step_size, args.source, args.freq, args.field_size] for i in range(args.start_chan, args.end_chan, args.step_size)]
+    #Find the uvaver files once and take the channel range from them
+    globs = args.vis_globs or DEFAULT_GLOBS['multicore']
+    manifest = load_manifest(args.source, args.freq, globs, args.manifest, args.rescan)
+    var_strs = vis_string(manifest)
+    chans = channel_range(manifest, args.start_chan, args.end_chan, args.step_size)
+    #Drop (or merge) channels the uv flags leave (almost) empty before any invert is run
+    chans, lines = screen(manifest, chans, args)
+
+    #Resume from the state journal: channels whose maps were finished and are unchanged are skipped
+    #(maps made before the journal existed are recorded as finished)
+    state = state_name(args.source, args.freq) if args.state is None else args.state
+    screened = chans
+    if state:
+        chans = [key[1] for key in mark_pending(state, read_states(state), [('grid', i, '') for i in chans], stage_outputs(args.source, args.freq))]
+
+    scratch = scratch_option(args)
+    trace = trace_option(args)
+    memory = memory_option(args)
+    placement = placement_option(args)
+    if args.block_size > 1:
+        #One invert per block of channels, split back into single channel maps (channel averaged, not mfs)
+        print(BLOCK_NOTE)
+        task = grid_block
+        inputs = [[b, args.step_size, args.source, args.freq, args.field_size, None, var_strs, state, scratch, trace, memory, placement] for b in blocks(chans, args.block_size, args.step_size)]
+    elif args.prebin:
+        #Cut the visibilities into cached per-channel bins first, each invert reads only its bin
+        task = grid_images
+        #The bins are laid out over the whole range (an average pass covers all of it), but none are made for channels already done
+        tasks, bins = prebin_tasks(manifest, screened, args.step_size, args.prebin, args.prebin_dir, trace, set(screened) - set(chans))
+        print('Binning Visibilities')
+        for binning in prebin_passes(tasks)[0]:
+            for _ in tqdm.tqdm(run_graph(pool, binning),total=len(binning)):
+                pass
+        inputs = [[i, args.step_size, args.source, args.freq, args.field_size, bins[i][0], bins[i][1], state, scratch, trace, memory, placement] for i in chans]
+    else:
+        task = grid_images
+        inputs = [[i, args.step_size, args.source, args.freq, args.field_size, var_strs, lines.get(i), state, scratch, trace, memory, placement] for i in chans]
 
     print('Creating Images')
-    #Runs each chunk of freq on new processor
-    for _ in tqdm.tqdm(pool.imap(grid_images, inputs),total=len(inputs)):
+    #Runs each chunk of freq on new processor, straggling inverts are rerun on idle workers with --speculate
+    for _ in tqdm.tqdm(imap_tasks(pool, task, inputs, args.speculate),total=len(inputs)):
         pass
     pool.close()
 
@@ -82,8 +139,8 @@ if __name__ == "__main__":
     parser.add_argument("-1", dest="start_chan", type=int, default=1,
                         help="starting channel number")
 
-    parser.add_argument("-2", dest="end_chan", type=int, default=1500,
-                        help="final channel number")
+    parser.add_argument("-2", dest="end_chan", type=int, default=None,
+                        help="final channel number (default from the visibility manifest)")
 
     parser.add_argument("-d", dest="step_size", type=int, default=5,
                         help="channel step_size for images")
@@ -91,7 +148,29 @@ if __name__ == "__main__":
     parser.add_argument("-b", dest="field_size", type=int, default=2000,
                         help="size of field in pixels sqr")
 
+    add_block_arguments(parser)
+
+
+
+    add_prebin_arguments(parser)
+
+    add_state_arguments(parser)
+
+    add_scratch_arguments(parser)
+
+    add_trace_arguments(parser)
+
+    add_memory_arguments(parser)
+
+    add_placement_arguments(parser)
+
+    add_flag_arguments(parser)
+
+    add_manifest_arguments(parser, DEFAULT_GLOBS['multicore'])
+
+    add_retry_arguments(parser)
 
+    add_engine_arguments(parser)
 
     group = parser.add_mutually_exclusive_group()
 
@@ -102,7 +181,22 @@ if __name__ == "__main__":
 
 
     args = parser.parse_args()
-    pool = schwimmbad.choose_pool(mpi=args.mpi, processes=args.n_cores)
+    if args.engine == 'asyncio' and args.mpi:
+        parser.error('--engine asyncio runs on one node, it cannot be combined with --mpi')
+    if args.autotune and args.mpi:
+        parser.error('--autotune sizes a single node run, it cannot be combined with --mpi')
+    if args.autotune and args.state == '':
+        parser.error("--autotune needs the state journal to skip its trial channels in the run, it cannot be combined with --state ''")
+    if args.prebin and args.block_size > 1:
+        parser.error('--prebin and --block cannot be combined')
+    if args.flag_merge and (args.prebin or args.block_size > 1):
+        parser.error('--flag-merge cannot be combined with --prebin or --block')
+    # Timeouts and retries of the miriad tasks, inherited by the workers
+    apply_retry(args)
+    if args.autotune:
+        # The first channels still to do are run with each processes x threads split, the rest with the fastest
+        args.n_cores, args.threads = autotune(main, args, 'grid', 'multicore')
+    pool = choose_engine(args)
     #pool = schwimmbad.SerialPool()
 
     if args.mpi:
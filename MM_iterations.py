@@ -0,0 +1,179 @@
+import os
+import sys
+import numpy as np
+
+from MM_miriad_io import read_header, read_image
+from MM_state import remove
+
+# Miriad Multicore adaptive clean iterations
+# Cleans in rounds instead of one fixed niters run: after each round the residual peak
+# (restor mode=residual) is checked against the clean cutoff, and cleaning stops once it is below
+# it (or clean stopped on its own before using the round). Each round continues from the model of
+# the one before (clean model=), so no work is repeated. The iterations a channel needed are kept
+# in an iteration table and used as the first round of later runs, which then usually converge in
+# one round.
+# WORKS FOR PYTHON 3
+
+
+def read_iterations(table):
+    '''
+    Reads the iteration table
+
+    Outputs:
+    dict of (source, freq, chan, stokes) -> (iterations, converged) of the latest clean
+    '''
+    iterations = {}
+    if not table or not os.path.isfile(table):
+        return iterations
+    with open(table) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 6:
+                source, freq, chan, stokes, iters, converged = parts
+                iterations[(source, freq, int(chan), stokes)] = (int(iters), converged == '1')
+    return iterations
+
+
+def record_iterations(table, source, freq, chan, stokes, iterations, converged):
+    '''
+    Appends the iterations spent on a clean to the table (one small write)
+    '''
+    if not table:
+        return
+    with open(table, 'a') as f:
+        f.write(f'{source} {freq} {chan} {stokes} {iterations} {int(converged)}\n')
+
+
+def residual_peak(run, maps, beam, mod, resid):
+    '''
+    Largest absolute residual of a clean model (restor mode=residual), None if restor failed
+    '''
+    remove(resid)
+    run(f'restor map={maps} beam={beam} model={mod} mode=residual out={resid}')
+    if not os.path.isdir(resid):
+        return None
+    peak = float(np.nanmax(np.abs(read_image(resid))))
+    remove(resid)
+    return peak
+
+
+def adaptive_clean(run, maps, beam, mod, cutoff, first, round_iters, max_iters, seed=None, options=''):
+    '''
+    Cleans a map in rounds until the residual peak is below the cutoff
+
+    Inputs:
+    run = function running one miriad command line, returning its exit code
+    maps, beam, mod = dirty map, beam and the final clean model to write
+    cutoff = clean cutoff (the residual peak to reach)
+    first = iterations of the first round (e.g. learned from an earlier run)
+    round_iters = iterations of each further round
+    max_iters = total iterations never exceeded
+    seed = model to start from (e.g. a warm start), None to start from zero
+    options = further clean keywords, e.g. ' region=percentage(95)'
+
+    Outputs:
+    iterations spent and whether the residual reached the cutoff
+    '''
+    total, converged, prev, k = 0, False, seed, 0
+    while total < max_iters:
+        niters = min(first if k == 0 else round_iters, max_iters - total)
+        out = f'{mod}.{k}'
+        remove(out)
+        model = f' model={prev}' if prev else ''
+        run(f'clean map={maps} beam={beam}{model}{options} niters={niters} cutoff={cutoff} out={out}')
+        if not os.path.isdir(out):
+            break
+        # clean counts its iterations in the model header, including those of the input model
+        # (a warm start seed carries the iterations of the channels it came from)
+        done = read_header(out).get('niters')
+        before = read_header(prev).get('niters', 0) if prev else 0
+        spent = niters if done is None else max(0, done - before)
+        total += spent
+        if prev and prev != seed:
+            remove(prev)
+        prev, k = out, k + 1
+        peak = residual_peak(run, maps, beam, out, f'{mod}.resid')
+        if spent < niters or (peak is not None and peak <= cutoff):
+            converged = True
+            break
+    remove(mod)
+    if prev and prev != seed:
+        os.replace(prev, mod)
+    return total, converged
+
+
+def add_iteration_arguments(parser):
+    '''
+    Adds the adaptive clean options shared by the cleaners to an argparse parser
+    '''
+    parser.add_argument("--adaptive", dest="adaptive", default=False, action="store_true",
+                        help="clean in rounds until the residual peak is below the cutoff, instead of -i iterations")
+
+    parser.add_argument("--iter-round", dest="iter_round", type=int, default=200,
+                        help="iterations per adaptive round")
+
+    parser.add_argument("--iter-max", dest="iter_max", type=int, default=None,
+                        help="most iterations an adaptive clean may use (default 5 x -i)")
+
+    parser.add_argument("--iter-table", dest="iter_table", default="iter_table.txt",
+                        help="table of the iterations each channel needed, used to size the first round on reruns")
+
+
+def iteration_option(args):
+    '''
+    The adaptive setting passed to the tasks: (iteration table, round, max iterations) or None
+    '''
+    if not args.adaptive:
+        return None
+    return (args.iter_table, args.iter_round, args.iter_max or 5 * args.n_iters)
+
+
+def iteration_report(table, source, freq, chans, n_iters):
+    '''
+    Lines reporting the iterations spent on each channel against the fixed -i budget
+    '''
+    iterations = read_iterations(table)
+    lines, total, count = [], 0, 0
+    for chan in chans:
+        per_stokes = {key[3]: value for key, value in iterations.items()
+                      if key[:3] == (source, str(freq), chan)}
+        if not per_stokes:
+            continue
+        lines.append(f'{chan:04d} ' + ' '.join(f'{stokes}={iters}{"" if converged else "*"}'
+                                               for stokes, (iters, converged) in sorted(per_stokes.items())))
+        total += sum(iters for iters, _ in per_stokes.values())
+        count += len(per_stokes)
+    if count:
+        lines.append(f'{total} iterations over {count} cleans, {count * n_iters} with a fixed -i {n_iters} '
+                     f'(* did not reach the cutoff)')
+    return lines
+
+
+if __name__ == "__main__":
+    import argparse
+
+    # Help string to be shown using the -h option
+    descStr = """
+    Reports the clean iterations spent on each channel by adaptive cleaning
+    """
+
+    parser = argparse.ArgumentParser(description=descStr,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-s", dest="source",
+                        type=str, help="Source name in RA-DEC convention from miriad")
+
+    parser.add_argument("-f", dest="freq", type=int, default=2100,
+                        help="centre frequency in MHz")
+
+    parser.add_argument("-i", dest="n_iters", type=int, default=1000,
+                        help="fixed number of iterations to compare with")
+
+    parser.add_argument("--iter-table", dest="iter_table", default="iter_table.txt",
+                        help="iteration table written by the cleaners")
+
+    args = parser.parse_args()
+    if not os.path.isfile(args.iter_table):
+        print(f'No iteration table {args.iter_table}')
+        sys.exit(1)
+    chans = sorted({key[2] for key in read_iterations(args.iter_table) if key[:2] == (args.source, str(args.freq))})
+    print('\n'.join(iteration_report(args.iter_table, args.source, args.freq, chans, args.n_iters)))
@@ -0,0 +1,196 @@
+import os
+import sys
+import glob
+import json
+
+# Miriad Multicore visibility manifest
+# Finds the uvaver datasets of a source once and records their paths, sizes, number of channels
+# and frequency axis in a json manifest, which the inverters then read instead of globbing in
+# every task. The manifest also gives the channel range to image.
+# WORKS FOR PYTHON 3
+
+DEFAULT_GLOBS = {
+    'multicore': ['../*/*{source}*.uvaver'],
+    'region': ['../*/*{source}*{freq}*.uvaver'],
+    'single': ['../../*/*/{source}*.uvaver'],
+}
+
+
+def manifest_name(source, freq):
+    return f'{source}.{freq}.manifest.json'
+
+
+def _dataset_size(path):
+    return sum(os.path.getsize(os.path.join(path, item)) for item in os.listdir(path)
+               if os.path.isfile(os.path.join(path, item)))
+
+
+def _as_list(value):
+    if value is None:
+        return None
+    if hasattr(value, 'tolist'):
+        value = value.tolist()
+    return value if isinstance(value, list) else [value]
+
+
+def describe(path):
+    '''
+    Describes one uvaver dataset for the manifest
+
+    Outputs:
+    dict with path, size in bytes, mtime, nchan and the frequency axis (sfreq, sdf in GHz per window)
+    '''
+    from MM_miriad_io import read_uv_variables
+    entry = {'path': path, 'size': _dataset_size(path),
+             'mtime': os.path.getmtime(os.path.join(path, 'visdata')),
+             'nchan': None, 'sfreq': None, 'sdf': None}
+    try:
+        uv = read_uv_variables(path)
+    except (OSError, ValueError, IndexError, KeyError) as err:
+        print(f'Could not read the uv variables of {path}: {err}')
+        return entry
+    entry['nchan'] = uv.get('nchan')
+    entry['sfreq'] = _as_list(uv.get('sfreq'))
+    entry['sdf'] = _as_list(uv.get('sdf'))
+    return entry
+
+
+def _find(patterns):
+    return sorted({path for pattern in patterns for path in glob.glob(pattern)})
+
+
+def build_manifest(source, freq, globs):
+    '''
+    Searches for the uvaver datasets of a source and describes them
+
+    Inputs:
+    source, freq = substituted into the glob patterns
+    globs = list of glob patterns, e.g. ['../*/*{source}*.uvaver']
+
+    Outputs:
+    manifest dict
+    '''
+    patterns = [pattern.format(source=source, freq=freq) for pattern in globs]
+    paths = _find(patterns)
+    datasets = [describe(path) for path in paths]
+    nchans = [entry['nchan'] for entry in datasets if entry['nchan']]
+    return {'source': source, 'freq': freq, 'globs': list(globs), 'roots': patterns,
+            'nchan': min(nchans) if nchans else None, 'datasets': datasets}
+
+
+def is_stale(manifest, globs):
+    '''
+    True if the manifest was built from different globs, the globs now find other datasets
+    (e.g. a new uvaver file) or one of its datasets has changed
+    '''
+    if manifest.get('globs') != list(globs):
+        return True
+    if _find(manifest['roots']) != [entry['path'] for entry in manifest['datasets']]:
+        return True
+    for entry in manifest['datasets']:
+        visdata = os.path.join(entry['path'], 'visdata')
+        if not os.path.isfile(visdata) or os.path.getmtime(visdata) != entry['mtime']:
+            return True
+    return False
+
+
+def load_manifest(source, freq, globs, path=None, rescan=False):
+    '''
+    Reads the manifest of a source, building (and writing) it first if it is missing or stale
+
+    Inputs:
+    source, freq = source name and centre frequency
+    globs = glob patterns used to find the datasets
+    path = manifest file (default {source}.{freq}.manifest.json)
+    rescan = always rebuild the manifest
+
+    Outputs:
+    manifest dict
+    '''
+    path = path or manifest_name(source, freq)
+    if not rescan and os.path.isfile(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        if not is_stale(manifest, globs):
+            return manifest
+    manifest = build_manifest(source, freq, globs)
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, path)
+    return manifest
+
+
+def vis_string(manifest):
+    '''
+    Comma separated dataset list for the vis= input of miriad invert
+    '''
+    return ','.join(entry['path'] for entry in manifest['datasets'])
+
+
+def channel_range(manifest, start_chan, end_chan, step_size):
+    '''
+    Channel numbers to image: range(start_chan, end_chan, step_size), where an end_chan of None
+    is taken from the manifest so the last block of step_size channels ends at nchan
+    (falls back to 1500, with a warning, if the number of channels is unknown)
+    '''
+    if start_chan is None:
+        start_chan = 1
+    if end_chan is None:
+        nchan = manifest.get('nchan')
+        if nchan is None:
+            print('Number of channels unknown (no uvaver files found), imaging channels up to 1500; give -2 to set the final channel', file=sys.stderr)
+            end_chan = 1500
+        else:
+            end_chan = nchan - step_size + 2
+    return range(start_chan, end_chan, step_size)
+
+
+def add_manifest_arguments(parser, default_globs, region_globs=None):
+    '''
+    Adds the visibility discovery options shared by the inverters to an argparse parser
+    (region_globs are the defaults with --region-mode, for the scripts that have it)
+    '''
+    default = ' '.join(default_globs)
+    if region_globs:
+        default += f", or {' '.join(region_globs)} with --region-mode"
+    parser.add_argument("--vis-glob", dest="vis_globs", action="append", default=None,
+                        help="glob pattern for the uvaver files, {source} and {freq} are filled in "
+                             f"(repeatable, default {default})")
+
+    parser.add_argument("--manifest", dest="manifest", default=None,
+                        help="visibility manifest file (default {source}.{freq}.manifest.json)")
+
+    parser.add_argument("--rescan", dest="rescan", default=False, action="store_true",
+                        help="rebuild the visibility manifest even if it is up to date")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    # Help string to be shown using the -h option
+    descStr = """
+    Finds the uvaver files of a source and writes the visibility manifest used by the inverters
+    """
+
+    parser = argparse.ArgumentParser(description=descStr,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-s", dest="source",
+                        type=str, help="Source name in RA-DEC convention from miriad")
+
+    parser.add_argument("-f", dest="freq", type=int, default=2100,
+                        help="centre frequency in MHz")
+
+    parser.add_argument("--layout", dest="layout", default="multicore", choices=list(DEFAULT_GLOBS),
+                        help="default glob patterns to use when --vis-glob is not given")
+
+    add_manifest_arguments(parser, DEFAULT_GLOBS['multicore'])
+
+    args = parser.parse_args()
+    globs = args.vis_globs or DEFAULT_GLOBS[args.layout]
+    manifest = load_manifest(args.source, args.freq, globs, args.manifest, rescan=True)
+    for entry in manifest['datasets']:
+        print(f"{entry['path']} {entry['size']/1e9:.2f} GB nchan={entry['nchan']}")
+    if not manifest['datasets']:
+        print(f'No uvaver files found matching {manifest["roots"]}')
+        sys.exit(1)
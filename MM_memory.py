@@ -0,0 +1,209 @@
+import os
+import time
+import json
+import fcntl
+import getpass
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from MM_state import output_size
+
+# Miriad Multicore memory admission
+# Estimates the memory of each miriad command (invert from imsize, number of maps/stokes, double
+# size beams and planes; the other tasks from the size of their input datasets) and only starts
+# it while the commands already running on the node fit in a memory budget. Reservations are kept
+# in a ledger file in the node's temporary directory, shared by every worker process (and MPI rank)
+# on the node. Once a task has run, its estimate is scaled by the largest ratio of peak RSS to
+# estimate over its recent runs (kept in a memory table), so the static model is corrected both
+# ways and a single outlier run ages out.
+# WORKS FOR PYTHON 3
+
+GB = 1024**3
+MB = 1024**2
+
+# Memory of a task beyond its images (program, uv buffers)
+BASE_BYTES = 64 * MB
+VIS_BYTES = 256 * MB
+# Input dataset sizes a task holds in memory at once
+INPUT_FACTOR = {'clean': 3, 'restor': 2, 'linmos': 2, 'fits': 1, 'imsub': 1,
+                'gethd': 0, 'puthd': 0, 'uvcat': 0, 'uvaver': 0}
+# Headroom on top of the learned peak
+MARGIN = 1.25
+# Runs of each task the learned ratio is taken over
+RECENT_PEAKS = 20
+# Size of the memory table above which it is cut back to the recent runs of each task
+TABLE_BYTES = 64 * 1024
+INPUT_KEYS = {'clean': ['map', 'beam', 'model'], 'restor': ['map', 'beam', 'model']}
+
+_lock = threading.Lock()
+_ratios = {}
+
+
+def estimate(args):
+    '''
+    Estimated memory in bytes of one miriad command
+
+    Inputs:
+    args = command line split into a list (task name first)
+    '''
+    task = os.path.basename(args[0])
+    kv = dict(a.split('=', 1) for a in args[1:] if '=' in a)
+    if task == 'invert':
+        field = int(kv.get('imsize', '256').split(',')[0])
+        maps = len([m for m in kv.get('map', '').split(',') if m]) or len(kv.get('stokes', 'i').split(','))
+        options = kv.get('options', '')
+        line = kv.get('line', '').split(',')
+        nplanes = 1 if 'mfs' in options or len(line) < 2 else int(line[1])
+        beam = 4 if 'double' in options else 1
+        pix = field * field
+        # complex gridding plane per map and for the beam, plus the float32 output planes
+        return VIS_BYTES + 8 * pix * (maps + beam) + 4 * pix * nplanes * (maps + beam)
+    inputs = [path for key in INPUT_KEYS.get(task, ['in', 'vis']) if key in kv for path in kv[key].split(',')]
+    size = sum(output_size(path) or 0 for path in inputs)
+    return BASE_BYTES + INPUT_FACTOR.get(task, 1) * size
+
+
+def read_ratios(table):
+    '''
+    Peak RSS / estimate of the last RECENT_PEAKS runs of each task in the memory table
+
+    Outputs:
+    dict of task -> deque of (estimate, peak) bytes, oldest first
+    '''
+    ratios = {}
+    if not table or not os.path.isfile(table):
+        return ratios
+    with open(table) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and float(parts[1]) > 0:
+                ratios.setdefault(parts[0], deque(maxlen=RECENT_PEAKS)).append((float(parts[1]), float(parts[2])))
+    return ratios
+
+
+def _ratios_of(table):
+    with _lock:
+        if table not in _ratios:
+            _ratios[table] = read_ratios(table)
+        return _ratios[table]
+
+
+def learned(table, task, est):
+    '''
+    Estimate scaled by the largest ratio of the recent runs of the task with a safety margin, so tasks
+    that used less than estimated are packed tighter and ones that used more are given more room
+    '''
+    runs = _ratios_of(table).get(task) if table else None
+    if not runs:
+        return est
+    return est * max(peak / run_est for run_est, peak in runs) * MARGIN
+
+
+def record_peak(table, task, est, peak):
+    '''
+    Learns from the observed peak RSS (bytes) of a command, appending it to the table. The table is
+    cut back to the recent runs of each task once it grows past TABLE_BYTES.
+    '''
+    if not table or est <= 0:
+        return
+    ratios = _ratios_of(table)
+    with _lock:
+        ratios.setdefault(task, deque(maxlen=RECENT_PEAKS)).append((est, peak))
+        with open(table, 'a') as f:
+            f.write(f'{task} {est:.0f} {peak:.0f}\n')
+        if os.path.getsize(table) > TABLE_BYTES:
+            recent = read_ratios(table)
+            tmp = f'{table}.tmp{os.getpid()}'
+            with open(tmp, 'w') as f:
+                for name, runs in recent.items():
+                    f.writelines(f'{name} {run_est:.0f} {run_peak:.0f}\n' for run_est, run_peak in runs)
+            os.replace(tmp, table)
+
+
+def ledger_name(kind='memory'):
+    '''
+    Node-local ledger file shared by the processes of one user on the node
+    '''
+    return os.path.join(tempfile.gettempdir(), f'mm_{kind}.{getpass.getuser()}.json')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def update_ledger(ledger, change):
+    '''
+    Applies change(entries) to the ledger under an exclusive lock, dropping entries of dead processes
+    '''
+    with _lock, open(ledger, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        text = f.read()
+        entries = json.loads(text) if text.strip() else {}
+        entries = {key: entry for key, entry in entries.items() if _alive(entry['pid'])}
+        result = change(entries)
+        f.seek(0)
+        f.truncate()
+        json.dump(entries, f)
+        return result
+
+
+@contextmanager
+def reserve(need, budget, ledger=None, poll=1.0):
+    '''
+    Waits until need bytes fit in the node's budget, holding them until the block finishes
+
+    Inputs:
+    need = bytes the command is expected to use
+    budget = bytes per node (None or 0 for no admission control)
+    ledger = reservation file shared by the processes of the node (default in the temporary directory)
+    poll = seconds between checks while waiting
+
+    A command that needs more than the budget on its own is started once nothing else is running.
+    '''
+    if not budget:
+        yield
+        return
+    ledger = ledger or ledger_name()
+    key = f'{os.getpid()}.{threading.get_ident()}.{time.time()}'
+
+    def admit(entries):
+        if entries and sum(entry['bytes'] for entry in entries.values()) + need > budget:
+            return False
+        entries[key] = {'pid': os.getpid(), 'bytes': need}
+        return True
+    while not update_ledger(ledger, admit):
+        time.sleep(poll)
+    try:
+        yield
+    finally:
+        update_ledger(ledger, lambda entries: entries.pop(key, None))
+
+
+def add_memory_arguments(parser):
+    '''
+    Adds the memory admission options shared by the inverters and cleaners to an argparse parser
+    '''
+    parser.add_argument("--mem-budget", dest="mem_budget", type=float, default=None,
+                        help="GB of memory per node the running miriad tasks may use, tasks wait until\n"
+                             "their estimated memory fits (default no limit)")
+
+    parser.add_argument("--memory-table", dest="memory_table", default="memory_table.txt",
+                        help="table of peak task memory used to correct the estimates ('' to disable)")
+
+
+def memory_option(args):
+    '''
+    The memory setting passed to the tasks: (budget bytes or None, memory table), or None if there
+    is neither a budget nor a table (peaks are learned even without a budget, ready for one)
+    '''
+    budget = args.mem_budget * GB if args.mem_budget else None
+    return (budget, args.memory_table) if budget or args.memory_table else None
@@ -0,0 +1,361 @@
+import os
+import numpy as np
+
+# Miriad Multicore image I/O
+# Reads miriad image datasets (directories) straight into numpy without going through fits,
+# and writes simple image and uv datasets (e.g. for the fake miriad tasks of MM_benchmark.py)
+# Layout follows the miriad hio/headio/maskio conventions:
+#   header - small items, each a 16 byte record (15 char name + 1 byte size) followed by the
+#            item data, padded out to a 16 byte boundary
+#   image  - 4 byte type header then big endian float32 pixels, naxis1 varying fastest
+#   mask   - 4 byte type header then big endian int32 words holding 31 flag bits each
+#            (the flags item of a uv dataset has the same layout, nchan bits per record)
+# WORKS FOR PYTHON 3
+
+# Item type codes from hio.h
+H_BYTE = 1
+H_INT = 2
+H_INT2 = 3
+H_REAL = 4
+H_DBLE = 5
+H_TXT = 6
+H_CMPLX = 7
+H_INT8 = 8
+
+ITEM_HDR_SIZE = 4
+HEADER_RECORD = 16
+MASK_BITS = 31
+
+_dtypes = {H_INT: '>i4', H_INT2: '>i2', H_REAL: '>f4', H_DBLE: '>f8', H_CMPLX: '>c8', H_INT8: '>i8'}
+
+
+def _align(n, size):
+    return ((n + size - 1) // size) * size
+
+
+def decode_item(buf):
+    '''
+    Decodes the raw bytes of a miriad item into a python value
+
+    Inputs:
+    buf = bytes of the item including its 4 byte type header
+
+    Outputs:
+    str for text items, scalar for single valued numeric items, numpy array otherwise
+    '''
+    if len(buf) < ITEM_HDR_SIZE:
+        return None
+    itype = int.from_bytes(buf[:ITEM_HDR_SIZE], 'big')
+    if itype in (H_BYTE, H_TXT):
+        return buf[ITEM_HDR_SIZE:].split(b'\0', 1)[0].decode('ascii', 'replace').strip()
+    if itype not in _dtypes:
+        raise ValueError(f'Unknown miriad item type {itype}')
+    dtype = np.dtype(_dtypes[itype])
+    offset = _align(ITEM_HDR_SIZE, min(dtype.itemsize, 8))
+    values = np.frombuffer(buf[offset:], dtype=dtype)
+    if values.size == 1:
+        return values[0].item()
+    return values
+
+
+def read_header(path):
+    '''
+    Parses the header item of a miriad dataset
+
+    Inputs:
+    path = miriad dataset directory (e.g. source.freq.chan.v.map)
+
+    Outputs:
+    dict of header keyword -> value (keywords are lower case as in miriad)
+    '''
+    with open(os.path.join(path, 'header'), 'rb') as f:
+        raw = f.read()
+    header = {}
+    offset = 0
+    while offset + HEADER_RECORD <= len(raw):
+        name = raw[offset:offset + HEADER_RECORD - 1].split(b'\0', 1)[0].decode('ascii')
+        size = raw[offset + HEADER_RECORD - 1]
+        start = offset + HEADER_RECORD
+        if name:
+            header[name] = decode_item(raw[start:start + size])
+        offset = _align(start + size, HEADER_RECORD)
+    return header
+
+
+def read_item(path, name, header=None):
+    '''
+    Returns a single item of a miriad dataset, looking in the header first and then
+    for a large item stored as its own file in the dataset directory
+    '''
+    if header is None:
+        header = read_header(path)
+    if name in header:
+        return header[name]
+    item = os.path.join(path, name)
+    if os.path.isfile(item):
+        with open(item, 'rb') as f:
+            return decode_item(f.read())
+    return None
+
+
+def image_shape(header):
+    '''
+    Numpy (C order) shape of a miriad image from its naxis keywords, slowest axis first
+    '''
+    naxis = header['naxis']
+    return tuple(int(header[f'naxis{n}']) for n in range(naxis, 0, -1))
+
+
+def read_mask(path, shape):
+    '''
+    Reads the mask item of a miriad image
+
+    Outputs:
+    boolean array of shape, True where the pixel is good, or None if the image has no mask
+    '''
+    item = os.path.join(path, 'mask')
+    if not os.path.isfile(item):
+        return None
+    words = np.fromfile(item, dtype='>i4', offset=ITEM_HDR_SIZE)
+    npix = int(np.prod(shape))
+    # pixel n lives at bit (n + 31) counting 31 bits per word from the start of the item
+    bit = np.arange(MASK_BITS, MASK_BITS + npix, dtype=np.int64)
+    word = bit // MASK_BITS - 1
+    good = (words[word] >> (bit % MASK_BITS)) & 1
+    return good.astype(bool).reshape(shape)
+
+
+def unpack_mask(words):
+    '''
+    Flag bits of a run of mask words (as stored, big endian), 31 per word in order
+
+    Outputs:
+    boolean array, True where the flag bit is set (good)
+    '''
+    native = np.asarray(words).astype('<u4')
+    bits = np.unpackbits(native.view(np.uint8), bitorder='little').reshape(-1, 32)
+    return bits[:, :MASK_BITS].ravel().astype(bool)
+
+
+def write_mask(path, good, item='mask'):
+    '''
+    Writes a mask (or uv flags) item, the inverse of read_mask
+
+    Inputs:
+    path = miriad dataset directory
+    good = boolean array, True where the pixel (or channel of a record) is good
+    item = item name, 'mask' for images and 'flags' for uv datasets
+    '''
+    bits = np.asarray(good, dtype=bool).ravel()
+    nwords = -(-len(bits) // MASK_BITS)
+    padded = np.zeros(nwords * MASK_BITS, dtype=np.uint8)
+    padded[:len(bits)] = bits
+    words = np.zeros((nwords, 32), dtype=np.uint8)
+    words[:, :MASK_BITS] = padded.reshape(nwords, MASK_BITS)
+    with open(os.path.join(path, item), 'wb') as f:
+        f.write(H_INT.to_bytes(ITEM_HDR_SIZE, 'big'))
+        f.write(np.packbits(words.ravel(), bitorder='little').view('<u4').astype('>u4').tobytes())
+
+
+def read_image(path, plane=None, masked=True):
+    '''
+    Memory maps the pixels of a miriad image
+
+    Inputs:
+    path = miriad image directory
+    plane = optional index along the slowest (non spatial) axes, e.g. 0 for the first plane
+    masked = replace flagged pixels with NaN, as miriad fits does (forces a copy if a mask exists)
+
+    Outputs:
+    numpy array (read only memmap when no mask is applied) of float32 pixels
+    '''
+    header = read_header(path)
+    shape = image_shape(header)
+    data = np.memmap(os.path.join(path, 'image'), dtype='>f4', mode='r',
+                     offset=ITEM_HDR_SIZE, shape=shape)
+    mask = read_mask(path, shape) if masked else None
+    if mask is not None and not mask.all():
+        data = np.where(mask, data, np.nan).astype(np.float32)
+    if plane is not None:
+        data = data.reshape((-1,) + shape[-2:])[plane]
+    return data
+
+
+# uv datasets: vartable lists the variables ("type name" per line), visdata is a stream of
+# 4 byte record headers (variable index, 0, record type, 0) each padded to an 8 byte boundary
+UV_HDR_SIZE = 4
+UV_ALIGN = 8
+VAR_SIZE = 0
+VAR_DATA = 1
+VAR_EOR = 2
+
+_uv_dtypes = {'a': 'S1', 'b': 'S1', 'j': '>i2', 'i': '>i4', 'r': '>f4', 'd': '>f8', 'c': '>c8'}
+
+
+def read_vartable(path):
+    '''
+    Reads the vartable item of a miriad uv dataset
+
+    Outputs:
+    list of (name, type code) in variable index order
+    '''
+    with open(os.path.join(path, 'vartable')) as f:
+        return [(line.split()[1], line.split()[0]) for line in f if line.strip()]
+
+
+def read_uv_variables(path, max_bytes=1 << 20):
+    '''
+    Reads the uv variables of the first record of a miriad uv dataset (nchan, sfreq, sdf, ...)
+    without reading the rest of the visibilities
+
+    Inputs:
+    path = miriad uv dataset directory (e.g. a .uvaver file)
+    max_bytes = how much of the start of visdata to scan for the first record
+
+    Outputs:
+    dict of variable name -> value (str for text, scalar or numpy array for numbers)
+    '''
+    variables = read_vartable(path)
+    with open(os.path.join(path, 'visdata'), 'rb') as f:
+        raw = f.read(max_bytes)
+    # Skip an item type header if there is one in front of the first record
+    offset = UV_HDR_SIZE if raw[3:4] != b'\0' else 0
+    sizes, values = {}, {}
+    while offset + UV_HDR_SIZE <= len(raw):
+        index, kind = raw[offset], raw[offset + 2]
+        offset += UV_HDR_SIZE
+        if kind == VAR_EOR:
+            break
+        name, code = variables[index]
+        dtype = np.dtype(_uv_dtypes[code])
+        if kind == VAR_SIZE:
+            sizes[name] = int.from_bytes(raw[offset:offset + 4], 'big')
+            offset += 4
+        elif kind == VAR_DATA:
+            offset = _align(offset, min(dtype.itemsize, 8))
+            buf = raw[offset:offset + sizes[name]]
+            offset += sizes[name]
+            if dtype.kind == 'S':
+                values[name] = buf.split(b'\0', 1)[0].decode('ascii', 'replace').strip()
+            else:
+                value = np.frombuffer(buf, dtype=dtype)
+                values[name] = value[0].item() if value.size == 1 else value
+        else:
+            raise ValueError(f'Corrupt visdata record in {path}')
+        offset = _align(offset, UV_ALIGN)
+    return values
+
+
+def encode_item(value):
+    '''
+    Encodes a python value as the raw bytes of a miriad item (inverse of decode_item)
+
+    Inputs:
+    value = str (text), int (integer), float (double), or a numpy scalar/array whose dtype picks
+            the item type (e.g. np.float32 for real)
+
+    Outputs:
+    bytes of the item including its 4 byte type header
+    '''
+    if isinstance(value, str):
+        return H_TXT.to_bytes(ITEM_HDR_SIZE, 'big') + value.encode('ascii')
+    if isinstance(value, (bool, int)):
+        value = np.int32(value)
+    elif isinstance(value, float):
+        value = np.float64(value)
+    value = np.asarray(value)
+    codes = {np.dtype(dtype).newbyteorder('='): code for code, dtype in _dtypes.items()}
+    itype = codes[value.dtype.newbyteorder('=')]
+    dtype = np.dtype(_dtypes[itype])
+    offset = _align(ITEM_HDR_SIZE, min(dtype.itemsize, 8))
+    return itype.to_bytes(ITEM_HDR_SIZE, 'big').ljust(offset, b'\0') + value.astype(dtype).tobytes()
+
+
+def write_header(path, header):
+    '''
+    Writes the header item of a miriad dataset
+
+    Inputs:
+    path = miriad dataset directory (created if missing)
+    header = dict of keyword -> value, encoded with encode_item (items must fit in 255 bytes)
+    '''
+    os.makedirs(path, exist_ok=True)
+    raw = b''
+    for name, value in header.items():
+        buf = encode_item(value)
+        if len(name) >= HEADER_RECORD or len(buf) > 255:
+            raise ValueError(f'Header item {name} is too long for a miriad header')
+        record = name.encode('ascii').ljust(HEADER_RECORD - 1, b'\0') + bytes([len(buf)]) + buf
+        raw += record.ljust(_align(len(record), HEADER_RECORD), b'\0')
+    with open(os.path.join(path, 'header'), 'wb') as f:
+        f.write(raw)
+
+
+def write_image(path, data, header=None):
+    '''
+    Writes a miriad image dataset
+
+    Inputs:
+    path = miriad image directory (created if missing)
+    data = numpy array of pixels, slowest axis first (as returned by read_image)
+    header = extra header keywords (e.g. crval1, cdelt1, ctype1, bunit); naxis keywords are
+             taken from data
+    '''
+    items = {'naxis': data.ndim}
+    items.update({f'naxis{n+1}': size for n, size in enumerate(data.shape[::-1])})
+    items.update(header or {})
+    write_header(path, items)
+    with open(os.path.join(path, 'image'), 'wb') as f:
+        f.write(H_REAL.to_bytes(ITEM_HDR_SIZE, 'big'))
+        f.write(np.ascontiguousarray(data, dtype='>f4').tobytes())
+
+
+def scale_image(path, factor):
+    '''
+    Multiplies the pixels of a miriad image in place, leaving its header and mask untouched
+    '''
+    shape = image_shape(read_header(path))
+    data = np.memmap(os.path.join(path, 'image'), dtype='>f4', mode='r+',
+                     offset=ITEM_HDR_SIZE, shape=shape)
+    data *= factor
+    data.flush()
+    del data
+
+
+def write_uv(path, variables, nrec=1):
+    '''
+    Writes a minimal miriad uv dataset, every record holding the same variables
+
+    Inputs:
+    path = miriad uv dataset directory (created if missing)
+    variables = dict of variable name -> str or numpy array (its dtype picks the vartable type)
+    nrec = number of records
+    '''
+    os.makedirs(path, exist_ok=True)
+    codes = {np.dtype(dtype): code for code, dtype in _uv_dtypes.items() if code not in 'ab'}
+    table, values = [], []
+    for name, value in variables.items():
+        if isinstance(value, str):
+            table.append(('a', name))
+            values.append(value.encode('ascii'))
+        else:
+            value = np.asarray(value)
+            code = codes[value.dtype.newbyteorder('>')]
+            table.append((code, name))
+            values.append(value.astype(_uv_dtypes[code]).tobytes())
+    record = b''
+    for index, ((code, name), buf) in enumerate(zip(table, values)):
+        record += bytes([index, 0, VAR_SIZE, 0]) + len(buf).to_bytes(4, 'big')
+        record = record.ljust(_align(len(record), UV_ALIGN), b'\0')
+        record += bytes([index, 0, VAR_DATA, 0])
+        size = np.dtype(_uv_dtypes[code]).itemsize
+        record = record.ljust(_align(len(record), min(size, 8)), b'\0') + buf
+        record = record.ljust(_align(len(record), UV_ALIGN), b'\0')
+    record += bytes([0, 0, VAR_EOR, 0])
+    record = record.ljust(_align(len(record), UV_ALIGN), b'\0')
+    with open(os.path.join(path, 'vartable'), 'w') as f:
+        f.write(''.join(f'{code} {name}\n' for code, name in table))
+    with open(os.path.join(path, 'visdata'), 'wb') as f:
+        f.write(record * nrec)
+    with open(os.path.join(path, 'header'), 'wb') as f:
+        f.write(b'')
@@ -0,0 +1,212 @@
+import sys
+import math
+import traceback
+from collections import deque
+
+# Miriad Multicore MPI dispatch
+# A drop-in for schwimmbad's MPIPool (map, imap, wait, is_master, close) that hands the workers
+# chunks of tasks instead of one task per message, from one queue per node. The tasks of a map are
+# split over the nodes by channel: each node gets a contiguous range of channels, so the
+# visibilities (or prebin bins) of neighbouring channels are read on the node whose page cache
+# already holds them. Workers take chunks from the front of their own node's queue; a node whose
+# queue has run empty steals a chunk from the back of the fullest queue of another node. Chunks
+# shrink towards the end of a queue (guided self-scheduling) so the tail stays balanced.
+# The queues are kept by the master, which answers each finished chunk with the next one, so it
+# sees one message per chunk rather than one per task.
+# WORKS FOR PYTHON 3
+
+DISPATCHES = ['steal', 'schwimmbad']
+AFFINITIES = ['block', 'none']
+
+TAG_TASKS = 1
+TAG_RESULTS = 2
+
+
+def locality_key(arg):
+    '''
+    Channel a task works on, for the node affinity: the first item of the task arguments of the
+    inverters and cleaners (the first channel of a block, or the channel of the first task of a
+    chain that has one, e.g. the invert after the prebin tasks). None if there is no channel.
+    '''
+    first = arg[0] if isinstance(arg, (list, tuple)) and arg else None
+    if isinstance(first, (list, tuple)) and first and callable(first[0]):
+        # A chain of (func, args)
+        return next((key for key in (locality_key(args) for _, args in arg) if key is not None), None)
+    if isinstance(first, (list, tuple)) and first:
+        # A block of channels
+        first = first[0]
+    return first if isinstance(first, int) else None
+
+
+def node_queues(args, nodes, affinity='block'):
+    '''
+    Splits the tasks of a map over the nodes
+
+    Inputs:
+    args = task arguments, in the order they should be started (e.g. longest first)
+    nodes = node names
+    affinity = block: contiguous channel ranges with about the same number of tasks per node
+               (tasks without a channel are dealt round robin), none: round robin
+
+    Outputs:
+    dict of node -> deque of task ids, each in the original order
+    '''
+    queues = {node: deque() for node in nodes}
+    keys = [locality_key(arg) if affinity == 'block' else None for arg in args]
+    keyed = [tid for tid in range(len(args)) if keys[tid] is not None]
+    # Cut the sorted channels into len(nodes) contiguous ranges of about equal task counts
+    order = sorted(keyed, key=lambda tid: keys[tid])
+    owner, per_node = {}, math.ceil(len(keyed) / len(nodes)) if keyed else 1
+    for rank, tid in enumerate(order):
+        node = nodes[min(rank // per_node, len(nodes) - 1)]
+        # Tasks of the same channel stay together
+        owner[keys[tid]] = owner.get(keys[tid], node)
+    dealt = 0
+    for tid in range(len(args)):
+        if keys[tid] is None:
+            queues[nodes[dealt % len(nodes)]].append(tid)
+            dealt += 1
+        else:
+            queues[owner[keys[tid]]].append(tid)
+    return queues
+
+
+class StealPool:
+    '''
+    MPI pool with chunked dispatch from per-node queues with work stealing
+
+    Inputs:
+    chunk = most tasks sent to a worker in one message
+    affinity = how the tasks are split over the nodes, see node_queues
+    comm = MPI communicator (default COMM_WORLD)
+
+    Every rank builds the pool (the node names are exchanged collectively); the workers then
+    call wait() and run tasks until the master closes the pool.
+    '''
+
+    def __init__(self, chunk=4, affinity='block', comm=None):
+        from mpi4py import MPI
+        self.MPI = MPI
+        self.comm = comm or MPI.COMM_WORLD
+        self.rank = self.comm.Get_rank()
+        self.master = 0
+        self.chunk, self.affinity = max(chunk, 1), affinity
+        names = self.comm.allgather(MPI.Get_processor_name())
+        self.workers = list(range(1, self.comm.Get_size()))
+        if self.is_master() and not self.workers:
+            raise ValueError('Tried to create an MPI pool, but there was only one MPI process available. Need at least two.')
+        self.node_of = {rank: names[rank] for rank in self.workers}
+        # Nodes in rank order, so neighbouring channel ranges go to neighbouring ranks
+        self.nodes = list(dict.fromkeys(self.node_of[rank] for rank in self.workers))
+        self.node_size = {node: sum(1 for rank in self.workers if self.node_of[rank] == node) for node in self.nodes}
+        self.stats = {'chunks': 0, 'stolen': 0}
+        self._closed = False
+
+    def is_master(self):
+        return self.rank == self.master
+
+    def wait(self, callback=None):
+        '''
+        Worker loop: runs each chunk sent by the master and sends back its results
+        '''
+        if self.is_master():
+            return
+        status = self.MPI.Status()
+        while True:
+            task = self.comm.recv(source=self.master, tag=self.MPI.ANY_TAG, status=status)
+            if task is None:
+                break
+            func, chunk = task
+            results = []
+            for tid, arg in chunk:
+                try:
+                    results.append((tid, func(arg), None))
+                except Exception as err:
+                    results.append((tid, None, f'{err!r}\n{traceback.format_exc()}'))
+            self.comm.send(results, dest=self.master, tag=TAG_RESULTS)
+        if callback is not None:
+            callback()
+
+    def _next_chunk(self, queues, rank):
+        '''
+        Task ids of the next chunk of a worker: from the front of its node's queue, or stolen from
+        the back of the fullest other queue once its own is empty
+        '''
+        node = self.node_of[rank]
+        own = queues[node]
+        if own:
+            share = math.ceil(len(own) / self.node_size[node])
+            return [own.popleft() for _ in range(min(self.chunk, share))]
+        victim = max(queues, key=lambda n: len(queues[n]))
+        if not queues[victim]:
+            return []
+        # Half of what is left, so the victim's own workers keep the rest of their range
+        size = min(self.chunk, math.ceil(len(queues[victim]) / 2))
+        stolen = [queues[victim].pop() for _ in range(size)]
+        self.stats['stolen'] += len(stolen)
+        return stolen[::-1]
+
+    def imap(self, func, iterable):
+        '''
+        Runs func over iterable on the workers, yielding the results in order as they arrive
+        '''
+        args = list(iterable)
+        queues = node_queues(args, self.nodes, self.affinity)
+        results, nxt, running = {}, 0, 0
+
+        def send(rank):
+            chunk = self._next_chunk(queues, rank)
+            if not chunk:
+                return 0
+            self.comm.send((func, [(tid, args[tid]) for tid in chunk]), dest=rank, tag=TAG_TASKS)
+            self.stats['chunks'] += 1
+            return 1
+
+        for rank in self.workers:
+            running += send(rank)
+        status = self.MPI.Status()
+        while running:
+            done = self.comm.recv(source=self.MPI.ANY_SOURCE, tag=TAG_RESULTS, status=status)
+            running -= 1
+            running += send(status.Get_source())
+            for tid, result, err in done:
+                if err is not None:
+                    raise RuntimeError(f'task {tid} failed on rank {status.Get_source()}: {err}')
+                results[tid] = result
+            while nxt in results:
+                yield results.pop(nxt)
+                nxt += 1
+
+    def map(self, func, iterable, callback=None):
+        results = []
+        for result in self.imap(func, iterable):
+            if callback is not None:
+                callback(result)
+            results.append(result)
+        return results
+
+    def close(self):
+        if not self.is_master() or self._closed:
+            return
+        self._closed = True
+        for rank in self.workers:
+            self.comm.send(None, dest=rank, tag=TAG_TASKS)
+        if self.stats['chunks']:
+            print(f"MPI dispatch: {self.stats['chunks']} chunks to {len(self.workers)} workers on "
+                  f"{len(self.nodes)} nodes, {self.stats['stolen']} tasks stolen", file=sys.stderr)
+
+
+def add_mpi_arguments(parser):
+    '''
+    Adds the MPI dispatch options to an argparse parser (with the engine options)
+    '''
+    parser.add_argument("--mpi-dispatch", dest="mpi_dispatch", default="steal", choices=DISPATCHES,
+                        help="with --mpi, steal: chunks from per-node queues with work stealing,\n"
+                             "schwimmbad: one task per message from the master")
+
+    parser.add_argument("--mpi-chunk", dest="mpi_chunk", type=int, default=4,
+                        help="most tasks per message with --mpi-dispatch steal (smaller near the end)")
+
+    parser.add_argument("--mpi-affinity", dest="mpi_affinity", default="block", choices=AFFINITIES,
+                        help="block: each node gets a contiguous range of channels (warm page cache),\n"
+                             "none: tasks dealt round robin over the nodes")
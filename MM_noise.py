@@ -0,0 +1,210 @@
+import os
+import numpy as np
+
+# Miriad Multicore noise estimator
+# Robust, chunked noise estimates of miriad maps with an on-disk per-channel noise table
+# The map is read in blocks of rows from a memory map, so a large field is never loaded whole,
+# and NaN (blanked) pixels are ignored.
+# WORKS FOR PYTHON 3
+
+METHODS = ['mad', 'clip', 'std']
+MAD_TO_SIGMA = 1.4826
+TABLE_COLUMNS = ['source', 'freq', 'chan', 'mtime', 'method', 'noise']
+
+# Rows of each noise table read so far in this process and how far into the file, so lookups only
+# read the rows appended since the last one
+_tables = {}
+
+
+def _blocks(data, block_rows):
+    '''
+    Yields the finite pixels of data a block of rows at a time as float64
+    '''
+    rows = data.reshape(-1, data.shape[-1])
+    for start in range(0, rows.shape[0], block_rows):
+        block = np.asarray(rows[start:start + block_rows], dtype=np.float64)
+        yield block[np.isfinite(block)]
+
+
+def _chunked_median(data, block_rows, centre=None, nbins=4096, passes=3):
+    '''
+    Median of the finite pixels of data (or of |data - centre|) from block histograms,
+    refining the bin holding the median on each pass
+    '''
+    def values():
+        for v in _blocks(data, block_rows):
+            yield v if centre is None else np.abs(v - centre)
+
+    lo, hi, n = np.inf, -np.inf, 0
+    for v in values():
+        if v.size:
+            lo, hi, n = min(lo, v.min()), max(hi, v.max()), n + v.size
+    if n == 0:
+        return np.nan
+    below = 0
+    for _ in range(passes):
+        if lo == hi:
+            break
+        counts = np.zeros(nbins, dtype=np.int64)
+        for v in values():
+            counts += np.histogram(v[(v >= lo) & (v <= hi)], bins=nbins, range=(lo, hi))[0]
+        cum = below + np.cumsum(counts)
+        k = min(int(np.searchsorted(cum, n / 2)), nbins - 1)
+        below = cum[k] - counts[k]
+        edges = np.linspace(lo, hi, nbins + 1)
+        lo, hi = edges[k], edges[k + 1]
+    return (lo + hi) / 2
+
+
+def _chunked_moments(data, block_rows, centre=None, limit=None):
+    '''
+    Mean and standard deviation of the finite pixels, optionally only those within limit of centre
+    '''
+    n, s, s2 = 0, 0.0, 0.0
+    for v in _blocks(data, block_rows):
+        if limit is not None:
+            v = v[np.abs(v - centre) <= limit]
+        n += v.size
+        s += v.sum()
+        s2 += np.square(v).sum()
+    if n == 0:
+        return np.nan, np.nan
+    mean = s / n
+    return mean, np.sqrt(max(s2 / n - mean**2, 0.0))
+
+
+def robust_noise(data, method='std', clip=3.0, max_iter=10, tol=1e-3, block_rows=256):
+    '''
+    Estimates the noise (sigma) of a map without loading it all at once
+
+    Inputs:
+    data = map pixels, usually a memmap from MM_miriad_io.read_image
+    method = 'mad' (1.4826 x median absolute deviation), 'clip' (iterative sigma clipping)
+             or 'std' (plain standard deviation of the finite pixels, the default as in the
+             original cleaners; mad and clip are opt-in)
+    clip, max_iter, tol = clipping threshold in sigma, iteration limit and fractional convergence
+    block_rows = number of image rows read per chunk
+
+    Outputs:
+    float noise estimate (NaN if the map has no finite pixels)
+    '''
+    if method == 'mad':
+        median = _chunked_median(data, block_rows)
+        return float(MAD_TO_SIGMA * _chunked_median(data, block_rows, centre=median))
+    mean, std = _chunked_moments(data, block_rows)
+    if method == 'clip':
+        for _ in range(max_iter):
+            if not std > 0:
+                break
+            new_mean, new_std = _chunked_moments(data, block_rows, centre=mean, limit=clip * std)
+            converged = abs(new_std - std) <= tol * std
+            mean, std = new_mean, new_std
+            if converged:
+                break
+    elif method != 'std':
+        raise ValueError(f'Unknown noise method {method}, use one of {METHODS}')
+    return float(std)
+
+
+def read_noise_table(table):
+    '''
+    Reads the noise table
+
+    Outputs:
+    dict keyed by (source, freq, chan, method) -> (mtime, noise), later rows replacing earlier ones
+
+    The table is read once per process, later calls only read the rows appended since
+    '''
+    if not table or not os.path.isfile(table):
+        return {}
+    offset, rows = _tables.get(table, (0, {}))
+    if os.path.getsize(table) < offset:
+        # Replaced or truncated, read it again
+        offset, rows = 0, {}
+    with open(table) as f:
+        f.seek(offset)
+        while True:
+            line = f.readline()
+            if not line.endswith('\n'):
+                break  # a row still being written is read next time
+            offset = f.tell()
+            if line.startswith('#') or not line.strip():
+                continue
+            source, freq, chan, mtime, method, noise = line.split()
+            rows[(source, str(freq), int(chan), method)] = (float(mtime), float(noise))
+    _tables[table] = (offset, rows)
+    return rows
+
+
+def record_noise(table, source, freq, chan, mtime, method, noise):
+    '''
+    Appends one row to the noise table (a single small write, so parallel workers do not interleave)
+    '''
+    new = not os.path.isfile(table)
+    line = f'{source}\t{freq}\t{chan}\t{mtime!r}\t{method}\t{noise!r}\n'
+    if new:
+        line = '#' + '\t'.join(TABLE_COLUMNS) + '\n' + line
+    with open(table, 'a') as f:
+        f.write(line)
+
+
+def cached_noise(maps, source, freq, chan, method='std', table='noise_table.txt'):
+    '''
+    Noise of a miriad map, read from the noise table when the map is unchanged since it was measured
+
+    Inputs:
+    maps = miriad map directory
+    source, freq, chan = table key
+    method = noise estimator (see robust_noise)
+    table = path to the noise table, or None/'' to always recompute
+
+    Outputs:
+    float noise estimate
+    '''
+    from MM_miriad_io import read_image
+    mtime = os.path.getmtime(os.path.join(maps, 'image'))
+    if table:
+        cached = read_noise_table(table).get((source, str(freq), int(chan), method))
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    noise = robust_noise(read_image(maps), method=method)
+    if table:
+        record_noise(table, source, freq, chan, mtime, method, noise)
+    return noise
+
+
+def noise_spectrum(table, source, freq, method='std'):
+    '''
+    Per-channel noise spectrum from the noise table as a list of (chan, noise) sorted by channel
+    '''
+    rows = read_noise_table(table)
+    return sorted((key[2], value[1]) for key, value in rows.items()
+                  if key[0] == source and key[1] == str(freq) and key[3] == method)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    # Help string to be shown using the -h option
+    descStr = """
+    Prints the per-channel noise spectrum recorded in the noise table by MM_cleaner.py / MM_region_clean.py
+    """
+
+    parser = argparse.ArgumentParser(description=descStr,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-s", dest="source",
+                        type=str, help="Source name in RA-DEC convention from miriad")
+
+    parser.add_argument("-f", dest="freq", type=int, default=2100,
+                        help="centre frequency in MHz")
+
+    parser.add_argument("--noise", dest="noise_method", default="std", choices=METHODS,
+                        help="noise estimator the table rows were measured with")
+
+    parser.add_argument("--noise-table", dest="noise_table", default="noise_table.txt",
+                        help="noise table file")
+
+    args = parser.parse_args()
+
+    for chan, noise in noise_spectrum(args.noise_table, args.source, args.freq, args.noise_method):
+        print(f'{chan:04d} {noise:.6g}')
@@ -0,0 +1,284 @@
+import sys
+import tqdm
+
+from MM_scheduler import run_graph, read_runtimes
+from MM_state import state_name, stage_outputs, read_states, seed, is_done, mark_pending, add_state_arguments
+from MM_scratch import scratch_option, add_scratch_arguments
+from MM_trace import trace_option, add_trace_arguments
+from MM_memory import memory_option, add_memory_arguments
+from MM_placement import placement_option, add_placement_arguments, autotune
+from MM_async import choose_engine, add_engine_arguments
+from MM_retry import apply_retry, add_retry_arguments
+from MM_prebin import prebin_tasks, prebin_passes, add_prebin_arguments
+from MM_block import BLOCK_NOTE, grid_block, blocks, add_block_arguments
+from MM_manifest import DEFAULT_GLOBS, load_manifest, vis_string, channel_range, add_manifest_arguments
+from MM_flags import screen, add_flag_arguments
+from MM_cube import CubeWriter, add_cube_arguments
+
+# Miriad Multicore Pipeline
+# Streams invert -> clean: each channel is cleaned as soon as its dirty maps and beam exist,
+# so the clean stage overlaps the slow tail of the invert stage on the same pool
+# Uses grid_images/clean_images from MM_inverter.py and MM_cleaner.py
+# (or MM_region_invert.py and MM_region_clean.py with --region-mode)
+# WORKS FOR PYTHON 3
+
+
+def clean_channel_stokes(args):
+    '''
+    Cleans one stokes map of a gridded channel, taking the noise cutoff from the noise table
+    filled in by the channel's noise task (the table is mandatory in the pipeline, so the noise
+    of a channel is measured once and not again by each of its stokes tasks)
+
+    User Inputs:
+    args = chan, stokes, source, freq, region, nit, noise_method, noise_table, runtime_table, state, scratch, trace, memory, placement, region_mode
+    '''
+    chan, stokes, source, freq, region, nit, noise_method, noise_table, runtime_table, state, scratch, trace, memory, placement, region_mode = args
+    if region_mode:
+        from MM_region_clean import get_noise, clean_stokes
+    else:
+        from MM_cleaner import get_noise, clean_stokes
+    cut_noise = get_noise(source,freq,chan,noise_method,noise_table)
+    return clean_stokes([chan, stokes, source, freq, region, nit, cut_noise, runtime_table, state, scratch, trace, memory, placement, None, None])
+
+
+def build_tasks(args, manifest=None, screened=None):
+    '''
+    Builds the per-channel dependency graph of invert, noise and per-stokes clean tasks
+
+    User Inputs:
+    args = parsed command line arguments
+    manifest = visibility manifest, loaded from args when None
+    screened = (chans, lines) of an already pre-screened channel range, worked out from args when None
+               (MM_batch.py shares the manifest and the screen between its targets)
+
+    Outputs:
+    dict of (stage, chan, stokes) -> (func, args, deps) for MM_scheduler.run_graph
+    '''
+    if args.region_mode:
+        from MM_region_invert import grid_images
+        from MM_region_clean import channel_noise
+    else:
+        from MM_inverter import grid_images
+        from MM_cleaner import channel_noise
+
+    # Find the uvaver files once and take the channel range from them
+    layout = 'region' if args.region_mode else 'multicore'
+    if manifest is None:
+        manifest = load_manifest(args.source, args.freq, args.vis_globs or DEFAULT_GLOBS[layout], args.manifest, args.rescan)
+    var_strs = vis_string(manifest)
+    offset = [args.xoff, args.yoff] if args.region_mode else []
+    state = state_name(args.source, args.freq) if args.state is None else args.state
+    scratch = scratch_option(args)
+    trace = trace_option(args)
+    memory = memory_option(args)
+    placement = placement_option(args)
+
+    if screened is None:
+        chans = channel_range(manifest, args.start_chan, args.end_chan, args.step_size)
+        # Drop (or merge) channels the uv flags leave (almost) empty before any invert is run
+        chans, lines = screen(manifest, chans, args)
+    else:
+        chans, lines = screened
+
+    stokespars = ['i','q','u','v']
+    tasks, grid_chans = {}, {}
+    if args.prebin:
+        # Each channel's invert waits only for its own visibility bins, channels already gridded need none
+        states = read_states(state)
+        seed(state, states, [('grid', chan, '') for chan in chans], stage_outputs(args.source, args.freq))
+        done = {chan for chan in chans if is_done(states, 'grid', chan, '')}
+        tasks, bins = prebin_tasks(manifest, chans, args.step_size, args.prebin, args.prebin_dir, trace, done)
+    for block in blocks(chans, args.block_size, args.step_size):
+        # Channels of a block are gridded by one invert, then cleaned independently
+        grid_key = ('grid', block[0], '')
+        grid_chans[grid_key] = block
+        if args.block_size > 1:
+            tasks[grid_key] = (grid_block, [block, args.step_size, args.source, args.freq, args.field_size, tuple(offset) or None, var_strs, state, scratch, trace, memory, placement], [])
+        elif args.prebin:
+            vis, line, deps = bins[block[0]]
+            tasks[grid_key] = (grid_images, [block[0], args.step_size, args.source, args.freq, args.field_size] + offset + [vis, line, state, scratch, trace, memory, placement], deps)
+        else:
+            tasks[grid_key] = (grid_images, [block[0], args.step_size, args.source, args.freq, args.field_size] + offset + [var_strs, lines.get(block[0]), state, scratch, trace, memory, placement], [])
+        for chan in block:
+            noise_args = [chan, args.source, args.freq, args.noise_method, args.noise_table]
+            tasks[('noise', chan, '')] = (channel_noise, noise_args, [grid_key])
+            for stokes in stokespars:
+                clean_args = [chan, stokes, args.source, args.freq, args.region, args.n_iters,
+                              args.noise_method, args.noise_table, args.runtime_table, state, scratch, trace, memory, placement, args.region_mode]
+                tasks[('clean', chan, stokes)] = (clean_channel_stokes, clean_args, [('noise', chan, '')])
+
+    # Resume from the state journal: finished inverts and cleans are dropped from the graph,
+    # the tasks that depended on them start straight away. Maps made before the journal count
+    # as finished, and every clean of a channel that is gridded again is redone.
+    if state:
+        keys = [('grid', chan, '') for block in grid_chans.values() for chan in block]
+        keys += [key for key in tasks if key[0] == 'clean']
+        todo = set(mark_pending(state, read_states(state), keys, stage_outputs(args.source, args.freq)))
+        for key, block in grid_chans.items():
+            pending = [chan for chan in block if ('grid', chan, '') in todo]
+            if not pending:
+                del tasks[key]
+            elif args.block_size > 1:
+                # Only the channels of the block still to do are gridded again
+                func, grid_args, deps = tasks[key]
+                tasks[key] = (func, [pending] + grid_args[1:], deps)
+        regrid = {key[1] for key in todo if key[0] == 'grid'}
+        tasks = {key: task for key, task in tasks.items() if key[0] != 'clean' or key in todo or key[1] in regrid}
+    return tasks
+
+
+def main(pool, args):
+
+    tasks = build_tasks(args)
+    if args.block_size > 1:
+        print(BLOCK_NOTE)
+
+    # The visibility bins are cut first, in passes of independent tasks, so the bins of different
+    # channels are not chained to their shared average pass on MPI and serial pools
+    passes, tasks = prebin_passes(tasks)
+    if passes:
+        print('Binning Visibilities')
+    for binning in passes:
+        for _ in tqdm.tqdm(run_graph(pool, binning), total=len(binning)):
+            pass
+
+    # A channel is cleaned as soon as it is gridded, ahead of the inverts still waiting,
+    # and its slowest stokes cleans (by past runtime) go first
+    print('Creating and Cleaning Images')
+    runtimes = read_runtimes(args.runtime_table)
+    def priority(key):
+        stage, chan, stokes = key
+        past = runtimes.get((stage, args.source, str(args.freq), chan, stokes), (0.0, 0))[0]
+        return 0.0 if stage == 'grid' else 1.0 + past
+    # Clean images are written into the stokes cubes as their tasks finish
+    cubes = None
+    if args.cube:
+        chans = channel_range(load_manifest(args.source, args.freq, args.vis_globs or DEFAULT_GLOBS['region' if args.region_mode else 'multicore'], args.manifest),
+                              args.start_chan, args.end_chan, args.step_size)
+        cubes = CubeWriter(args.source, args.freq, chans, args.step_size, ['i','q','u','v'], args.cube_compress, args.manifest)
+    # Straggling inverts and cleans are rerun on idle workers with --speculate
+    for key, _ in tqdm.tqdm(run_graph(pool, tasks, priority, args.speculate, ('grid', 'clean')), total=len(tasks)):
+        if cubes and key[0] == 'clean':
+            cubes.add(key[1], key[2])
+    pool.close()
+    if cubes:
+        print('Cubes: ' + ' '.join(cubes.close()))
+
+
+if __name__ == "__main__":
+    import argparse
+    import schwimmbad
+
+
+    # Help string to be shown using the -h option
+    descStr = """
+    Runs miriad invert and clean for every channel in one pool, cleaning each channel as soon as
+    its dirty maps exist. Equivalent to MM_inverter.py followed by MM_cleaner.py.
+    """
+
+    # Parse the command line options
+    parser = argparse.ArgumentParser(description=descStr,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-s", dest="source",
+                        type=str, help="Source name in RA-DEC convention from miriad")
+
+    parser.add_argument("-f", dest="freq", type=int, default=2100,
+                        help="centre frequency in MHz")
+
+    parser.add_argument("-1", dest="start_chan", type=int, default=1,
+                        help="starting channel number")
+
+    parser.add_argument("-2", dest="end_chan", type=int, default=None,
+                        help="final channel number (default from the visibility manifest)")
+
+    parser.add_argument("-d", dest="step_size", type=int, default=5,
+                        help="channel step_size for images")
+
+    parser.add_argument("-b", dest="field_size", type=int, default=2000,
+                        help="size of field in pixels sqr")
+
+    add_block_arguments(parser)
+
+    parser.add_argument("-i", dest="n_iters", type=int, default=1000,
+                        help="number of iterations to clean")
+
+    parser.add_argument("-r", dest="region", type=float, default=95,
+                        help="region (percentage) to clean as percentage of image")
+
+    parser.add_argument("--noise", dest="noise_method", default="std", choices=['mad','clip','std'],
+                        help="estimator for the stokes v noise used as clean cutoff")
+
+    parser.add_argument("--noise-table", dest="noise_table", default="noise_table.txt",
+                        help="table caching per-channel noise between runs, also passes the noise of each\n"
+                             "channel to its clean tasks (cannot be disabled in the pipeline)")
+
+    parser.add_argument("--runtime-table", dest="runtime_table", default="runtime_table.txt",
+                        help="table of past clean runtimes used to start the slowest cleans first ('' to disable)")
+
+    parser.add_argument("--region-mode", dest="region_mode", default=False, action="store_true",
+                        help="use MM_region_invert.py/MM_region_clean.py (offset field, no linmos)")
+
+    parser.add_argument("-x", dest="xoff", type=int, default=0,
+                        help="offset in x direction in pixels (--region-mode)")
+
+    parser.add_argument("-y", dest="yoff", type=int, default=0,
+                        help="offset in y direction in pixels (--region-mode)")
+
+    add_prebin_arguments(parser)
+
+    add_state_arguments(parser)
+
+    add_scratch_arguments(parser)
+
+    add_trace_arguments(parser)
+
+    add_memory_arguments(parser)
+
+    add_placement_arguments(parser)
+
+    add_flag_arguments(parser)
+
+    add_cube_arguments(parser)
+
+    add_manifest_arguments(parser, DEFAULT_GLOBS['multicore'], DEFAULT_GLOBS['region'])
+
+    add_retry_arguments(parser)
+
+    add_engine_arguments(parser)
+
+    group = parser.add_mutually_exclusive_group()
+
+    group.add_argument("--ncores", dest="n_cores", default=1,
+                       type=int, help="Number of processes (uses multiprocessing).")
+    group.add_argument("--mpi", dest="mpi", default=False,
+                       action="store_true", help="Run with MPI.")
+
+
+    args = parser.parse_args()
+    if args.engine == 'asyncio' and args.mpi:
+        parser.error('--engine asyncio runs on one node, it cannot be combined with --mpi')
+    if args.autotune and args.mpi:
+        parser.error('--autotune sizes a single node run, it cannot be combined with --mpi')
+    if args.autotune and args.state == '':
+        parser.error("--autotune needs the state journal to skip its trial channels in the run, it cannot be combined with --state ''")
+    if args.prebin and args.block_size > 1:
+        parser.error('--prebin and --block cannot be combined')
+    if args.flag_merge and (args.prebin or args.block_size > 1):
+        parser.error('--flag-merge cannot be combined with --prebin or --block')
+    if not args.noise_table:
+        parser.error('the clean tasks read the noise of their channel from the noise table, --noise-table cannot be empty')
+    # Timeouts and retries of the miriad tasks, inherited by the workers
+    apply_retry(args)
+    if args.autotune:
+        # The first channels still to do are run with each processes x threads split, the rest with the fastest
+        args.n_cores, args.threads = autotune(main, args, 'clean', 'region' if args.region_mode else 'multicore')
+    pool = choose_engine(args)
+
+    if args.mpi:
+        if not pool.is_master():
+            pool.wait()
+            sys.exit(0)
+
+
+    # Makes and cleans the images
+    main(pool, args)
@@ -0,0 +1,177 @@
+import os
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+
+from MM_memory import ledger_name, update_ledger
+
+# Miriad Multicore placement
+# Sizes the OpenMP threads of each miriad task (OMP_NUM_THREADS) and pins each running task to
+# its own cores (os.sched_setaffinity), so --ncores tasks x --threads threads never compete for
+# the same cores. Cores are handed out per running task from a ledger in the node's temporary
+# directory, shared by every worker process (and MPI rank) on the node, taken from the cores the
+# job is allowed to use. --autotune tries a few processes x threads splits of --ncores cores on
+# the first channels of the run and uses the fastest for the rest.
+# WORKS FOR PYTHON 3
+
+THREAD_CHOICES = [1, 2, 4, 8]
+# Largest share of the channels still to do that the autotune trials may take together
+AUTOTUNE_SHARE = 0.25
+
+
+def task_env(placement):
+    '''
+    Environment for a miriad task: OMP_NUM_THREADS set to the placement's threads (None to inherit)
+    '''
+    if not placement or not placement[0]:
+        return None
+    return dict(os.environ, OMP_NUM_THREADS=str(placement[0]))
+
+
+@contextmanager
+def claim_cores(placement, ledger=None, poll=0.2):
+    '''
+    Claims free cores of the node for one miriad task
+
+    Inputs:
+    placement = (threads per task, pin) or None
+    ledger = claims file shared by the processes of the node (default in the temporary directory)
+    poll = seconds between checks while all cores are taken
+
+    Outputs:
+    yields the set of cores to pin the task to, or None if pinning is off
+    '''
+    if not placement or not placement[1]:
+        yield None
+        return
+    ledger = ledger or ledger_name('cores')
+    allowed = sorted(os.sched_getaffinity(0))
+    want = min(placement[0] or 1, len(allowed))
+    key = f'{os.getpid()}.{threading.get_ident()}.{time.time()}'
+
+    def claim(entries):
+        taken = {core for entry in entries.values() for core in entry['cores']}
+        free = [core for core in allowed if core not in taken]
+        if len(free) < want:
+            return None
+        entries[key] = {'pid': os.getpid(), 'cores': free[:want]}
+        return set(free[:want])
+    cores = update_ledger(ledger, claim)
+    while cores is None:
+        time.sleep(poll)
+        cores = update_ledger(ledger, claim)
+    try:
+        yield cores
+    finally:
+        update_ledger(ledger, lambda entries: entries.pop(key, None))
+
+
+def pin_to(cores):
+    '''
+    preexec_fn pinning a task to its cores before it starts (None if not pinned)
+    '''
+    if not cores:
+        return None
+    return lambda: os.sched_setaffinity(0, cores)
+
+
+def splits(cores):
+    '''
+    processes x threads splits of cores to try, e.g. 8 -> (8, 1), (4, 2), (2, 4), (1, 8)
+    '''
+    return [(cores // threads, threads) for threads in THREAD_CHOICES if threads <= cores]
+
+
+def trial_channels(args, stage, layout, sources=None):
+    '''
+    Channels of the run that still have work to do: not every (stage, chan, stokes) of the
+    channel is done in the state journal (of each source). Outputs made before the journal
+    existed are seeded into it first, as the run itself does.
+
+    Inputs:
+    args = parsed command line arguments
+    stage = 'grid' for the inverters, 'clean' for the cleaners and the pipeline
+    layout = key of MM_manifest.DEFAULT_GLOBS, for the channel range
+    sources = names the images and journals are named after (default [args.source], MM_batch.py
+              gives its targets)
+    '''
+    from MM_manifest import DEFAULT_GLOBS, load_manifest, channel_range
+    from MM_state import state_name, stage_outputs, read_states, seed, is_done
+    manifest = load_manifest(args.source, args.freq, args.vis_globs or DEFAULT_GLOBS[layout], args.manifest, args.rescan)
+    chans = list(channel_range(manifest, args.start_chan, args.end_chan, args.step_size))
+    stokespars = [''] if stage == 'grid' else ['i','q','u','v']
+    pending = set()
+    for source in sources or [args.source]:
+        state = state_name(source, args.freq) if args.state is None else args.state
+        keys = [(stage, chan, stokes) for chan in chans for stokes in stokespars]
+        states = read_states(state)
+        seed(state, states, keys, stage_outputs(source, args.freq))
+        pending.update(key[1] for key in keys if not is_done(states, *key))
+    return [chan for chan in chans if chan in pending]
+
+
+def autotune(main, args, stage, layout, sources=None, sample=None):
+    '''
+    Runs channels of the run with each processes x threads split of args.n_cores cores and picks
+    the one with the most channels per second
+
+    Inputs:
+    main = main(pool, args) of the script
+    args = parsed command line arguments (start_chan, end_chan, step_size, n_cores, threads, ...)
+    stage, layout, sources = what makes a channel done, see trial_channels
+    sample = channels per trial (default the largest number of processes)
+
+    Outputs:
+    best (processes, threads). The trials only take channels that are not done yet and time only
+    the run of their main (not the pool start), so a resumed run is not timed on skipped work.
+    All the trials together take at most AUTOTUNE_SHARE of the channels still to do; the splits
+    that do not fit are not tried. The trial channels are finished as part of the run, the state
+    journal (which autotune needs) makes the full run skip them.
+    '''
+    from MM_async import choose_engine
+    trials = splits(args.n_cores)
+    sample = sample or max(procs for procs, _ in trials)
+    pending = trial_channels(args, stage, layout, sources)
+    trials = trials[:int(len(pending) * AUTOTUNE_SHARE) // sample]
+    if len(trials) < 2:
+        print(f'Autotune: {len(pending)} channels to do, too few to try the splits of {args.n_cores} cores')
+        return args.n_cores, args.threads
+    results = []
+    for k, (procs, threads) in enumerate(trials):
+        chans = pending[k * sample:(k + 1) * sample]
+        trial = argparse.Namespace(**vars(args))
+        # Channels in between that are already done are skipped by main
+        trial.start_chan, trial.end_chan, trial.n_cores, trial.threads = chans[0], chans[-1] + 1, procs, threads
+        # Trials only clean their channels, the products of the run (e.g. cubes) come from the full run
+        trial.cube = False
+        pool = choose_engine(trial)
+        t0 = time.time()
+        main(pool, trial)
+        rate = len(chans) / (time.time() - t0)
+        print(f'Autotune: {procs} processes x {threads} threads, {rate:.3f} channels/s')
+        results.append((rate, procs, threads))
+    _, procs, threads = max(results)
+    return procs, threads
+
+
+def add_placement_arguments(parser):
+    '''
+    Adds the thread and core placement options shared by the multicore scripts to an argparse parser
+    '''
+    parser.add_argument("--threads", dest="threads", type=int, default=None,
+                        help="OpenMP threads per miriad task (sets OMP_NUM_THREADS, default inherited)")
+
+    parser.add_argument("--pin", dest="pin", default=False, action="store_true",
+                        help="pin each running miriad task to its own --threads cores")
+
+    parser.add_argument("--autotune", dest="autotune", default=False, action="store_true",
+                        help="try processes x threads splits of --ncores cores on the first channels\n"
+                             "and use the fastest for the rest of the run")
+
+
+def placement_option(args):
+    '''
+    The placement setting passed to the tasks: (threads, pin) or None
+    '''
+    return (args.threads, args.pin) if args.threads or args.pin else None
@@ -0,0 +1,172 @@
+import os
+import json
+import shutil
+
+from MM_run import run_miriad
+
+# Miriad Multicore visibility pre-binning
+# Cuts the uvaver files once into one small dataset per output channel (bin of step_size channels)
+# so each invert only reads its own bin instead of the full bandwidth files.
+#   split   - uvcat line=chan,step,chan per bin (exact, same data invert would select)
+#   average - one uvaver pass averaging every step channels, then uvcat of each single channel bin
+# Bins are cached in a directory and rebuilt when the source files, step or mode change.
+# WORKS FOR PYTHON 3
+
+MODES = ['split', 'average']
+# Stages (key[0]) of the tasks planned by prebin_tasks
+STAGES = ('average', 'prebin')
+
+
+def _finish(tmp, out):
+    '''
+    Moves a finished dataset into place so a killed task never leaves a half written bin
+    '''
+    if os.path.isdir(tmp):
+        if os.path.isdir(out):
+            shutil.rmtree(out)
+        os.replace(tmp, out)
+
+
+def split_bin(args):
+    '''
+    Copies the channels of one bin out of a uvaver file with uvcat
+
+    User Inputs:
+    args = vis, chan, step, out, trace
+    '''
+    vis, chan, step, out, trace = args
+    tmp = f'{out}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    run_miriad(f'uvcat vis={vis} out={tmp} line=chan,{step},{chan}', 'error_prebin.log', True, trace,
+               {'stage': 'prebin', 'chan': chan, 'stokes': ''})
+    _finish(tmp, out)
+
+
+def average_vis(args):
+    '''
+    Averages every step channels of a uvaver file into one channel with uvaver
+
+    User Inputs:
+    args = vis, start, nbins, step, out, trace
+    '''
+    vis, start, nbins, step, out, trace = args
+    tmp = f'{out}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    run_miriad(f'uvaver vis={vis} out={tmp} line=chan,{nbins},{start},{step},{step}', 'error_prebin.log', True, trace,
+               {'stage': 'prebin', 'chan': None, 'stokes': ''})
+    _finish(tmp, out)
+
+
+def extract_bin(args):
+    '''
+    Copies a single channel out of an averaged dataset with uvcat
+
+    User Inputs:
+    args = vis, index, out, trace
+    '''
+    vis, index, out, trace = args
+    tmp = f'{out}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    run_miriad(f'uvcat vis={vis} out={tmp} line=chan,1,{index}', 'error_prebin.log', True, trace,
+               {'stage': 'prebin', 'chan': None, 'stokes': ''})
+    _finish(tmp, out)
+
+
+def _check_cache(entry, cache_dir, step, mode, chans):
+    '''
+    Clears the cached bins of a dataset if its stamp does not match the dataset and binning
+    (the channel range only matters in average mode, where the bins are planes of one averaged
+    dataset; split bins stay valid whatever the range)
+    '''
+    base = os.path.basename(os.path.normpath(entry['path']))
+    stamp_file = os.path.join(cache_dir, f'{base}.stamp.json')
+    stamp = {'path': entry['path'], 'mtime': entry['mtime'], 'size': entry['size'],
+             'step': step, 'mode': mode, 'start': chans[0] if mode == 'average' else None,
+             'last': chans[-1] if mode == 'average' else None}
+    if os.path.isfile(stamp_file):
+        with open(stamp_file) as f:
+            if json.load(f) == stamp:
+                return base
+    for item in os.listdir(cache_dir):
+        if item.startswith(f'{base}.') and os.path.isdir(os.path.join(cache_dir, item)):
+            shutil.rmtree(os.path.join(cache_dir, item))
+    with open(stamp_file, 'w') as f:
+        json.dump(stamp, f)
+    return base
+
+
+def prebin_tasks(manifest, chans, step, mode='split', cache_dir='prebin', trace=None, done=()):
+    '''
+    Plans the pre-binning of every uvaver file in the manifest
+
+    Inputs:
+    manifest = visibility manifest from MM_manifest.load_manifest
+    chans = first channel of every output channel (bin)
+    step = channels per bin
+    mode = 'split' or 'average'
+    cache_dir = directory holding the bins
+    trace = json-lines trace of the uvcat/uvaver runs (see MM_trace), None for no trace
+    done = channels the state journal has as inverted, no bins are made for them
+
+    Outputs:
+    tasks = dict of key -> (func, args, deps) for MM_scheduler.run_graph, only for missing bins
+    inputs = dict of chan -> (var_strs, line, deps) for grid_images, deps being the keys in
+             tasks that must finish before the channel can be inverted
+    '''
+    if mode not in MODES:
+        raise ValueError(f'Unknown prebin mode {mode}, use one of {MODES}')
+    os.makedirs(cache_dir, exist_ok=True)
+    chans = list(chans)
+    tasks, vis, deps = {}, {chan: [] for chan in chans}, {chan: [] for chan in chans}
+    for entry in manifest['datasets']:
+        base = _check_cache(entry, cache_dir, step, mode, chans)
+        if mode == 'average':
+            avg = os.path.join(cache_dir, f'{base}.avg')
+            avg_key = ('average', 0, entry['path'])
+            avg_deps = [] if os.path.isdir(avg) else [avg_key]
+        for chan in chans:
+            out = os.path.join(cache_dir, f'{base}.{chan:04d}.bin')
+            vis[chan].append(out)
+            if os.path.isdir(out) or chan in done:
+                continue
+            key = ('prebin', chan, entry['path'])
+            deps[chan].append(key)
+            if mode == 'split':
+                tasks[key] = (split_bin, [entry['path'], chan, step, out, trace], [])
+            else:
+                tasks[key] = (extract_bin, [avg, (chan - chans[0]) // step + 1, out, trace], avg_deps)
+        if mode == 'average' and avg_deps and any(key[0] == 'prebin' and key[2] == entry['path'] for key in tasks):
+            nbins = (chans[-1] - chans[0]) // step + 1
+            tasks[avg_key] = (average_vis, [entry['path'], chans[0], nbins, step, avg, trace], [])
+    line = f'chan,{step},1' if mode == 'split' else 'chan,1,1'
+    inputs = {chan: (','.join(vis[chan]), line, deps[chan]) for chan in chans}
+    return tasks, inputs
+
+
+def prebin_passes(tasks):
+    '''
+    Splits the prebin tasks out of a task graph, to be run as passes of independent tasks before
+    the rest: the averaging passes, then the bins. In one graph the average pass of a dataset is a
+    dependency of every bin, so run_graph on pools without apply_async (MPI, serial) would join
+    every channel into a single chain and run it on one worker.
+
+    Outputs:
+    passes = list of task dicts to run one after another with MM_scheduler.run_graph (no deps)
+    rest = the other tasks, whose deps on the prebin tasks count as finished once the passes ran
+    '''
+    averages = {key: task for key, task in tasks.items() if key[0] == 'average'}
+    bins = {key: (func, args, []) for key, (func, args, _) in tasks.items() if key[0] == 'prebin'}
+    rest = {key: task for key, task in tasks.items() if key[0] not in STAGES}
+    return [tasks for tasks in (averages, bins) if tasks], rest
+
+
+def add_prebin_arguments(parser):
+    '''
+    Adds the pre-binning options shared by the inverters to an argparse parser
+    '''
+    parser.add_argument("--prebin", dest="prebin", default=None, choices=MODES,
+                        help="cut the uvaver files into one cached dataset per output channel first\n"
+                             "(split keeps every channel, average averages each step of channels)")
+
+    parser.add_argument("--prebin-dir", dest="prebin_dir", default="prebin",
+                        help="directory for the pre-binned visibility cache")
@@ -0,0 +1,75 @@
+import argparse
+
+import MM_run
+
+# Miriad Multicore straggler options
+# Command line options for the exit code checks, timeouts and retries of the miriad tasks
+# (MM_run.run_miriad) and the speculative re-execution of straggling tasks
+# (MM_scheduler.run_graph / imap_tasks). A task that exits non-zero or runs past the timeout of
+# its miriad task is killed, its outputs removed and rerun after an exponential backoff; one that
+# still fails is reported instead of passing silently. Near the end of a run, a task running far
+# longer than the median of its stage is started again on an idle worker and the first copy to
+# finish is kept.
+# WORKS FOR PYTHON 3
+
+
+def parse_timeouts(values):
+    '''
+    Timeouts from --timeout values: SECONDS for every task or TASK=SECONDS (e.g. invert=3600)
+
+    Outputs:
+    dict of miriad task name -> seconds, the default of all tasks under None
+    '''
+    timeouts = {}
+    for value in values or []:
+        task, _, seconds = value.rpartition('=')
+        if float(seconds) <= 0:
+            raise ValueError(f'timeout {value} is not positive')
+        timeouts[task or None] = float(seconds)
+    return timeouts
+
+
+def timeout_value(value):
+    '''
+    argparse type of --timeout, checks the value and keeps it as given
+    '''
+    try:
+        parse_timeouts([value])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value} is not SECONDS or TASK=SECONDS with SECONDS > 0')
+    return value
+
+
+def retry_option(args):
+    '''
+    The retry setting of the miriad tasks for MM_run.set_retry: (timeouts, retries, backoff) or None
+    '''
+    timeouts = parse_timeouts(args.timeouts)
+    return (timeouts, args.retries, args.backoff) if timeouts or args.retries else None
+
+
+def apply_retry(args):
+    '''
+    Sets the retry setting of the parsed options in this process. Called before the pool is
+    made, so multiprocessing workers inherit it and every MPI rank sets its own.
+    '''
+    MM_run.set_retry(retry_option(args))
+
+
+def add_retry_arguments(parser):
+    '''
+    Adds the timeout, retry and speculation options shared by the multicore scripts to an argparse parser
+    '''
+    parser.add_argument("--timeout", dest="timeouts", action="append", default=None, type=timeout_value, metavar="[TASK=]SECONDS",
+                        help="kill a miriad task after this many seconds, for every task or one task\n"
+                             "(e.g. --timeout 1800 --timeout invert=7200, default no limit)")
+
+    parser.add_argument("--retries", dest="retries", type=int, default=0,
+                        help="times a miriad task that failed or timed out is rerun (default 0)")
+
+    parser.add_argument("--backoff", dest="backoff", type=float, default=10.0,
+                        help="seconds before the first rerun of a task, doubled for each further one")
+
+    parser.add_argument("--speculate", dest="speculate", type=float, default=None,
+                        help="near the end of the run, start a second copy on an idle worker of any task\n"
+                             "running this many times longer than the median of its stage (e.g. 3)")
@@ -0,0 +1,197 @@
+import os
+import sys
+import numpy as np
+import tqdm
+
+from MM_fits import read_fits, create_fits, derived_cards
+from MM_cube import cube_name
+
+# Miriad Multicore RM synthesis
+# Faraday rotation measure synthesis on the stokes Q and U cubes of a run (MM_cube.py):
+#   F(phi) = sum_j w_j P_j exp(-2i phi (lambda_j^2 - lambda_0^2)) / sum_j w_j,   P = Q + iU
+# computed for blocks of image rows as one complex matrix product (Faraday depths x channels
+# times channels x pixels), with the Q/U rows read through memory maps so the cubes are never
+# loaded whole. Blocks run on the pool (or MPI) like the imaging tasks. Channels that are NaN in
+# a pixel (flagged, failed or missing) get zero weight there.
+# Writes the Faraday dispersion amplitude cube ({source}.{freq}.fdf.fits), the peak Faraday depth
+# and peak polarised intensity maps (.peakrm.fits, .peakpi.fits) and the RMSF (.rmsf.txt).
+# WORKS FOR PYTHON 3
+
+C = 299792458.0
+
+
+def lambda_squared(header):
+    '''
+    Wavelength squared (m^2) of every plane of a cube with a FREQ axis (Hz)
+    '''
+    if not str(header.get('CTYPE3', '')).startswith('FREQ'):
+        raise ValueError('the cube has no frequency axis (build it with the visibility manifest present)')
+    k = np.arange(header['NAXIS3'])
+    freqs = header['CRVAL3'] + (k + 1 - header.get('CRPIX3', 1.0)) * header['CDELT3']
+    return (C / freqs)**2
+
+
+def faraday_depths(lam2, phi_max=None, dphi=None, oversample=3):
+    '''
+    Faraday depths (rad/m^2) to synthesise: -phi_max..phi_max in steps of dphi
+
+    Defaults follow the usual limits of the lambda^2 coverage: the RMSF width 2 sqrt(3) / span
+    sampled oversample times, out to the largest depth one channel still resolves, sqrt(3) / width
+    '''
+    span = lam2.max() - lam2.min()
+    width = np.abs(np.diff(np.sort(lam2))).max() if len(lam2) > 1 else span
+    if dphi is None:
+        dphi = 2 * np.sqrt(3) / span / oversample
+    if phi_max is None:
+        phi_max = np.sqrt(3) / width if width > 0 else 100 * dphi
+    n = int(np.ceil(phi_max / dphi))
+    return np.arange(-n, n + 1) * dphi
+
+
+def rmsf(phi, lam2, weights=None):
+    '''
+    Rotation measure spread function of the lambda^2 coverage at the Faraday depths phi
+    '''
+    weights = np.ones_like(lam2) if weights is None else weights
+    lam0 = np.sum(weights * lam2) / np.sum(weights)
+    return np.exp(-2j * np.outer(phi, lam2 - lam0)) @ weights / np.sum(weights)
+
+
+def rm_block(args):
+    '''
+    RM synthesis of one block of image rows
+
+    User Inputs:
+    args = q_cube, u_cube, start, stop, phi, lam2
+
+    Outputs:
+    start row, Faraday dispersion amplitude (depths x rows x columns), peak Faraday depth and
+    peak polarised intensity maps of the rows
+    '''
+    q_cube, u_cube, start, stop, phi, lam2 = args
+    q = np.asarray(read_fits(q_cube)[1][:, start:stop], dtype=np.float32)
+    u = np.asarray(read_fits(u_cube)[1][:, start:stop], dtype=np.float32)
+    nchan, rows, cols = q.shape
+    pol = (q + 1j * u).astype(np.complex64).reshape(nchan, rows * cols)
+    good = np.isfinite(pol)
+    pol[~good] = 0
+    # All channels share lambda_0^2 so the kernel is one matrix for the whole block
+    lam0 = lam2.mean()
+    kernel = np.exp(-2j * np.outer(phi, lam2 - lam0)).astype(np.complex64)
+    count = good.sum(axis=0)
+    fdf = np.abs(kernel @ pol) / np.maximum(count, 1)
+    fdf[:, count == 0] = np.nan
+
+    # Peak of each spectrum, refined by a parabola through the peak and its neighbours
+    valid = count > 0
+    peak = np.argmax(np.where(np.isnan(fdf), -1, fdf), axis=0)
+    inner = np.clip(peak, 1, len(phi) - 2)
+    cols_ = np.arange(fdf.shape[1])
+    left, mid, right = fdf[inner - 1, cols_], fdf[inner, cols_], fdf[inner + 1, cols_]
+    denom = left - 2 * mid + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = np.where((peak == inner) & (denom < 0), 0.5 * (left - right) / denom, 0.0)
+    dphi = phi[1] - phi[0] if len(phi) > 1 else 0.0
+    peak_rm = np.where(valid, phi[peak] + shift * dphi, np.nan)
+    peak_pi = np.where(valid, fdf[peak, cols_] - 0.25 * (left - right) * shift, np.nan)
+    return (start, fdf.reshape(len(phi), rows, cols).astype(np.float32),
+            peak_rm.reshape(rows, cols).astype(np.float32), peak_pi.reshape(rows, cols).astype(np.float32))
+
+
+def main(pool, args):
+
+    q_cube, u_cube = [cube_name(args.source, args.freq, stokes) for stokes in 'qu']
+    for cube in [q_cube, u_cube]:
+        if not os.path.isfile(cube):
+            print(f'{cube} does not exist, build the Q and U cubes first (--cube in the cleaners or MM_cube.py)')
+            pool.close()
+            sys.exit(1)
+    header, q = read_fits(q_cube)
+    try:
+        lam2 = lambda_squared(header)
+    except ValueError as err:
+        print(f'{q_cube}: {err}')
+        pool.close()
+        sys.exit(1)
+    phi = faraday_depths(lam2, args.phi_max, args.dphi)
+    nchan, rows, cols = q.shape
+    print(f'RM synthesis: {nchan} channels, {len(phi)} Faraday depths from {phi[0]:.1f} to {phi[-1]:.1f} rad/m^2')
+
+    # Outputs are pre-allocated and filled block by block, only the blocks in flight are in memory
+    base = f'{args.source}.{args.freq}'
+    shape = (len(phi), rows, cols)
+    create_fits(f'{base}.fdf.fits', derived_cards(header, shape, {'CTYPE3': 'FARADAY', 'CRVAL3': float(phi[0]), 'CRPIX3': 1.0,
+                                                                   'CDELT3': float(phi[1] - phi[0]) if len(phi) > 1 else 1.0,
+                                                                   'CUNIT3': 'rad/m^2'}), shape)
+    create_fits(f'{base}.peakrm.fits', derived_cards(header, shape[1:], {'BUNIT': 'rad/m^2'}), shape[1:])
+    create_fits(f'{base}.peakpi.fits', derived_cards(header, shape[1:]), shape[1:])
+    fdf, peak_rm, peak_pi = [read_fits(f'{base}.{name}.fits', 'r+')[1] for name in ['fdf', 'peakrm', 'peakpi']]
+
+    inputs = [[q_cube, u_cube, start, min(start + args.block_rows, rows), phi, lam2] for start in range(0, rows, args.block_rows)]
+    imap = getattr(pool, 'imap', pool.map)
+    for start, block, rm, pi in tqdm.tqdm(imap(rm_block, inputs), total=len(inputs)):
+        stop = start + block.shape[1]
+        fdf[:, start:stop] = block
+        peak_rm[start:stop] = rm
+        peak_pi[start:stop] = pi
+    pool.close()
+    for out in [fdf, peak_rm, peak_pi]:
+        out.flush()
+
+    r = rmsf(phi, lam2)
+    np.savetxt(f'{base}.rmsf.txt', np.column_stack([phi, r.real, r.imag, np.abs(r)]),
+               header='phi real imag amplitude', fmt='%.6g')
+
+
+if __name__ == "__main__":
+    import argparse
+    from MM_async import choose_engine, add_engine_arguments
+
+
+    # Help string to be shown using the -h option
+    descStr = """
+    Runs RM synthesis on the stokes Q and U cubes built from the clean images (MM_cube.py),
+    writing the Faraday dispersion cube and peak Faraday depth and polarised intensity maps
+    """
+
+    # Parse the command line options
+    parser = argparse.ArgumentParser(description=descStr,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-s", dest="source",
+                        type=str, help="Source name in RA-DEC convention from miriad")
+
+    parser.add_argument("-f", dest="freq", type=int, default=2100,
+                        help="centre frequency in MHz")
+
+    parser.add_argument("--phi-max", dest="phi_max", type=float, default=None,
+                        help="largest Faraday depth in rad/m^2 (default from the channel width)")
+
+    parser.add_argument("--dphi", dest="dphi", type=float, default=None,
+                        help="Faraday depth step in rad/m^2 (default a third of the RMSF width)")
+
+    parser.add_argument("--block-rows", dest="block_rows", type=int, default=16,
+                        help="image rows per task (memory grows with rows x channels x Faraday depths)")
+
+    add_engine_arguments(parser)
+
+    group = parser.add_mutually_exclusive_group()
+
+    group.add_argument("--ncores", dest="n_cores", default=1,
+                       type=int, help="Number of processes (uses multiprocessing).")
+    group.add_argument("--mpi", dest="mpi", default=False,
+                       action="store_true", help="Run with MPI.")
+
+
+    args = parser.parse_args()
+    if args.engine == 'asyncio' and args.mpi:
+        parser.error('--engine asyncio runs on one node, it cannot be combined with --mpi')
+    pool = choose_engine(args)
+
+    if args.mpi:
+        if not pool.is_master():
+            pool.wait()
+            sys.exit(0)
+
+
+    # Run RM synthesis
+    main(pool, args)
@@ -0,0 +1,226 @@
+import os
+import sys
+import shlex
+import shutil
+import random
+import subprocess
+import time
+
+from MM_trace import record_trace
+from MM_memory import estimate, learned, record_peak, reserve
+from MM_placement import task_env, claim_cores, pin_to
+from MM_state import remove, cancel_file, cancelled
+
+# Miriad Multicore task runner
+# Helpers shared by the inverters and cleaners for running miriad tasks
+# WORKS FOR PYTHON 3
+
+# Engine that launches the commands instead of a blocking Popen (see MM_async), None for Popen
+_engine = None
+
+
+# Timeouts and retries of the miriad tasks (see MM_retry), None to run every task once with no limit
+_retry = None
+
+# Keywords naming the outputs of a task, removed before it is retried (miriad will not overwrite them)
+OUTPUT_KEYS = {'invert': ['map', 'beam']}
+
+
+def set_engine(engine):
+    global _engine
+    _engine = engine
+
+
+def set_retry(retry):
+    '''
+    Sets the timeouts and retries of the miriad tasks of this process
+
+    Inputs:
+    retry = (timeouts, retries, backoff) from MM_retry.retry_option: timeouts is a dict of task
+            name -> seconds (None for the default of all tasks), retries the number of reruns of a
+            task that failed or timed out, backoff the seconds waited before the first rerun
+            (doubled for each one after), or None
+    '''
+    global _retry
+    _retry = retry
+
+
+def task_outputs(args):
+    '''
+    Outputs named on the command line of a task (out=, or map= and beam= for invert)
+    '''
+    keys = OUTPUT_KEYS.get(os.path.basename(args[0]), ['out'])
+    paths = []
+    for arg in args[1:]:
+        key, _, value = arg.partition('=')
+        if key in keys and value:
+            paths += value.split(',')
+    return paths
+
+
+def _wait(p, timeout, cancel=None):
+    '''
+    Waits for a child, killing it after timeout seconds (None to wait for ever) or once the
+    cancel file appears (see MM_state.attempt)
+
+    Outputs:
+    exit code (negative signal number if it was killed), resource usage and whether it timed out
+    '''
+    if timeout is None and cancel is None:
+        _, status, usage = os.wait4(p.pid, 0)
+        return os.waitstatus_to_exitcode(status), usage, False
+    deadline, delay = None if timeout is None else time.time() + timeout, 0.01
+    while True:
+        pid, status, usage = os.wait4(p.pid, os.WNOHANG)
+        if pid:
+            return os.waitstatus_to_exitcode(status), usage, False
+        timed_out = deadline is not None and time.time() >= deadline
+        if timed_out or (cancel is not None and os.path.exists(cancel)):
+            p.kill()
+            _, status, usage = os.wait4(p.pid, 0)
+            return os.waitstatus_to_exitcode(status), usage, timed_out
+        time.sleep(delay if deadline is None else min(delay, max(deadline - time.time(), 0)))
+        delay = min(2 * delay, 0.5)
+
+
+def run_miriad(cmd, log_file, log_stderr=True, trace=None, tags=None, memory=None, placement=None,
+               stdout=subprocess.DEVNULL):
+    '''
+    Runs one miriad command line, discarding stdout unless asked otherwise
+
+    Inputs:
+    cmd = command line string
+    log_file = log that stderr is appended to
+    log_stderr = False to discard stderr as well
+    trace = json-lines trace the wall time, cpu time, peak rss and exit code of the task are
+            appended to (None or '' for no trace)
+    tags = dict stored with the trace record, e.g. stage, chan and stokes
+    memory = (node memory budget in bytes, memory table) to wait until the estimated memory of the
+             task fits in the budget, or None to start it straight away (see MM_memory)
+    placement = (OpenMP threads, pin to free cores) for the task, or None (see MM_placement)
+    stdout = where stdout goes: DEVNULL, an open file, or None to pass it straight through to the
+             terminal (see output_stream)
+
+    Outputs:
+    exit code of the task (of its last run if it was retried)
+
+    With set_retry a task that exits non-zero or runs past its timeout is killed and rerun after a
+    backoff, with its outputs removed first. A task that still fails is reported on stderr and in
+    log_file. In a speculated task that another attempt has finished (MM_state.cancelled) the
+    task is killed or not started, and its outputs removed.
+    '''
+    #print(cmd)
+    args = shlex.split(cmd)  # Splits the cmd into a string for subprocess
+    timeouts, retries, backoff = _retry or ({}, 0, 0)
+    timeout = timeouts.get(os.path.basename(args[0]), timeouts.get(None))
+    code = 1
+    for attempt in range(retries + 1):
+        if attempt:
+            # Exponential backoff with jitter so retried tasks do not hit a struggling filesystem together
+            time.sleep(backoff * 2**(attempt - 1) * random.uniform(0.5, 1.5))
+            for out in task_outputs(args):
+                remove(out)
+        if cancelled():
+            break
+        code, timed_out = _run_once(args, log_file, log_stderr, trace, tags, memory, placement, stdout, timeout, attempt)
+        if code == 0:
+            return code
+        if cancelled():
+            break
+        reason = f'timed out after {timeout:g} s' if timed_out else f'exited with {code}'
+        with open(log_file, 'a') as log:
+            log.write(f'# {args[0]} {reason} (run {attempt + 1} of {retries + 1}): {cmd}\n')
+    else:
+        print(f'{args[0]} failed ({reason}), see {log_file}: {cmd}', file=sys.stderr)
+        return code
+    # Another attempt of the task finished first, its outputs are the ones kept
+    for out in task_outputs(args):
+        remove(out)
+    return code or 1
+
+
+def _run_once(args, log_file, log_stderr, trace, tags, memory, placement, stdout, timeout, attempt):
+    '''
+    One run of a miriad task for run_miriad
+
+    Outputs:
+    exit code and whether the task was killed by its timeout
+    '''
+    cpu = maxrss = None
+    budget, table = memory or (None, None)
+    est = estimate(args) if memory else 0
+    with reserve(learned(table, args[0], est), budget), claim_cores(placement) as cores, open(log_file, 'a') as log:
+        start = time.time()
+        stderr = log if log_stderr else subprocess.DEVNULL
+        env, pin = task_env(placement), pin_to(cores)
+        if _engine is not None:
+            # The asyncio engine reaps its children itself, so there is no resource usage
+            code, start, timed_out = _engine.run(args, stdout, stderr, env, pin, timeout, cancel_file())
+        else:
+            p = subprocess.Popen(args, stdout=stdout, stderr=stderr, env=env, preexec_fn=pin)
+            # wait4 gives the resource usage of this child alone, RUSAGE_CHILDREN would also count
+            # every earlier child of a long lived pool worker
+            code, usage, timed_out = _wait(p, timeout, cancel_file())
+            p.returncode = code
+            cpu, maxrss = usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+    if maxrss:
+        record_peak(table, args[0], est, maxrss * 1024)  # ru_maxrss is in kB
+    if trace:
+        record_trace(trace, dict(tags or {}, task=args[0], exit=code, start=start,
+                                 wall=time.time() - start, cpu=cpu, maxrss=maxrss,
+                                 attempt=attempt, timeout=timed_out))
+    return code, timed_out
+
+
+OUTPUT_MODES = ['show', 'log', 'quiet']
+
+
+def output_stream(mode, log_file):
+    '''
+    The stdout of a task for an output mode, used by the single scripts
+
+    Inputs:
+    mode = show (straight to the terminal, no python in between), log (appended to log_file)
+           or quiet (discarded)
+    log_file = log for the log mode
+
+    Outputs:
+    stdout for run_miriad; an open file for the log mode, to be closed by the caller
+    '''
+    if mode == 'show':
+        return None
+    if mode == 'log':
+        return open(log_file, 'a')
+    return subprocess.DEVNULL
+
+
+def add_output_arguments(parser):
+    '''
+    Adds the miriad output option of the single scripts to an argparse parser
+    '''
+    parser.add_argument("--output", dest="output", default="show", choices=OUTPUT_MODES,
+                        help="miriad task output: show (passed straight to the terminal), log (one log\n"
+                             "file per task, keeps concurrent stokes apart) or quiet")
+
+
+def split_cube(cube, outputs, log_file, trace=None, tags=None, memory=None, placement=None):
+    '''
+    Splits the planes of a miriad cube into single plane images with imsub
+
+    Inputs:
+    cube = miriad image with one plane per output
+    outputs = output image names, one per plane in order (None to skip a plane). If the cube only
+              has one plane (e.g. a single beam for all channels) it is copied to every output
+    log_file = log for imsub errors
+    trace, tags, memory, placement = trace, memory admission and placement of the imsub runs, see run_miriad
+    '''
+    from MM_miriad_io import read_header
+    header = read_header(cube)
+    nplanes = header.get('naxis3', 1) if header.get('naxis', 2) >= 3 else 1
+    for k, out in enumerate(outputs):
+        if out is None or os.path.isdir(out):
+            continue
+        if nplanes == 1:
+            shutil.copytree(cube, out)
+        else:
+            run_miriad(f'imsub in={cube} out={out} region=images({k+1},{k+1})', log_file, True, trace, tags, memory, placement)
@@ -0,0 +1,298 @@
+import os
+import time
+import heapq
+import shutil
+import itertools
+import queue
+import tempfile
+from collections import defaultdict
+
+from MM_state import attempt
+
+# Miriad Multicore scheduler
+# Runs a graph of dependent tasks (e.g. invert -> clean of each channel) on a schwimmbad pool,
+# submitting each task as soon as the tasks it depends on have finished
+# WORKS FOR PYTHON 3
+
+# Finished tasks of a stage needed before its stragglers are judged against their median
+SPECULATE_MIN_DONE = 3
+# Seconds between straggler checks while waiting for tasks
+SPECULATE_POLL = 1.0
+
+
+def run_chain(chain):
+    '''
+    Runs a list of (func, args) one after another in a single worker
+
+    Outputs:
+    list of the results of each func
+    '''
+    return [func(args) for func, args in chain]
+
+
+def run_attempt(job):
+    '''
+    Runs one attempt of a task that may also be run speculatively, job = func, args, since, speculative, cancel
+    (see MM_state.attempt)
+    '''
+    func, args, since, speculative, cancel = job
+    with attempt(since, speculative, cancel):
+        return func(args)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _chains(tasks):
+    '''
+    Groups the tasks into chains of connected tasks, each in dependency order
+    '''
+    parent = {key: key for key in tasks}
+
+    def find(key):
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    for key, (_, _, deps) in tasks.items():
+        for dep in deps:
+            if dep in tasks:
+                parent[find(dep)] = find(key)
+
+    order, seen = [], set()
+
+    def visit(key):
+        if key in seen:
+            return
+        seen.add(key)
+        for dep in tasks[key][2]:
+            if dep in tasks:
+                visit(dep)
+        order.append(key)
+
+    for key in tasks:
+        visit(key)
+    chains = defaultdict(list)
+    for key in order:
+        chains[find(key)].append(key)
+    return list(chains.values())
+
+
+def run_graph(pool, tasks, priority=None, speculate=None, stages=None):
+    '''
+    Runs a dependency graph of tasks on the pool
+
+    Inputs:
+    pool = schwimmbad pool
+    tasks = dict of key -> (func, args, deps) where deps are keys that must finish first
+            (deps that are not in tasks count as already finished, e.g. skipped on a resumed run)
+    priority = optional function of key, tasks that are ready together are submitted highest first
+    speculate = factor over the median runtime of its stage after which a running task is started
+                again on an idle worker (None for no speculative re-execution)
+    stages = stages (key[0]) whose tasks may be run speculatively, their tasks must stage their
+             outputs through MM_state.commit (default all)
+
+    Outputs:
+    generator yielding (key, result) as each task finishes
+
+    Pools with apply_async (multiprocessing) get each task submitted the moment its dependencies
+    finish and a worker is free, highest priority first. Other pools (MPI, serial) run each connected group of tasks as one chain in a worker,
+    which keeps the per-channel ordering but overlaps different channels.
+
+    With speculate, once no task is waiting for a worker (the tail of the run) every task running
+    longer than speculate times the median of the finished tasks of its stage gets a second copy
+    on an idle worker. The first copy to finish is kept, its outputs committed first
+    (MM_state.commit), and the result of the other is dropped. Only the apply_async pools speculate.
+    The other copy is cancelled as soon as the first finishes: its miriad task is killed by its
+    worker, which removes its outputs and scratch directory and records nothing (MM_state.attempt).
+    The generator only ends once every copy has returned, so no worker is left mid-task when the
+    pool is closed.
+    '''
+    order = priority or (lambda key: 0)
+    if not hasattr(pool, 'apply_async'):
+        chains = sorted(_chains(tasks), key=lambda chain: -max(order(key) for key in chain))
+        inputs = [[(tasks[key][0], tasks[key][1]) for key in chain] for chain in chains]
+        # MPIPool and SerialPool only provide map
+        imap = getattr(pool, 'imap', pool.map)
+        for chain, results in zip(chains, imap(run_chain, inputs)):
+            for key, result in zip(chain, results):
+                yield key, result
+        return
+
+    waiting = {key: set(deps) & tasks.keys() for key, (_, _, deps) in tasks.items()}
+    dependents = defaultdict(list)
+    for key, deps in waiting.items():
+        for dep in deps:
+            dependents[dep].append(key)
+    finished = queue.Queue()
+
+    # Only keep about one task per worker queued in the pool, the rest wait here so that
+    # newly ready tasks can overtake lower priority ones
+    window = getattr(pool, '_processes', None) or os.cpu_count() or 1
+    ready, count = [], itertools.count()
+    # Submit times, attempts in flight and runtimes per stage for the speculation
+    submitted, running, runtimes, copied, done = {}, defaultdict(int), defaultdict(list), set(), set()
+    # The cancel file of each task, created once one of its attempts has finished
+    cancels = tempfile.mkdtemp(prefix='mm_cancel_') if speculate else None
+    ids = {key: k for k, key in enumerate(tasks)}
+
+    def cancel(key):
+        open(os.path.join(cancels, str(ids[key])), 'a').close()
+
+    def push(keys):
+        for key in keys:
+            heapq.heappush(ready, (-order(key), next(count), key))
+
+    def launch(key, copy=False):
+        func, args, _ = tasks[key]
+        if speculate:
+            func, args = run_attempt, (func, args, submitted.setdefault(key, time.time()), copy, os.path.join(cancels, str(ids[key])))
+        in_flight[0] += 1
+        running[key] += 1
+        pool.apply_async(func, (args,),
+                         callback=lambda result, key=key: finished.put((key, result, None)),
+                         error_callback=lambda err, key=key: finished.put((key, None, err)))
+
+    def submit():
+        while ready and in_flight[0] < window:
+            launch(heapq.heappop(ready)[2])
+
+    def stragglers():
+        if ready or not speculate:
+            return
+        now = time.time()
+        slow = [key for key, n in running.items() if n and key not in copied and key not in done
+                and (stages is None or key[0] in stages) and len(runtimes[key[0]]) >= SPECULATE_MIN_DONE
+                and now - submitted[key] > speculate * median(runtimes[key[0]])]
+        for key in sorted(slow, key=lambda key: submitted[key]):
+            if in_flight[0] >= window:
+                break
+            copied.add(key)
+            launch(key, copy=True)
+
+    in_flight = [0]
+    push(key for key, deps in waiting.items() if not deps)
+    submit()
+    try:
+        while len(done) < len(tasks):
+            try:
+                key, result, err = finished.get(timeout=SPECULATE_POLL if speculate else None)
+            except queue.Empty:
+                stragglers()
+                continue
+            in_flight[0] -= 1
+            running[key] -= 1
+            if key in done or (err is not None and running[key]):
+                # The other copy of a speculated task finished first, or may still succeed
+                submit()
+                continue
+            if err is not None:
+                raise err
+            done.add(key)
+            if speculate:
+                runtimes[key[0]].append(time.time() - submitted[key])
+                if running[key]:
+                    cancel(key)
+            for dependent in dependents[key]:
+                waiting[dependent].discard(key)
+                if not waiting[dependent]:
+                    push([dependent])
+            submit()
+            stragglers()
+            yield key, result
+    finally:
+        # With speculation, wait for the attempts still running (the cancelled copies, or every
+        # task after an error, all cancelled) so that none is killed mid-task when the pool is closed
+        if speculate:
+            for key, n in running.items():
+                if n:
+                    cancel(key)
+            while in_flight[0] > 0:
+                finished.get()
+                in_flight[0] -= 1
+            shutil.rmtree(cancels, ignore_errors=True)
+
+
+def imap_tasks(pool, func, inputs, speculate=None):
+    '''
+    imap of func over inputs on the pool, with speculative re-execution of the stragglers
+    (see run_graph) if speculate is given and the pool has apply_async
+
+    Outputs:
+    generator of the results in the order of inputs
+    '''
+    if not speculate or not hasattr(pool, 'apply_async'):
+        yield from getattr(pool, 'imap', pool.map)(func, inputs)
+        return
+    tasks = {('task', k, ''): (func, args, []) for k, args in enumerate(inputs)}
+    # Submitted in input order (e.g. longest first), yielded in input order as imap does
+    results, nxt = {}, 0
+    for key, result in run_graph(pool, tasks, lambda key: -key[1], speculate):
+        results[key[1]] = result
+        while nxt in results:
+            yield results.pop(nxt)
+            nxt += 1
+
+
+def read_runtimes(table):
+    '''
+    Reads the runtime table written by record_runtime
+
+    Outputs:
+    dict keyed by (stage, source, freq, chan, stokes) -> (seconds, work), later rows replacing earlier ones
+    '''
+    rows = {}
+    if not table or not os.path.isfile(table):
+        return rows
+    with open(table) as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            stage, source, freq, chan, stokes, seconds, work = line.split()
+            rows[(stage, source, str(freq), int(chan), stokes)] = (float(seconds), float(work))
+    return rows
+
+
+def record_runtime(table, stage, source, freq, chan, stokes, seconds, work):
+    '''
+    Appends the measured runtime of one task to the runtime table (a single small write)
+    '''
+    if not table:
+        return
+    line = f'{stage}\t{source}\t{freq}\t{chan}\t{stokes}\t{seconds:.3f}\t{work:.6g}\n'
+    if not os.path.isfile(table):
+        line = '#stage\tsource\tfreq\tchan\tstokes\tseconds\twork\n' + line
+    with open(table, 'a') as f:
+        f.write(line)
+
+
+def task_costs(keys, work, runtimes):
+    '''
+    Estimates the cost of each task for longest-first ordering
+
+    Inputs:
+    keys = list of (stage, source, freq, chan, stokes) task keys
+    work = dict of key -> static work estimate (e.g. niters x map pixels)
+    runtimes = output of read_runtimes
+
+    Outputs:
+    dict of key -> estimated seconds. Tasks that have run before use their last runtime,
+    the others use their work times the seconds per unit work seen for the same stage and stokes.
+    '''
+    rate = defaultdict(list)
+    for (stage, _, _, _, stokes), (seconds, done) in runtimes.items():
+        if done > 0:
+            rate[(stage, stokes)].append(seconds / done)
+    all_rates = [r for rates in rate.values() for r in rates]
+    default = sorted(all_rates)[len(all_rates) // 2] if all_rates else 1.0
+    costs = {}
+    for key in keys:
+        if key in runtimes:
+            costs[key] = runtimes[key][0]
+        else:
+            rates = sorted(rate.get((key[0], key[4]), [default]))
+            costs[key] = work.get(key, 0) * rates[len(rates) // 2]
+    return costs
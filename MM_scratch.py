@@ -0,0 +1,127 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from MM_state import remove, tmp_name, speculative
+from MM_memory import ledger_name, update_ledger
+
+# Miriad Multicore scratch staging
+# Runs the miriad tasks of one invert or clean in a private directory on node-local storage
+# (e.g. /dev/shm or a local SSD) so the intermediates never touch the shared filesystem.
+# Only the products are copied back, under their .tmp names, ready for MM_state.commit to
+# rename into place atomically. The scratch directory is removed when the task finishes.
+# The space a task expects to write is claimed in a node ledger (as MM_memory does for memory)
+# under the same lock as the free space check, so tasks starting together cannot all count the
+# same free space.
+# WORKS FOR PYTHON 3
+
+GB = 1024**3
+
+
+@contextmanager
+def scratch_space(scratch, need=0):
+    '''
+    Per-task scratch directory
+
+    Inputs:
+    scratch = (base directory, GB to always leave free) or None
+    need = bytes the task expects to write
+
+    Outputs:
+    yields the scratch directory, or None (work in the shared directory as usual) if scratch is
+    not used or the base directory does not have need bytes free on top of the reserve and the
+    space claimed by the other tasks using it.
+    A speculative attempt (MM_state.attempt) always gets a directory, in the shared directory if
+    there is no scratch, so that it never touches the intermediates of the attempt it copies.
+    '''
+    base, reserve = scratch or (None, 0)
+    ledger = ledger_name('scratch')
+    key = f'{os.getpid()}.{threading.get_ident()}.{time.time()}'
+
+    def claim(entries):
+        # Free space is checked and claimed under one lock of the ledger
+        held = sum(entry['bytes'] for entry in entries.values() if entry['base'] == os.path.abspath(base))
+        if shutil.disk_usage(base).free - held < need + reserve * GB:
+            return False
+        entries[key] = {'pid': os.getpid(), 'bytes': need, 'base': os.path.abspath(base)}
+        return True
+    claimed = bool(scratch) and update_ledger(ledger, claim)
+    if not claimed:
+        if not speculative():
+            yield None
+            return
+        base = '.'
+    path = tempfile.mkdtemp(prefix=f'mm_{os.getpid()}_', dir=base)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+        if claimed:
+            update_ledger(ledger, lambda entries: entries.pop(key, None))
+
+
+def staged(path, work):
+    '''
+    Name a task should write path under: its .tmp name, inside the scratch directory if there is one
+    '''
+    if work is None:
+        return tmp_name(path)
+    return os.path.join(work, os.path.basename(tmp_name(path)))
+
+
+def in_scratch(path, work):
+    '''
+    Name for an intermediate that is never copied back
+    '''
+    if work is None:
+        return path
+    return os.path.join(work, os.path.basename(path))
+
+
+def copy_back(paths, work):
+    '''
+    Copies the staged products of a task from scratch to their .tmp names in the shared directory
+
+    Outputs:
+    False if a product is missing from scratch
+    '''
+    if work is None:
+        return True
+    for path in paths:
+        src = staged(path, work)
+        if not os.path.exists(src):
+            return False
+        remove(tmp_name(path))
+        if os.path.isdir(src):
+            shutil.copytree(src, tmp_name(path))
+        else:
+            shutil.copyfile(src, tmp_name(path))
+    return True
+
+
+def image_bytes(field, nplanes=1):
+    '''
+    Rough size of miriad float32 images of field x field pixels (beams are double size on each axis)
+    '''
+    return 4 * field * field * nplanes
+
+
+def add_scratch_arguments(parser):
+    '''
+    Adds the scratch staging options shared by the inverters and cleaners to an argparse parser
+    '''
+    parser.add_argument("--scratch", dest="scratch", default=None,
+                        help="node-local directory (e.g. /dev/shm) to run each task in, only products are copied back")
+
+    parser.add_argument("--scratch-reserve", dest="scratch_reserve", type=float, default=1.0,
+                        help="GB to leave free in --scratch, tasks that would not fit run in the working directory")
+
+
+def scratch_option(args):
+    '''
+    The scratch setting passed to the tasks: (directory, reserve GB) or None
+    '''
+    return (args.scratch, args.scratch_reserve) if args.scratch else None
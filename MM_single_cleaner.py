@@ -3,6 +3,9 @@ import subprocess,shlex,shutil
 import sys,getopt
 import glob
 
+from MM_run import run_miriad, output_stream, add_output_arguments
+from MM_async import choose_engine, add_engine_arguments
+
 # Miriad Single Cleaner
 # Work through cleaning single image from MM_single_inverter.py
 # J. Livingston 23 Oct 2019
@@ -10,82 +13,86 @@ import glob
 # WORKS FOR PYTHON 3
 
 
-def clean_images(args):
+def clean_stokes(args):
     '''
-    Cleans mfs dirty map generated from MM_single_inverter.py and converts to fits file
+    Cleans the mfs dirty map of one stokes parameter and converts it to a fits file
     
     User Inputs:
-    args = source, freq, region, nit
+    args = stokes, source, freq, region, nit, cut_noise, output
+    (output is how the miriad output is handled: show, log or quiet, see MM_run.output_stream)
     
     Outputs:
-    cleans mfs dirty map and produces fits image for each stokes parameter
+    clean fits image for the stokes parameter
     '''
-    source, freq, region, nit = args
-    stokespars = ['i','q','u','v']
-    # Cycle over the channels
-    cut_noise = get_noise(source,freq)
-    for stokes in stokespars[0:3]:  # Only clean I, Q, U
-        mod = f'{source}.{freq}.{stokes}.mod'
-        cln = f'{source}.{freq}.{stokes}.cln'
-        maps = f'{source}.{freq}.{stokes}.map'
-        beam = f'{source}.{freq}.beam' 
-        fits = f'{source}.{stokes}.single.fits'
+    stokes, source, freq, region, nit, cut_noise, output = args
+    mod = f'{source}.{freq}.{stokes}.mod'
+    cln = f'{source}.{freq}.{stokes}.cln'
+    maps = f'{source}.{freq}.{stokes}.map'
+    beam = f'{source}.{freq}.beam' 
+    fits = f'{source}.{stokes}.single.fits'
+    log_file = 'error_single.log'
+    stdout = output_stream(output, f'{source}.{freq}.{stokes}.clean.log')
+    try:
         # Run through first clean of central source
         cmd = f'mfclean map={maps} beam={beam} region=percentage({region}) niters={nit} cutoff={cut_noise} out={mod}'
         print(cmd)
-        args=shlex.split(cmd)  # Splits the cmd into a string for subprocess
-        p=subprocess.Popen(args, stdout=subprocess.PIPE)
-        # Print the output
-        for line in p.stdout:
-            print(line)
-        p.wait()
+        run_miriad(cmd, log_file, stdout=stdout)
         # Restor the images
         cmd = f'restor map={maps} beam={beam} model={mod} out={cln}'
         print(cmd)
-        args=shlex.split(cmd)
-        p=subprocess.Popen(args, stdout=subprocess.PIPE)
-        for line in p.stdout:
-            print(line)
-        p.wait()
-        
+        run_miriad(cmd, log_file, stdout=stdout)
         # FITS convert
         cmd = f'fits in={cln} out={fits} op=xyout'
         print(cmd)
-        args=shlex.split(cmd)
-        p=subprocess.Popen(args, stdout=subprocess.PIPE)
-        for line in p.stdout:
-            print(line)
-        p.wait()
+        run_miriad(cmd, log_file, stdout=stdout)
+    finally:
+        if output == 'log':
+            stdout.close()
     return
 
+
+def clean_images(args):
+    '''
+    Cleans mfs dirty map generated from MM_single_inverter.py and converts to fits file
+    
+    User Inputs:
+    args = source, freq, region, nit
+    
+    Outputs:
+    cleans mfs dirty map and produces fits image for each stokes parameter
+    '''
+    source, freq, region, nit = args
+    stokespars = ['i','q','u','v']
+    cut_noise = get_noise(source,freq)
+    for stokes in stokespars[0:3]:  # Only clean I, Q, U
+        clean_stokes([stokes, source, freq, region, nit, cut_noise, 'show'])
+    return
+
+
 def get_noise(source,freq):
-    from astropy.io import fits
     import numpy as np
+    from MM_miriad_io import read_image
     noise=-100.0
     stokes='v'
     maps = f'{source}.{freq}.{stokes}.map'
     if os.path.isdir(maps):
-        fitsfile = f'{maps}.fits'
-        cmd = f'fits in={maps} out={fitsfile} op=xyout '
-        print(cmd)
-        args=shlex.split(cmd)
-        p=subprocess.Popen(args, stdout=subprocess.PIPE)
-    # Print the output
-        for line in p.stdout:
-            print(line)
-        p.wait()
-    # Open the FITS file
-        hdul = fits.open(fitsfile)
-        data = hdul[0].data
+    # Read the map directly from the miriad dataset
+        data = read_image(maps)
         noise=np.std(data)/2
         print(f"Triple Noise {noise:f}")
-        os.remove(fitsfile)
     return noise
 
-def main(args):
+def main(pool, args):
 
-    inputs = [args.source, args.freq, args.region, args.n_iters]
-    clean_images(inputs)
+    stokespars = ['i','q','u','v']
+    # The stokes v noise is the cutoff of every clean, so it is measured once up front
+    cut_noise = get_noise(args.source,args.freq)
+    # Only clean I, Q, U, each on its own processor
+    inputs = [[stokes, args.source, args.freq, args.region, args.n_iters, cut_noise, args.output] for stokes in stokespars[0:3]]
+    imap = getattr(pool, 'imap', pool.map)
+    for _ in imap(clean_stokes, inputs):
+        pass
+    pool.close()
     print('Done')
 
 if __name__ == "__main__":
@@ -113,10 +120,29 @@ if __name__ == "__main__":
     parser.add_argument("-r", dest="region", type=float, default=95,
                         help="region (percentage) to clean as percentage of image")
 
+    add_output_arguments(parser)
+
+    add_engine_arguments(parser)
+
+    group = parser.add_mutually_exclusive_group()
+
+    group.add_argument("--ncores", dest="n_cores", default=3,
+                       type=int, help="Number of processes (uses multiprocessing, default one per stokes).")
+    group.add_argument("--mpi", dest="mpi", default=False,
+                       action="store_true", help="Run with MPI.")
+
     args = parser.parse_args()
+    if args.engine == 'asyncio' and args.mpi:
+        parser.error('--engine asyncio runs on one node, it cannot be combined with --mpi')
+    pool = choose_engine(args)
+
+    if args.mpi:
+        if not pool.is_master():
+            pool.wait()
+            sys.exit(0)
 
     # Clean the images
-    main(args)
+    main(pool, args)
 
 
 
@@ -3,6 +3,8 @@ import subprocess,shlex,shutil
 import sys,getopt
 import glob
 
+from MM_run import run_miriad, output_stream, add_output_arguments
+
 # Miriad Single Inverter
 # Work through making single image from .uvaver miriad files
 # J. Livingston 23 Oct 2019
@@ -14,15 +16,13 @@ def grid_images(args):
     Takes inputs and runs miriad invert from command line producing dirty maps and beams
     
     User Inputs:
-    t = core index
-    
-    Other Inputs:
-    outputs from inputs function above
+    args = source, freq, field, output
+    (output is how the miriad output is handled: show, log or quiet, see MM_run.output_stream)
     
     Outputs:
     for each channel band produces dirty maps (.map) for each Stokes parameter and beam images
     '''
-    source, freq, field = args
+    source, freq, field, output = args
     #Get all uvaver files
     uvaver_locations=glob.glob(f'../../*/*/{source}*.uvaver') #!only works for where my files are stored!
     var_strs=','.join(uvaver_locations)
@@ -40,18 +40,16 @@ def grid_images(args):
             stokes_str = ','.join(stokespars)
             cmd =f'invert vis={var_strs} map={maps} beam={beam} imsize={field},{field} cell=1,1 robust=+0.6 stokes={stokes_str} options=double,sdb,mfs'
             print(cmd)
-            args=shlex.split(cmd)
-            p=subprocess.Popen(args, stdout=subprocess.PIPE)
-            
-    # Print the output
-            for line in p.stdout:
-               print(line)
-            p.wait()
+            # The output goes straight to the terminal (or a log) rather than through python line by line
+            stdout = output_stream(output, f'{source}.{freq}.invert.log')
+            run_miriad(cmd, 'error_single.log', stdout=stdout)
+            if output == 'log':
+                stdout.close()
     return
 
 def main(args):
 
-    inputs = [args.source, args.freq, args.field_size]
+    inputs = [args.source, args.freq, args.field_size, args.output]
 
     #Runs each chunk of freq on new processor
     grid_images(inputs)
@@ -77,6 +75,8 @@ if __name__ == "__main__":
     parser.add_argument("-b", dest="field_size", type=int, default=2000,
                         help="size of field in pixels sqr")
 
+    add_output_arguments(parser)
+
     args = parser.parse_args()
 
     # Create the images
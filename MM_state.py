@@ -0,0 +1,292 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import socket
+import threading
+from contextlib import contextmanager
+
+# Miriad Multicore run state
+# Append-only journal of the state (pending, running, done, failed) of every stage of every
+# channel/stokes, with the sizes of the outputs of finished stages. A restarted run skips the
+# stages that are done and whose outputs are still there and unchanged, and redoes the rest.
+# Each record is one small appended line, so parallel workers can share the journal.
+# A stage with no record whose outputs are all there (a run from before the journal) is taken as
+# done and recorded, and a clean is redone once the maps of its channel have been gridded again.
+# WORKS FOR PYTHON 3
+
+STATUSES = ['pending', 'running', 'done', 'failed']
+
+# Stage whose outputs a stage reads: a newer record of it invalidates the stage
+UPSTREAM = {'clean': 'grid'}
+
+# The attempt a thread is running (see attempt), speculative copies of a task stage under their own names
+_attempt = threading.local()
+
+
+def state_name(source, freq):
+    return f'{source}.{freq}.state.log'
+
+
+def stage_outputs(source, freq):
+    '''
+    Final outputs of the stages of a run, as recorded with their done records
+
+    Outputs:
+    function of (stage, chan, stokes) -> list of output paths (empty for stages without fixed outputs)
+    '''
+    def outputs(stage, chan, stokes):
+        name = f'{source}.{freq}.{chan:04d}'
+        if stage == 'grid':
+            return [f'{name}.{a}.map' for a in ['i','q','u','v']] + [f'{name}.beam']
+        if stage == 'clean':
+            return [f'{name}.{stokes}.cln.fits']
+        return []
+    return outputs
+
+
+def output_size(path):
+    '''
+    Size in bytes of a file or of all files in a miriad dataset directory (None if missing)
+    '''
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, item)) for item in os.listdir(path)
+                   if os.path.isfile(os.path.join(path, item)))
+    return None
+
+
+def record(state, stage, chan, stokes, status, outputs=()):
+    '''
+    Appends a state record to the journal (no-op if state is None or '')
+
+    Inputs:
+    state = journal file
+    stage, chan, stokes = what the record is for (stokes '' for per-channel stages)
+    status = one of STATUSES
+    outputs = output paths, their sizes are stored with done records
+    '''
+    if not state or cancelled():
+        # An attempt cancelled because another one finished first leaves the journal to it
+        return
+    entry = {'stage': stage, 'chan': chan, 'stokes': stokes, 'status': status,
+             'time': time.time(), 'host': socket.gethostname(), 'pid': os.getpid()}
+    if status == 'done':
+        entry['outputs'] = {path: output_size(path) for path in outputs}
+    with open(state, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
+def read_states(state):
+    '''
+    Reads the journal
+
+    Outputs:
+    dict of (stage, chan, stokes) -> latest record
+    '''
+    states = {}
+    if not state or not os.path.isfile(state):
+        return states
+    with open(state) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by a killed run
+            states[(entry['stage'], entry['chan'], entry['stokes'])] = entry
+    return states
+
+
+def is_done(states, stage, chan, stokes):
+    '''
+    True if the stage finished and all its outputs still exist with the recorded sizes, and the
+    stage it reads from (UPSTREAM) has not been recorded again since
+    '''
+    entry = states.get((stage, chan, stokes))
+    if entry is None or entry['status'] != 'done':
+        return False
+    upstream = states.get((UPSTREAM.get(stage), chan, ''))
+    if upstream is not None and upstream['time'] > entry['time']:
+        return False
+    return all(output_size(path) == size for path, size in entry.get('outputs', {}).items())
+
+
+def seed(state, states, keys, outputs):
+    '''
+    Records as done every key with no record in the journal whose outputs all exist, so a
+    workdir imaged before the journal existed (or with it disabled) is not redone. The records
+    carry the time of the newest output, so a clean seeded after its maps stays valid.
+
+    Inputs:
+    state = journal file
+    states = journal from read_states, updated in place
+    keys = (stage, chan, stokes) to check
+    outputs = function of (stage, chan, stokes) -> output paths, see stage_outputs
+    '''
+    if not state:
+        return
+    host, pid, lines = socket.gethostname(), os.getpid(), []
+    for stage, chan, stokes in keys:
+        paths = outputs(stage, chan, stokes)
+        if (stage, chan, stokes) in states or not paths or not all(os.path.exists(path) for path in paths):
+            continue
+        entry = {'stage': stage, 'chan': chan, 'stokes': stokes, 'status': 'done',
+                 'time': max(os.path.getmtime(path) for path in paths), 'host': host, 'pid': pid,
+                 'outputs': {path: output_size(path) for path in paths}, 'seeded': True}
+        states[(stage, chan, stokes)] = entry
+        lines.append(json.dumps(entry) + '\n')
+    if lines:
+        with open(state, 'a') as f:
+            f.write(''.join(lines))
+
+
+def mark_pending(state, states, keys, outputs=None):
+    '''
+    Records every (stage, chan, stokes) in keys that is not done as pending and returns them
+    (with outputs, see stage_outputs, keys with no record whose outputs exist are seeded as done first)
+    '''
+    if outputs is not None:
+        seed(state, states, keys, outputs)
+    todo = [key for key in keys if not is_done(states, *key)]
+    if state and todo:
+        now, host, pid = time.time(), socket.gethostname(), os.getpid()
+        with open(state, 'a') as f:
+            f.write(''.join(json.dumps({'stage': stage, 'chan': chan, 'stokes': stokes, 'status': 'pending',
+                                        'time': now, 'host': host, 'pid': pid}) + '\n'
+                            for stage, chan, stokes in todo))
+    return todo
+
+
+def remove(path):
+    '''
+    Removes a stale file or miriad dataset left by an earlier run
+    '''
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+@contextmanager
+def attempt(since, speculative=False, cancel=None):
+    '''
+    Marks the task run in this thread as one attempt of a task that may run more than once at the
+    same time (speculative re-execution, see MM_scheduler.run_graph)
+
+    Inputs:
+    since = time the first attempt of the task was submitted, outputs committed after it are
+            taken to come from another attempt
+    speculative = this is the extra copy: it stages under its own .spec.tmp names and in its own
+                  scratch directory (MM_scratch.scratch_space), so the attempts never share files
+    cancel = file that appears once another attempt of the task has finished: the miriad task
+             running is killed, no further ones start and nothing is recorded (see cancelled)
+    '''
+    _attempt.since, _attempt.speculative, _attempt.cancel = since, speculative, cancel
+    try:
+        yield
+    finally:
+        _attempt.since, _attempt.speculative, _attempt.cancel = None, False, None
+
+
+def speculative():
+    return getattr(_attempt, 'speculative', False)
+
+
+def cancel_file():
+    return getattr(_attempt, 'cancel', None)
+
+
+def cancelled():
+    '''
+    True once another attempt of the task run in this thread has finished (see attempt)
+    '''
+    path = cancel_file()
+    return bool(path) and os.path.exists(path)
+
+
+def tmp_name(path):
+    return f'{path}.spec.tmp' if speculative() else f'{path}.tmp'
+
+
+@contextmanager
+def _commit_lock(path):
+    # One lock per directory, commits are only renames so they never wait long
+    with open(os.path.join(os.path.dirname(path) or '.', '.mm_commit.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def commit(paths):
+    '''
+    Renames the temporary outputs of a finished stage to their final names
+
+    Outputs:
+    True if every temporary output existed and was moved into place (or another attempt of the
+    same task already moved its outputs into place, whose are kept)
+    '''
+    if not all(os.path.exists(tmp_name(path)) for path in paths):
+        return False
+    since = getattr(_attempt, 'since', None)
+    if since is None:
+        for path in paths:
+            remove(path)
+            os.replace(tmp_name(path), path)
+        return True
+    # Attempts of a task commit one at a time and the first to finish wins
+    with _commit_lock(paths[0]):
+        if all(os.path.exists(path) and os.path.getmtime(path) >= since for path in paths):
+            for path in paths:
+                remove(tmp_name(path))
+            return True
+        for path in paths:
+            remove(path)
+            os.replace(tmp_name(path), path)
+    return True
+
+
+def add_state_arguments(parser):
+    '''
+    Adds the run state options shared by the inverters and cleaners to an argparse parser
+    '''
+    parser.add_argument("--state", dest="state", default=None,
+                        help="run state journal used to resume interrupted runs\n"
+                             "(default {source}.{freq}.state.log, '' to disable)")
+
+
+if __name__ == "__main__":
+    import argparse
+    from collections import Counter
+
+    # Help string to be shown using the -h option
+    descStr = """
+    Summarises a run state journal: number of channel/stokes stages pending, running, done and failed
+    """
+
+    parser = argparse.ArgumentParser(description=descStr,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-s", dest="source",
+                        type=str, help="Source name in RA-DEC convention from miriad")
+
+    parser.add_argument("-f", dest="freq", type=int, default=2100,
+                        help="centre frequency in MHz")
+
+    add_state_arguments(parser)
+
+    args = parser.parse_args()
+    state = args.state or state_name(args.source, args.freq)
+    if not os.path.isfile(state):
+        print(f'No state journal {state}')
+        sys.exit(1)
+    states = read_states(state)
+    counts = Counter((key[0], entry['status']) for key, entry in states.items())
+    for stage in sorted({key[0] for key in states}):
+        print(stage, ' '.join(f'{status}={counts[(stage, status)]}' for status in STATUSES))
+    failed = sorted(key for key, entry in states.items() if entry['status'] == 'failed')
+    for stage, chan, stokes in failed:
+        print(f'failed: {stage} {chan:04d} {stokes}')
@@ -0,0 +1,300 @@
+import os
+import sys
+import time
+import itertools
+import numpy as np
+import tqdm
+
+from MM_run import run_miriad
+from MM_fits import miriad_to_fits
+from MM_miriad_io import read_header, read_image
+from MM_state import remove
+from MM_trace import trace_option, add_trace_arguments
+from MM_memory import memory_option, add_memory_arguments
+from MM_placement import placement_option, add_placement_arguments
+from MM_manifest import DEFAULT_GLOBS, load_manifest, channel_range, add_manifest_arguments
+
+# Miriad Multicore clean parameter sweep
+# Cleans the same dirty maps with every combination of a grid of clean settings (region, niters,
+# cutoff scale) in one pool: one task per (channel, stokes, setting), all reading the dirty maps
+# and beams already made by the inverter and the noise cutoff measured once per channel. Each
+# setting writes its models and images into its own directory ({source}.{freq}.sweep/r95_i1000/...)
+# so settings never overwrite each other or the normal clean outputs. The residual of every clean
+# is measured (restor mode=residual) and the run ends with a table comparing the settings.
+# WORKS FOR PYTHON 3
+
+STOKESPARS = ['i','q','u','v']
+
+
+def sweep_dir(source, freq):
+    return f'{source}.{freq}.sweep'
+
+
+def setting_name(region, nit, scale):
+    '''
+    Directory name of a clean setting, e.g. r95_i1000 (or r95_i1000_c2 with a cutoff scale)
+    '''
+    name = f'r{region:g}_i{nit}'
+    return name if scale == 1 else f'{name}_c{scale:g}'
+
+
+def sweep_settings(regions, niters, scales):
+    '''
+    Every combination of the swept clean parameters
+
+    Outputs:
+    dict of setting name -> (region, niters, cutoff scale)
+    '''
+    return {setting_name(region, nit, scale): (region, nit, scale)
+            for region, nit, scale in itertools.product(regions, niters, scales)}
+
+
+def read_sweep(table):
+    '''
+    Reads the sweep table written by record_sweep
+
+    Outputs:
+    dict of (setting, chan, stokes) -> (residual rms, residual peak, seconds), later rows replacing earlier ones
+    '''
+    rows = {}
+    if not os.path.isfile(table):
+        return rows
+    with open(table) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 6 and not line.startswith('#'):
+                setting, chan, stokes, rms, peak, seconds = parts
+                rows[(setting, int(chan), stokes)] = (float(rms), float(peak), float(seconds))
+    return rows
+
+
+def record_sweep(table, setting, chan, stokes, rms, peak, seconds):
+    '''
+    Appends the residual of one clean to the sweep table (one small write)
+    '''
+    with open(table, 'a') as f:
+        f.write(f'{setting} {chan} {stokes} {rms:.6g} {peak:.6g} {seconds:.3f}\n')
+
+
+def sweep_clean(args):
+    '''
+    Cleans one stokes map of a channel with one setting of the sweep, writing into the setting's directory
+
+    User Inputs:
+    args = chan, stokes, source, freq, directory, region, nit, cut_noise, region_mode, trace, memory, placement
+    (region_mode cleans the whole map and skips linmos like MM_region_clean.py)
+    (trace, memory and placement are as in MM_cleaner.clean_stokes)
+
+    Outputs:
+    (chan, stokes, residual rms, residual peak, seconds), rms and peak are NaN if any step failed
+    (no row is recorded for them)
+    '''
+    chan, stokes, source, freq, directory, region, nit, cut_noise, region_mode, trace, memory, placement = args
+    start = time.time()
+    # The dirty map and beam are shared by all settings, everything else is per setting
+    maps = f'{source}.{freq}.{chan:04d}.{stokes}.map'
+    beam = f'{source}.{freq}.{chan:04d}.beam'
+    mod, resid, pbcorr, cln = [os.path.join(directory, f'{source}.{freq}.{chan:04d}.{stokes}.{ext}')
+                               for ext in ['mod', 'resid', 'pbcorr', 'cln']]
+    outfile = f'{cln}.fits'
+    log_file = os.path.join(directory, 'error_cln.log')
+    if not os.path.isdir(maps) or not os.path.isdir(beam):
+        return chan, stokes, np.nan, np.nan, 0.0
+    # Clear intermediates left by an interrupted run, miriad will not overwrite them
+    for stale in [mod, resid, pbcorr, cln, outfile]:
+        remove(stale)
+    tags = {'stage': 'sweep', 'chan': chan, 'stokes': stokes}
+    run = lambda cmd: run_miriad(cmd, log_file, False, trace, tags, memory, placement)
+    area = '' if region_mode else f' region=percentage({region})'
+    # Each step only runs if the one before it succeeded, like MM_cleaner.clean_stokes
+    ret = run(f'clean map={maps} beam={beam}{area} niters={nit} cutoff={cut_noise} out={mod}')
+    if ret == 0:
+        ret = run(f'restor map={maps} beam={beam} model={mod} mode=residual out={resid}')
+    rms = peak = np.nan
+    if ret == 0 and os.path.isdir(resid):
+        data = read_image(resid)
+        rms = float(np.sqrt(np.nanmean(np.square(data))))
+        peak = float(np.nanmax(np.abs(data)))
+    remove(resid)
+    # Restor the images, primary beam corrected unless in region mode
+    if region_mode:
+        if ret == 0:
+            ret = run(f'restor map={maps} beam={beam} model={mod} out={cln}')
+        if ret == 0:
+            ret = miriad_to_fits(cln, outfile)
+    else:
+        if ret == 0:
+            ret = run(f'restor map={maps} beam={beam} model={mod} out={pbcorr}')
+        if ret == 0:
+            ret = run(f'linmos in={pbcorr} out={cln}')
+        if ret == 0:
+            rms_item = read_header(pbcorr).get('rms')
+            ret = miriad_to_fits(cln, outfile, None if rms_item is None else {'rms': rms_item})
+        remove(pbcorr)
+    # A setting only gets a row in the comparison once its clean image exists
+    if ret != 0 or not os.path.isfile(outfile):
+        return chan, stokes, np.nan, np.nan, time.time() - start
+    return chan, stokes, rms, peak, time.time() - start
+
+
+def sweep_summary(rows, settings):
+    '''
+    Lines of the table comparing the settings: residual rms per stokes (mean over channels),
+    worst residual peak and clean time, best (lowest mean residual rms) first
+    '''
+    lines = ['# setting region niters cutoff_scale cleans ' + ' '.join(f'rms_{stokes}' for stokes in STOKESPARS)
+             + ' rms_mean peak_max seconds']
+    table = []
+    for name, (region, nit, scale) in settings.items():
+        mine = {key: value for key, value in rows.items() if key[0] == name and np.isfinite(value[0])}
+        if not mine:
+            continue
+        per_stokes = {stokes: [rms for (_, _, s), (rms, _, _) in mine.items() if s == stokes] for stokes in STOKESPARS}
+        means = [np.mean(values) if values else np.nan for values in per_stokes.values()]
+        rms_mean = float(np.mean([rms for rms, _, _ in mine.values()]))
+        peak = max(peak for _, peak, _ in mine.values())
+        seconds = sum(seconds for _, _, seconds in mine.values())
+        table.append((rms_mean, f'{name} {region:g} {nit} {scale:g} {len(mine)} ' + ' '.join(f'{m:.4g}' for m in means)
+                      + f' {rms_mean:.4g} {peak:.4g} {seconds:.1f}'))
+    return lines + [line for _, line in sorted(table)]
+
+
+def main(pool, args):
+
+    if args.region_mode:
+        from MM_region_clean import channel_noise
+    else:
+        from MM_cleaner import channel_noise
+    # The final channel is taken from the visibility manifest when -2 is not given
+    globs = args.vis_globs or DEFAULT_GLOBS['region' if args.region_mode else 'multicore']
+    chans = list(channel_range(load_manifest(args.source, args.freq, globs, args.manifest, args.rescan),
+                               args.start_chan, args.end_chan, args.step_size))
+    settings = sweep_settings(args.regions, args.niters, args.cut_scales)
+    out_dir = args.sweep_dir or sweep_dir(args.source, args.freq)
+    for name in settings:
+        os.makedirs(os.path.join(out_dir, name), exist_ok=True)
+    table = os.path.join(out_dir, 'sweep_table.txt')
+    imap = getattr(pool, 'imap', pool.map)
+
+    # The noise cutoff is shared by every setting, so it is measured once per channel
+    print('Measuring Noise')
+    noise_inputs = [[i, args.source, args.freq, args.noise_method, args.noise_table] for i in chans]
+    cut_noise = dict(zip(chans, tqdm.tqdm(imap(channel_noise, noise_inputs), total=len(chans))))
+
+    # Cleans of an earlier sweep with their image still there are not repeated
+    rows = read_sweep(table)
+    def done(name, chan, stokes):
+        image = os.path.join(out_dir, name, f'{args.source}.{args.freq}.{chan:04d}.{stokes}.cln.fits')
+        return (name, chan, stokes) in rows and os.path.isfile(image)
+    keys = [(name, chan, stokes) for name in settings for chan in chans for stokes in STOKESPARS
+            if cut_noise[chan] > 0 and not done(name, chan, stokes)]
+    # Most iterations first so the longest cleans are not left to the end
+    keys.sort(key=lambda key: settings[key[0]][1], reverse=True)
+    options = [args.region_mode, trace_option(args), memory_option(args), placement_option(args)]
+    inputs = [[chan, stokes, args.source, args.freq, os.path.join(out_dir, name), settings[name][0], settings[name][1],
+               cut_noise[chan] * settings[name][2]] + options for name, chan, stokes in keys]
+
+    print(f'Cleaning {len(settings)} settings')
+    for (name, _, _), (chan, stokes, rms, peak, seconds) in tqdm.tqdm(zip(keys, imap(sweep_clean, inputs)), total=len(inputs)):
+        if np.isfinite(rms):
+            record_sweep(table, name, chan, stokes, rms, peak, seconds)
+    pool.close()
+
+    summary = sweep_summary(read_sweep(table), settings)
+    with open(os.path.join(out_dir, 'sweep_summary.txt'), 'w') as f:
+        f.write('\n'.join(summary) + '\n')
+    print('\n'.join(summary))
+
+
+if __name__ == "__main__":
+    import argparse
+    from MM_async import choose_engine, add_engine_arguments
+    from MM_retry import apply_retry, add_retry_arguments
+
+
+    # Help string to be shown using the -h option
+    descStr = """
+    Cleans the dirty maps of a run with every combination of the given clean settings, each
+    setting in its own directory, and compares the residual rms of the settings
+    """
+
+    # Parse the command line options
+    parser = argparse.ArgumentParser(description=descStr,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-s", dest="source",
+                        type=str, help="Source name in RA-DEC convention from miriad")
+
+    parser.add_argument("-f", dest="freq", type=int, default=2100,
+                        help="centre frequency in MHz")
+
+    parser.add_argument("-1", dest="start_chan", type=int, default=1,
+                        help="starting channel number")
+
+    parser.add_argument("-2", dest="end_chan", type=int, default=None,
+                        help="final channel number (default from the visibility manifest)")
+
+    parser.add_argument("-d", dest="step_size", type=int, default=5,
+                        help="channel step_size for images")
+
+    parser.add_argument("-i", dest="niters", type=int, nargs='+', default=[1000],
+                        help="numbers of iterations to clean (one setting each)")
+
+    parser.add_argument("-r", dest="regions", type=float, nargs='+', default=[95],
+                        help="regions (percentage) to clean as percentage of image (one setting each)")
+
+    parser.add_argument("--cut-scale", dest="cut_scales", type=float, nargs='+', default=[1.0],
+                        help="multiples of the stokes v noise cutoff to clean down to (one setting each)")
+
+    parser.add_argument("--noise", dest="noise_method", default="std", choices=['mad','clip','std'],
+                        help="estimator for the stokes v noise used as clean cutoff")
+
+    parser.add_argument("--noise-table", dest="noise_table", default="noise_table.txt",
+                        help="table caching per-channel noise between runs ('' to disable)")
+
+    parser.add_argument("--sweep-dir", dest="sweep_dir", default=None,
+                        help="directory of the setting directories and tables (default {source}.{freq}.sweep)")
+
+    parser.add_argument("--region-mode", dest="region_mode", default=False, action="store_true",
+                        help="clean like MM_region_clean.py (whole map, no linmos, -r has no effect)")
+
+    add_trace_arguments(parser)
+
+    add_memory_arguments(parser)
+
+    add_placement_arguments(parser)
+
+    add_manifest_arguments(parser, DEFAULT_GLOBS['multicore'], DEFAULT_GLOBS['region'])
+
+    add_retry_arguments(parser)
+
+    add_engine_arguments(parser)
+
+    group = parser.add_mutually_exclusive_group()
+
+    group.add_argument("--ncores", dest="n_cores", default=1,
+                       type=int, help="Number of processes (uses multiprocessing).")
+    group.add_argument("--mpi", dest="mpi", default=False,
+                       action="store_true", help="Run with MPI.")
+
+
+    args = parser.parse_args()
+    if args.engine == 'asyncio' and args.mpi:
+        parser.error('--engine asyncio runs on one node, it cannot be combined with --mpi')
+    if args.autotune:
+        parser.error('--autotune is not supported by the sweep, give --threads')
+    if args.region_mode and len(args.regions) > 1:
+        parser.error('--region-mode cleans the whole map, sweeping -r would repeat the same cleans')
+    if args.speculate:
+        parser.error('--speculate is not supported by the sweep, its cleans write straight into the setting directories')
+    # Timeouts and retries of the miriad tasks, inherited by the workers
+    apply_retry(args)
+    pool = choose_engine(args)
+
+    if args.mpi:
+        if not pool.is_master():
+            pool.wait()
+            sys.exit(0)
+
+
+    # Clean with every setting
+    main(pool, args)
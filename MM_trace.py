@@ -0,0 +1,117 @@
+import os
+import sys
+import json
+import socket
+from collections import defaultdict
+
+# Miriad Multicore trace
+# JSON-lines trace of every miriad task run by the inverters and cleaners (wall time, child cpu
+# time, peak rss and exit code, tagged with stage/channel/stokes) and a summary report of it
+# WORKS FOR PYTHON 3
+
+
+def record_trace(trace, entry):
+    '''
+    Appends one record to the trace (a single small write, so parallel workers do not interleave)
+    '''
+    if not trace:
+        return
+    entry = dict(entry, host=socket.gethostname(), pid=os.getpid())
+    with open(trace, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
+def read_trace(trace):
+    '''
+    Reads every record of a trace, skipping a line cut short by a killed run
+    '''
+    entries = []
+    with open(trace) as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return entries
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(int(q / 100 * len(values)), len(values) - 1)]
+
+
+def summarise(entries, n_slowest=10):
+    '''
+    Builds the summary report of a trace
+
+    Outputs:
+    list of report lines: per miriad task totals and percentiles, then the slowest channels
+    '''
+    by_task = defaultdict(list)
+    by_chan = defaultdict(float)
+    for entry in entries:
+        by_task[entry['task']].append(entry)
+        if entry.get('chan') is not None:
+            by_chan[(entry.get('stage'), entry['chan'])] += entry['wall']
+    total = sum(entry['wall'] for entry in entries) or 1.0
+    lines = [f"{'task':8s} {'runs':>6s} {'fail':>5s} {'wall[s]':>10s} {'%wall':>6s} {'cpu[s]':>10s} "
+             f"{'p50':>8s} {'p90':>8s} {'p99':>8s} {'max':>8s} {'rss[MB]':>8s}"]
+    for task, runs in sorted(by_task.items(), key=lambda item: -sum(e['wall'] for e in item[1])):
+        walls = [e['wall'] for e in runs]
+        lines.append(f"{task:8s} {len(runs):6d} {sum(e['exit'] != 0 for e in runs):5d} {sum(walls):10.1f} "
+                     f"{100 * sum(walls) / total:6.1f} {sum(e['cpu'] or 0 for e in runs):10.1f} "
+                     f"{percentile(walls, 50):8.2f} {percentile(walls, 90):8.2f} {percentile(walls, 99):8.2f} "
+                     f"{max(walls):8.2f} {max(e['maxrss'] or 0 for e in runs) / 1024:8.0f}")
+    lines.append('')
+    lines.append(f'Slowest {n_slowest} channels (wall time summed over their miriad tasks)')
+    for (stage, chan), wall in sorted(by_chan.items(), key=lambda item: -item[1])[:n_slowest]:
+        lines.append(f'{stage:6s} {chan:04d} {wall:10.1f} s')
+    return lines
+
+
+def trace_name(source, freq):
+    return f'{source}.{freq}.trace.jsonl'
+
+
+def add_trace_arguments(parser):
+    '''
+    Adds the trace option shared by the inverters and cleaners to an argparse parser
+    '''
+    parser.add_argument("--trace", dest="trace", default=None,
+                        help="json-lines trace of every miriad task run\n"
+                             "(default {source}.{freq}.trace.jsonl, '' to disable)")
+
+
+def trace_option(args):
+    return trace_name(args.source, args.freq) if args.trace is None else args.trace
+
+
+if __name__ == "__main__":
+    import argparse
+
+    # Help string to be shown using the -h option
+    descStr = """
+    Summarises a miriad task trace: time per task (invert, clean, restor, ...) and the slowest channels
+    """
+
+    parser = argparse.ArgumentParser(description=descStr,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-s", dest="source",
+                        type=str, help="Source name in RA-DEC convention from miriad")
+
+    parser.add_argument("-f", dest="freq", type=int, default=2100,
+                        help="centre frequency in MHz")
+
+    parser.add_argument("-n", dest="n_slowest", type=int, default=10,
+                        help="number of slowest channels to list")
+
+    add_trace_arguments(parser)
+
+    args = parser.parse_args()
+    trace = trace_option(args)
+    if not trace or not os.path.isfile(trace):
+        print(f'No trace {trace}')
+        sys.exit(1)
+    print('\n'.join(summarise(read_trace(trace), args.n_slowest)))
@@ -0,0 +1,109 @@
+import os
+import shutil
+import numpy as np
+
+from MM_miriad_io import read_image, scale_image
+from MM_state import remove
+
+# Miriad Multicore warm start
+# Seeds the clean of a channel with the clean model of the previous channel (miriad clean model=),
+# since adjacent channels of a source have nearly the same sky. Channels of each stokes are cleaned
+# in chains of --warm-chain consecutive channels, one chain per worker, so each seed is finished
+# before the channel that uses it starts; the first channel of a chain starts cold unless the
+# previous channel was already cleaned by an earlier run. Models are kept next to the maps.
+# WORKS FOR PYTHON 3
+
+# Limits on the automatic seed scaling, the seed is only a starting point for clean
+MIN_SCALE = 0.5
+MAX_SCALE = 2.0
+
+
+def _peak(maps):
+    return float(np.nanmax(np.abs(read_image(maps))))
+
+
+def scale_factor(scale, maps, prev_map):
+    '''
+    Factor to scale the previous channel's model by
+
+    Inputs:
+    scale = 'peak' (ratio of the dirty map peaks of this and the previous channel), 'none', or a number
+    maps, prev_map = dirty maps of this and the previous channel
+    '''
+    if scale == 'none':
+        return 1.0
+    if scale != 'peak':
+        return float(scale)
+    if not os.path.isdir(prev_map):
+        return 1.0
+    prev = _peak(prev_map)
+    if not prev > 0:
+        return 1.0
+    return min(MAX_SCALE, max(MIN_SCALE, _peak(maps) / prev))
+
+
+def seed_model(warm, maps, out):
+    '''
+    Copies (and scales) the previous channel's clean model to out for clean model=
+
+    Inputs:
+    warm = (previous channel's model, previous channel's dirty map, scale) from the cleaner's main
+    maps = dirty map being cleaned
+    out = name for the seed model (in scratch if used)
+
+    Outputs:
+    out, or None if there is no model to start from
+    '''
+    prev_mod, prev_map, scale = warm
+    if not prev_mod or not os.path.isdir(prev_mod):
+        return None
+    remove(out)
+    shutil.copytree(prev_mod, out)
+    factor = scale_factor(scale, maps, prev_map)
+    if factor != 1.0:
+        scale_image(out, factor)
+    return out
+
+
+def warm_chains(todo, chans, chain_len):
+    '''
+    Groups the (chan, stokes) cleans to run into chains of consecutive channels of one stokes
+
+    Inputs:
+    todo = (chan, stokes) cleans to run
+    chans = all channels of the run in order
+    chain_len = channels per chain
+
+    Outputs:
+    list of chains, each a list of (chan, stokes, previous channel to seed from or None)
+    '''
+    chans = list(chans)
+    index = {chan: k for k, chan in enumerate(chans)}
+    pending = set(todo)
+    chains = []
+    for stokes in sorted({stokes for _, stokes in todo}):
+        order = sorted(chan for chan, s in todo if s == stokes)
+        for start in range(0, len(order), chain_len):
+            chain = []
+            for k, chan in enumerate(order[start:start + chain_len]):
+                prev = chans[index[chan] - 1] if index[chan] > 0 else None
+                # A chain head cannot wait for a previous channel that another chain is still cleaning
+                if k == 0 and (prev, stokes) in pending:
+                    prev = None
+                chain.append((chan, stokes, prev))
+            chains.append(chain)
+    return chains
+
+
+def add_warm_arguments(parser):
+    '''
+    Adds the warm start options shared by the cleaners to an argparse parser
+    '''
+    parser.add_argument("--warm-start", dest="warm_start", default=False, action="store_true",
+                        help="seed each channel's clean with the previous channel's model")
+
+    parser.add_argument("--warm-chain", dest="warm_chain", type=int, default=10,
+                        help="consecutive channels per warm start chain (chains run in parallel)")
+
+    parser.add_argument("--warm-scale", dest="warm_scale", default="peak",
+                        help="scaling of the seed model: peak (ratio of dirty map peaks), none, or a factor")